@@ -0,0 +1,114 @@
+"""Columnar format of tokenized dtitle data, a directory (*.dtitle.columnar) with:
+	meta.json: columns, row count and dtype of tokens
+	<column>.tokens: token ids of all rows in one flat array (uint16 when vocab_size <= 65536, int32 otherwise)
+	<column>.offsets: int64 array of row_count + 1 offsets, tokens of row i are tokens[offsets[i]:offsets[i+1]]
+arrays are raw little-endian binaries which are memory-mapped by ColumnarReader.
+"""
+
+import os
+import json
+import shutil
+
+import numpy as np
+
+
+_META_FILE = 'meta.json'
+
+def _token_dtype(vocab_size):
+	return np.uint16 if vocab_size <= 2**16 else np.int32
+
+
+class ColumnarWriter():
+	"""write packed blocks (lengths[row_count, col_count], ids) of tokenize-dtitle-v2 workers into a columnar directory"""
+	def __init__(self, path, columns, vocab_size):
+		self.path = path
+		self.columns = list(columns)
+		self.dtype = np.dtype(_token_dtype(vocab_size)).newbyteorder('<')
+		self.vocab_size = vocab_size
+		self.row_count = 0
+		os.makedirs(path, exist_ok=True)
+		self._token_files = [open(os.path.join(path, f'{col}.tokens'), 'wb') for col in self.columns]
+		self._offsets = [[np.zeros([1], dtype=np.int64)] for _ in self.columns]
+		self._token_counts = [0] * len(self.columns)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def write_block(self, lengths, ids):
+		ends = np.cumsum(lengths.ravel())
+		starts = ends - lengths.ravel()
+		for c, fo in enumerate(self._token_files):
+			col_starts, col_ends = starts[c::len(self.columns)], ends[c::len(self.columns)]
+			col_ids = np.concatenate([ids[s:e] for s, e in zip(col_starts, col_ends)]) if len(col_starts) else ids[:0]
+			col_ids.astype(self.dtype).tofile(fo)
+			self._offsets[c].append(self._token_counts[c] + np.cumsum(lengths[:, c], dtype=np.int64))
+			self._token_counts[c] += len(col_ids)
+		self.row_count += lengths.shape[0]
+
+	def close(self):
+		for col, fo, offsets in zip(self.columns, self._token_files, self._offsets):
+			fo.close()
+			np.concatenate(offsets).astype('<i8').tofile(os.path.join(self.path, f'{col}.offsets'))
+		_write_meta(self.path, self.columns, self.row_count, self.dtype, self.vocab_size)
+
+
+def _write_meta(path, columns, row_count, dtype, vocab_size):
+	with open(os.path.join(path, _META_FILE), 'w') as fo:
+		json.dump({'columns': columns, 'row_count': row_count, 'dtype': dtype.str, 'vocab_size': vocab_size}, fo)
+
+def write_columns(path, column_files, vocab_size):
+	"""build a columnar directory from existing (tokens file, offsets file) of each column, e.g. columns cached by StageCache,
+	returns (row count, token count)"""
+	os.makedirs(path, exist_ok=True)
+	dtype = np.dtype(_token_dtype(vocab_size)).newbyteorder('<')
+	row_counts, token_count = set(), 0
+	for col, (token_file, offset_file) in column_files.items():
+		shutil.copyfile(token_file, os.path.join(path, f'{col}.tokens'))
+		shutil.copyfile(offset_file, os.path.join(path, f'{col}.offsets'))
+		row_counts.add(os.path.getsize(offset_file) // 8 - 1)
+		token_count += os.path.getsize(token_file) // dtype.itemsize
+	if len(row_counts) != 1:
+		raise ValueError(f'columns of {path} have different row counts {row_counts}')
+	row_count = row_counts.pop()
+	_write_meta(path, list(column_files), row_count, dtype, vocab_size)
+	return row_count, token_count
+
+
+class ColumnarReader():
+	"""memory-mapped reader of a columnar directory, reader[i] returns {column: token array} of row i without copy"""
+	def __init__(self, path, columns=None):
+		with open(os.path.join(path, _META_FILE)) as fi:
+			self.meta = json.load(fi)
+		self.path = path
+		self.columns = columns or self.meta['columns']
+		self.row_count = self.meta['row_count']
+		dtype = np.dtype(self.meta['dtype'])
+		self.tokens, self.offsets = {}, {}
+		for col in self.columns:
+			if col not in self.meta['columns']:
+				raise ValueError(f'column {col} is not in {path}, columns = {self.meta["columns"]}')
+			token_file = os.path.join(path, f'{col}.tokens')
+			# np.memmap doesn't support empty files
+			self.tokens[col] = np.memmap(token_file, dtype=dtype, mode='r') if os.path.getsize(token_file) else np.zeros([0], dtype=dtype)
+			self.offsets[col] = np.memmap(os.path.join(path, f'{col}.offsets'), dtype='<i8', mode='r')
+
+	def __len__(self):
+		return self.row_count
+
+	def __getitem__(self, idx):
+		if not -self.row_count <= idx < self.row_count:
+			raise IndexError(f'row {idx} is out of range [0, {self.row_count})')
+		idx %= self.row_count
+		return {col: self.tokens[col][self.offsets[col][idx]:self.offsets[col][idx + 1]] for col in self.columns}
+
+	def get_column(self, col, idx):
+		offsets = self.offsets[col]
+		return self.tokens[col][offsets[idx]:offsets[idx + 1]]
+
+	def get_block(self, col, start, end):
+		"""return (tokens, row_lengths) of rows [start, end) in one column, tokens are a view of the memory-mapped array"""
+		offsets = self.offsets[col][start:end + 1]
+		return self.tokens[col][offsets[0]:offsets[-1]], np.diff(offsets)
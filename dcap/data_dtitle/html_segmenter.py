@@ -0,0 +1,49 @@
+"""Html segmenter for pre-process.
+
+HtmlSegmenter applies the mask_* options and splits html into head and body with the same regexes, in the same order,
+as the chain it replaces (see _segment_html_legacy in process_dtitle_data.py), so the outputs are identical:
+	1. replace <title> with ' ', remove og/meta title, description and site_name tags
+	2. head = ' '.join(re.findall(r'<head\\W.*?</head>', html)), body = html without these heads
+the case-insensitive regexes have no literal prefix for SRE to search on and are tried at every char, so the regexes
+are precompiled, html without '<' is returned as the body, each regex starts at the first '<' instead of the start of html,
+and one scan of the head regex collects both the heads and the body (instead of findall and sub).
+"""
+
+import re
+
+
+class HtmlSegmenter():
+	def __init__(self, mask_html_title=True, mask_title_fields=False, mask_description_fields=False, mask_og_sitename=False):
+		# (regex, replacement) of the masks in the order of the regex chain
+		self._masks = []
+		if mask_html_title:
+			self._masks.append((re.compile(r'<title.*?</title>', flags=re.I), ' '))
+		for enabled, name in [(mask_title_fields, 'title'), (mask_description_fields, 'description'), (mask_og_sitename, 'site_name')]:
+			if enabled:
+				self._masks.append((re.compile(r'<meta[^>]*=["\'](?:og:|og&#x3a;)?{}["\'][^>]*>'.format(name), flags=re.I), ''))
+		self._head_regex = re.compile(r'<head\W.*?</head>', flags=re.I)
+
+	@classmethod
+	def from_flags(cls, FLAGS):
+		return cls(FLAGS.mask_html_title, FLAGS.mask_title_fields, FLAGS.mask_description_fields, FLAGS.mask_og_sitename)
+
+	def segment(self, html):
+		"""return (head, body)"""
+		# every match starts with '<', and the text before the first '<' is never changed by the masks
+		start = html.find('<')
+		if start < 0:
+			return '', html
+		for regex, replacement in self._masks:
+			masked, count = regex.subn(replacement, html[start:])
+			if count:
+				html = html[:start] + masked
+
+		heads, body, pos = [], [], 0
+		for m in self._head_regex.finditer(html, start):
+			heads.append(m.group())
+			body.append(html[pos:m.start()])
+			pos = m.end()
+		if not heads:
+			return '', html
+		body.append(html[pos:])
+		return ' '.join(heads), ''.join(body)
@@ -5,9 +5,13 @@ import re
 import time
 import gzip
 import collections
+import itertools
+import os
+import shutil
 from multiprocessing import Pool
 from functools import partial
 
+import numpy as np
 from absl import app
 from absl import flags
 
@@ -22,30 +26,84 @@ def _normalize_string(s, replace_tab=False):
 	return ret
 
 _tokenizer = None
-def _initialize_tokenizer(vocab_file):
+def _initialize_tokenizer(vocab_file, subword_encoder='trie'):
 	global _tokenizer
-	_tokenizer = tfds.deprecated.text.SubwordTextEncoder.load_from_file(vocab_file)
-	print(f'initilize tokenizer from vocab file [{vocab_file}].')
-
-def dtitle_reader(dtitle_file, input_schema, log_per_n_step=None):
-	column_names = input_schema.split(',')
-	Row = collections.namedtuple('Row', column_names, rename=True)
+	if subword_encoder == 'trie':
+		from subword_encoder import SubwordTrieEncoder
+		_tokenizer = SubwordTrieEncoder.load_from_file(vocab_file)
+	else:
+		_tokenizer = tfds.deprecated.text.SubwordTextEncoder.load_from_file(vocab_file)
+	print(f'initilize {subword_encoder} tokenizer from vocab file [{vocab_file}].', file=sys.stderr)
 
-	lcount = 0
+def _initialize_cached_tokenizer(FLAGS):
+	"""initialize _tokenizer as a CachedEncoder, whose encode() takes the column name as the 2nd arg"""
+	global _tokenizer
+	from subword_encoder import CachedEncoder
+	_initialize_tokenizer(FLAGS.vocab_file, FLAGS.subword_encoder)
+	_tokenizer = CachedEncoder.from_flags(_tokenizer, FLAGS)
 
+def _open_input(dtitle_file):
 	if dtitle_file:
-		is_gz_file = dtitle_file.endswith('.gz')
-		fin = gzip.open(dtitle_file) if is_gz_file else open(dtitle_file, encoding='utf8')
+		return gzip.open(dtitle_file) if dtitle_file.endswith(('.gz', '.bgz')) else open(dtitle_file, encoding='utf8')
 	else:
-		fin = sys.stdin
+		return sys.stdin
+
+_row_types = {}
+def _get_row_type(schema):
+	if schema not in _row_types:
+		_row_types[schema] = collections.namedtuple('Row', schema.split(','), rename=True)
+	return _row_types[schema]
+
+def _parse_row(l, Row):
+	inputs = l.decode('utf8') if isinstance(l, bytes) else l
+	inputs = inputs.split('\t')
+	if len(inputs) != len(Row._fields):
+		print('invalid input, len(inputs)@{}!={}, {}'.format(len(inputs), len(Row._fields), inputs[0][:200]), file=sys.stderr)
+		return None
+	return Row(*[_normalize_string(s, replace_tab=True) for s in inputs])
+
+def _gz_index_file(gz_file):
+	return gz_file + '.idx'
+
+def _bgz_file(gz_file):
+	"""the block gzip copy of gz_file written by index-gz, x.raw.gz => x.raw.bgz"""
+	return gz_file[:-len('.gz')] + '.bgz'
+
+def _load_gz_index(gz_file):
+	"""load the index written by index-gz, an int64 array of (first row, byte offset) of each gzip member + (row count, file size)"""
+	if not gz_file:
+		return None
+	index_file = _gz_index_file(gz_file)
+	if not os.path.isfile(index_file):
+		return None
+	if os.path.getmtime(index_file) < os.path.getmtime(gz_file):
+		print(f'ignore {index_file} which is older than {gz_file}', file=sys.stderr)
+		return None
+	return np.load(index_file)
+
+def _open_input_rows(dtitle_file, start_row=None, end_row=None):
+	"""lines [start_row, end_row) of dtitle_file, the file is read from the gzip member of start_row if it's indexed by index-gz"""
+	if not start_row and end_row is None:
+		return _open_input(dtitle_file)
+	start_row = start_row or 0
+	index = _load_gz_index(dtitle_file)
+	if index is None:
+		return itertools.islice(_open_input(dtitle_file), start_row, end_row)
+	block = max(np.searchsorted(index[:, 0], start_row, side='right') - 1, 0)
+	first_row, offset = index[block]
+	fin = open(dtitle_file, 'rb')
+	fin.seek(offset)
+	return itertools.islice(gzip.GzipFile(fileobj=fin), start_row - first_row, None if end_row is None else end_row - first_row)
+
+def dtitle_reader(dtitle_file, input_schema, log_per_n_step=None, start_row=None, end_row=None):
+	"""read rows of dtitle_file (or stdin), only lines [start_row, end_row) when they're set, see index-gz for random access"""
+	Row = _get_row_type(input_schema)
 
-	for l in fin:
-		inputs = l.decode('utf8') if dtitle_file and is_gz_file else l
-		inputs = inputs.split('\t')
-		if len(inputs) != len(column_names):
-			print('invalid input, len(inputs)@{}!={}, {}'.format(len(inputs), len(column_names), inputs[0][:200]), file=sys.stderr)
+	lcount = 0
+	for l in _open_input_rows(dtitle_file, start_row, end_row):
+		row = _parse_row(l, Row)
+		if row is None:
 			continue
-		row = Row(*[_normalize_string(s, replace_tab=True) for s in inputs])
 		yield row
 		if log_per_n_step:
 			lcount += 1
@@ -54,6 +112,38 @@ def dtitle_reader(dtitle_file, input_schema, log_per_n_step=None):
 	if log_per_n_step:
 		print('read {} examples from {} in total'.format(lcount, dtitle_file), file=sys.stderr)
 
+def _read_line_blocks(dtitle_file, block_size):
+	"""read raw lines from dtitle_file (or stdin) in blocks of block_size lines, parsing is left to the consumer."""
+	fin = _open_input(dtitle_file)
+	while True:
+		block = list(itertools.islice(fin, block_size))
+		if not block:
+			break
+		yield block
+
+
+# flags which change the outputs of a stage, the others (mp_processes, encoder caches, ...) only change the speed.
+# subword_encoder is included, the encoders have the same ids but a stale output must not be reused if they ever differ
+_PREPROCESS_FLAGS = ['input_schema', 'dtitle_schema', 'mask_html_title', 'mask_title_fields', 'mask_description_fields', 'mask_og_sitename',
+	'max_suppress_ratio', 'suppress_notenoughttokens', 'suppress_title_notexactmatch', 'suppress_title_nottokenmatch', 'suppress_title_notsegmentmatch',
+	'title_segmentmatch_schema', 'htmlhead_length_limit', 'htmlbody_token_length_ratio', 'truncate_by_token', 'html_token_limit',
+	'for_inference', 'include_twitter_in_training', 'for_wikipedia', 'subword_encoder']
+_TOKENIZE_FLAGS = ['dtitle_schema', 'use_lower_case', 'html_token_limit', 'head_token_limit', 'default_token_limit', 'subword_encoder']
+_PREPROCESS_CODE = ['process_dtitle_data.py', 'html_segmenter.py', 'subword_encoder.py']
+_TOKENIZE_CODE = ['process_dtitle_data.py', 'subword_encoder.py', 'columnar.py']
+
+def _get_stage_cache(FLAGS):
+	if not FLAGS.stage_cache_dir:
+		return None
+	from stage_cache import StageCache
+	return StageCache(FLAGS.stage_cache_dir)
+
+def _get_flag_values(FLAGS, names):
+	return {name: FLAGS[name].value for name in names}
+
+def _get_code_files(names):
+	return [os.path.join(os.path.dirname(os.path.abspath(__file__)), name) for name in names]
+
 
 def _title_is_tokenmatched(tokens, html):
 	return all(t in html for t in tokens)
@@ -64,136 +154,334 @@ def _title_is_segmentmatched(title, html, row, columns):
 	res = all(any(seg in f for f in matching_fields) for seg in title_segments)
 	return res
 
+def _segment_html_legacy(html, FLAGS):
+	"""the original regex chain of pre-process, kept as the baseline of bench-html-segmenter"""
+	#html = re.sub(r'</html>.*', '</html>', html, flags=re.I)
+	if FLAGS.mask_html_title:
+		html = re.sub(r'<title.*?</title>', ' ', html, flags=re.I)
+	if FLAGS.mask_title_fields:
+		html = re.sub(r'<meta[^>]*=["\'](?:og:|og&#x3a;)?title["\'][^>]*>', '', html, flags=re.I)
+	if FLAGS.mask_description_fields:
+		html = re.sub(r'<meta[^>]*=["\'](?:og:|og&#x3a;)?description["\'][^>]*>', '', html, flags=re.I)
+	if FLAGS.mask_og_sitename:
+		html = re.sub(r'<meta[^>]*=["\'](?:og:|og&#x3a;)?site_name["\'][^>]*>', '', html, flags=re.I)
+
+	head_regex = r'<head\W.*?</head>'
+	htmlhead = ' '.join(re.findall(head_regex, html, flags=re.I))
+	htmlbody = re.sub(head_regex, '', html, flags=re.I)
+	return htmlhead, htmlbody
+
+_html_segmenter = None
+def _get_html_segmenter(FLAGS):
+	global _html_segmenter
+	if _html_segmenter is None:
+		from html_segmenter import HtmlSegmenter
+		_html_segmenter = HtmlSegmenter.from_flags(FLAGS)
+	return _html_segmenter
+
+def _preprocess_row(row, FLAGS, dtitle_schema_columns, fuzzy_match_columns, stats):
+	"""pre-process one raw row, return the output columns or None when the row is dropped.
+	stats counts valid/suppressed examples seen so far, it's updated here and used by max_suppress_ratio.
+	"""
+	url, title, html = row.Url if hasattr(row, 'Url') else row.DocumentUrl, row.AHtmlTitle, row.CleanedHtmlBody if hasattr(row, 'CleanedHtmlBody') else ''
+
+	is_twitter_handle_url = FLAGS.include_twitter_in_training and re.match('^https://twitter.com/[^/]+$', url)
+	if not url: return None
+	if not html and not FLAGS.for_inference and not is_twitter_handle_url: return None
+
+	# using wikipedia data for true casing model
+	if FLAGS.for_wikipedia:
+		tokens = re.split(r'\s+', title)
+		if (
+		len(tokens) <= 1        # filter title/sentence less than 2 tokens
+		or title[:1].islower()  # first char must not be lower case
+		#or title[1:].islower() # contains at least one upper case char since index 1
+		or len(title) >= 256    # ignore long sentence
+		or getattr(row, 'ParaID') == '0' and getattr(row, 'SentID') == '0'
+		or len([t for t in tokens[:7] if t and t[:1].isupper()]) > 4
+		):
+			return None
+
+	# apply html modification (mask) options, then split head and body
+	htmlhead, htmlbody = _get_html_segmenter(FLAGS).segment(html)
+
+	# truncate head and body
+	htmlhead = _normalize_string(htmlhead[:FLAGS.htmlhead_length_limit])
+	htmlbody = _normalize_string(htmlbody[:int(FLAGS.html_token_limit * FLAGS.htmlbody_token_length_ratio)])
+
+	if FLAGS.truncate_by_token:
+		if hasattr(_tokenizer, 'encode_until'):
+			htmlbody = htmlbody[:_tokenizer.encode_until(htmlbody, FLAGS.html_token_limit)[1]]
+		else:
+			htmlbody_tokens = _tokenizer.encode(htmlbody)[:FLAGS.html_token_limit]
+			htmlbody = htmlbody[:len(_tokenizer.decode(htmlbody_tokens))]
+
+	# apply filtering options
+	title_lowered, htmlbody_lowered = (s.lower() for s in [title, htmlbody])
+	title_tokens = [w for w in re.split(r'\s+', title_lowered) if w]
+
+	if not FLAGS.for_inference and not is_twitter_handle_url and (
+		FLAGS.suppress_notenoughttokens and len(title_tokens) <= 1
+		or FLAGS.suppress_title_notexactmatch and title_lowered not in htmlbody_lowered
+		or FLAGS.suppress_title_nottokenmatch and not _title_is_tokenmatched(title_tokens, htmlbody_lowered)
+		or FLAGS.suppress_title_notsegmentmatch and not _title_is_segmentmatched(title_lowered, htmlbody_lowered, row, fuzzy_match_columns)
+		):
+		if FLAGS.max_suppress_ratio * (stats['valid'] + stats['suppressed']) > stats['suppressed']:
+			stats['suppressed'] += 1
+			title = ''
+		else:
+			return None
+
+	# output by the order defined in dtitle_schema
+	res = []
+	for col in dtitle_schema_columns:
+		if col == 'TargetTitle':
+			res.append(title)
+		elif col == 'TargetTitle_lower':
+			res.append(title.lower())
+		elif col == 'HtmlBody':
+			res.append(htmlbody)
+		elif col == 'HtmlHead':
+			res.append(htmlhead)
+		else:
+			res.append(getattr(row, col))
+	stats['valid'] += 1 if title else 0
+	return res
+
+def _print_preprocess_stats(stats, source):
+	total, valid, suppressed = stats['total'], stats['valid'], stats['suppressed']
+	ignored = total - valid - suppressed
+	total = total or 1
+	print(f'processed {stats["total"]} example(s), including {valid} ({valid/total*100:.2f}%) valid, {suppressed} ({suppressed/total*100:.2f}%) suppressed and {ignored} ({ignored/total*100:.2f}%) ignored examples, from {source}', file=sys.stderr)
+
 def preprocess_raw_input(FLAGS):
+	cache = _get_stage_cache(FLAGS)
+	if cache is None or not FLAGS.input_file:
+		_preprocess_raw_input(FLAGS, [sys.stdout])
+		return
+
+	input_files = [FLAGS.input_file] + ([FLAGS.vocab_file + '.subwords'] if FLAGS.truncate_by_token else [])
+	key = cache.key('pre-process', input_files, _get_flag_values(FLAGS, _PREPROCESS_FLAGS), _get_code_files(_PREPROCESS_CODE))
+	cached_file = cache.get('pre-process', key, '.dtitle')
+	if cached_file:
+		with open(cached_file, 'rb') as fi:
+			shutil.copyfileobj(fi, sys.stdout.buffer)
+		print(f'reuse pre-process outputs of {FLAGS.input_file} in {cached_file}', file=sys.stderr)
+		return
+	with cache.put('pre-process', key, '.dtitle') as tmp_file, open(tmp_file, 'w', encoding='utf8') as fo:
+		_preprocess_raw_input(FLAGS, [sys.stdout, fo])
+
+def _preprocess_raw_input(FLAGS, output_files):
 	if FLAGS.truncate_by_token:
-		_initialize_tokenizer(FLAGS.vocab_file)
+		_initialize_tokenizer(FLAGS.vocab_file, FLAGS.subword_encoder)
 	dtitle_schema_columns = FLAGS.dtitle_schema.split(',')
 	fuzzy_match_columns = FLAGS.title_segmentmatch_schema.split(',')
 
-	total, valid, suppressed = 0, 0, 0
+	stats = collections.Counter()
 	for row in dtitle_reader(FLAGS.input_file, FLAGS.input_schema):
-		total += 1
-		url, title, html = row.Url if hasattr(row, 'Url') else row.DocumentUrl, row.AHtmlTitle, row.CleanedHtmlBody if hasattr(row, 'CleanedHtmlBody') else ''
-
-		is_twitter_handle_url = FLAGS.include_twitter_in_training and re.match('^https://twitter.com/[^/]+$', url)
-		if not url: continue
-		if not html and not FLAGS.for_inference and not is_twitter_handle_url: continue;
-
-		# using wikipedia data for true casing model
-		if FLAGS.for_wikipedia:
-			tokens = re.split(r'\s+', title)
-			if (
-			len(tokens) <= 1        # filter title/sentence less than 2 tokens
-			or title[:1].islower()  # first char must not be lower case
-			#or title[1:].islower() # contains at least one upper case char since index 1
-			or len(title) >= 256    # ignore long sentence
-			or getattr(row, 'ParaID') == '0' and getattr(row, 'SentID') == '0'
-			or len([t for t in tokens[:7] if t and t[:1].isupper()]) > 4
-			):
-				continue
-
-		#html = re.sub(r'</html>.*', '</html>', html, flags=re.I)
-
-		# apply html modification (mask) options to modify content
-		if FLAGS.mask_html_title:
-			html = re.sub(r'<title.*?</title>', ' ', html, flags=re.I)
-		if FLAGS.mask_title_fields:
-			html = re.sub(r'<meta[^>]*=["\'](?:og:|og&#x3a;)?title["\'][^>]*>', '', html, flags=re.I)
-		if FLAGS.mask_description_fields:
-			html = re.sub(r'<meta[^>]*=["\'](?:og:|og&#x3a;)?description["\'][^>]*>', '', html, flags=re.I)
-		if FLAGS.mask_og_sitename:
-			html = re.sub(r'<meta[^>]*=["\'](?:og:|og&#x3a;)?site_name["\'][^>]*>', '', html, flags=re.I)
-		if False:
-			m = re.search(r'<meta[^>]*=["\']description["\'][^>]*>', html, flags=re.I)
-			mstring = m.group(0) if m else None
-			print(f'url = {url}\nhtml = {html[:1000]}\ntmstring = {mstring}')
-			if mstring: input("Press Enter to continue...")
-			continue
-
-		# split and truncate head and body
-		head_regex = r'<head\W.*?</head>'
-		htmlhead = ' '.join(re.findall(head_regex, html, flags=re.I))
-		htmlbody = re.sub(head_regex, '', html, flags=re.I)
+		stats['total'] += 1
+		res = _preprocess_row(row, FLAGS, dtitle_schema_columns, fuzzy_match_columns, stats)
+		if res is not None:
+			for fo in output_files:
+				print('\t'.join(res), file=fo)
 
-		htmlhead = _normalize_string(htmlhead[:FLAGS.htmlhead_length_limit])
-		htmlbody = _normalize_string(htmlbody[:int(FLAGS.html_token_limit * FLAGS.htmlbody_token_length_ratio)])
+	_print_preprocess_stats(stats, FLAGS.input_file)
 
-		if FLAGS.truncate_by_token: # 20 times slower when turn this option on
-			htmlbody_tokens = _tokenizer.encode(htmlbody)[:FLAGS.html_token_limit]
-			htmlbody = htmlbody[:len(_tokenizer.decode(htmlbody_tokens))]
 
-		# apply filtering options
-		title_lowered, htmlbody_lowered = (s.lower() for s in [title, htmlbody])
-		title_tokens = [w for w in re.split(r'\s+', title_lowered) if w]
-
-		if not FLAGS.for_inference and not is_twitter_handle_url and (
-			FLAGS.suppress_notenoughttokens and len(title_tokens) <= 1
-			or FLAGS.suppress_title_notexactmatch and title_lowered not in htmlbody_lowered
-			or FLAGS.suppress_title_nottokenmatch and not _title_is_tokenmatched(title_tokens, htmlbody_lowered)
-			or FLAGS.suppress_title_notsegmentmatch and not _title_is_segmentmatched(title_lowered, htmlbody_lowered, row, fuzzy_match_columns)
-			):
-			if FLAGS.max_suppress_ratio * (valid + suppressed) > suppressed:
-				suppressed += 1
-				title = ''
-			else:
-				continue
-
-		# output by the order defined in dtitle_schema
-		res = []
-		for col in dtitle_schema_columns:
-			if col == 'TargetTitle':
-				res.append(title)
-			elif col == 'TargetTitle_lower':
-				res.append(title.lower())
-			elif col == 'HtmlBody':
-				res.append(htmlbody)
-			elif col == 'HtmlHead':
-				res.append(htmlhead)
-			else:
-				res.append(getattr(row, col))
-		print('\t'.join(res))
-		valid += 1 if title else 0
+# stats of the current pre-process-mp worker, each worker applies max_suppress_ratio on its own examples
+_worker_stats = collections.Counter()
+def _preprocess_block(lines):
+	FLAGS = flags.FLAGS
+	Row = _get_row_type(FLAGS.input_schema)
+	dtitle_schema_columns = FLAGS.dtitle_schema.split(',')
+	fuzzy_match_columns = FLAGS.title_segmentmatch_schema.split(',')
 
-	ignored = total - valid - suppressed
-	print(f'processed {total} example(s), including {valid} ({valid/total*100:.2f}%) valid, {suppressed} ({suppressed/total*100:.2f}%) suppressed and {ignored} ({ignored/total*100:.2f}%) ignored examples, from {FLAGS.input_file}', file=sys.stderr)
+	before = _worker_stats.copy()
+	outputs = []
+	for l in lines:
+		row = _parse_row(l, Row)
+		if row is None:
+			continue
+		_worker_stats['total'] += 1
+		res = _preprocess_row(row, FLAGS, dtitle_schema_columns, fuzzy_match_columns, _worker_stats)
+		if res is not None:
+			outputs.append('\t'.join(res) + '\n')
+	return os.getpid(), len(lines), ''.join(outputs), _worker_stats - before
+
+def _preprocess_rows(row_range):
+	"""pre-process rows [start, end) of an input indexed by index-gz, read by the worker itself"""
+	return _preprocess_block(list(_open_input_rows(flags.FLAGS.input_file, *row_range)))
+
+def preprocess_raw_input_mp(FLAGS):
+	"""pre-process one input (gz file or stdin) with a pool of workers, outputs are written in input order.
+	workers read their rows directly when the input is indexed by index-gz"""
+	if FLAGS.truncate_by_token:
+		_initialize_tokenizer(FLAGS.vocab_file, FLAGS.subword_encoder)
 
+	index = _load_gz_index(FLAGS.input_file)
+	if index is None:
+		process_fn, blocks = _preprocess_block, _read_line_blocks(FLAGS.input_file, FLAGS.mp_block_size)
+	else:
+		# workers decompress their own row ranges, the main process only writes outputs
+		row_count = int(index[-1, 0])
+		process_fn, blocks = _preprocess_rows, [(s, min(s + FLAGS.mp_block_size, row_count)) for s in range(0, row_count, FLAGS.mp_block_size)]
+
+	start_time = time.time()
+	line_count, worker_stats = 0, collections.defaultdict(collections.Counter)
+	with Pool(FLAGS.mp_processes) as pool:
+		for idx, (pid, count, outputs, stats) in enumerate(pool.imap(process_fn, blocks)):
+			sys.stdout.write(outputs)
+			line_count += count
+			worker_stats[pid].update(stats)
+			if (idx + 1) % FLAGS.mp_log_per_n_blocks == 0:
+				print(f'read {line_count} lines, {line_count/(time.time() - start_time):.1f} rows/sec, at {time.asctime()}', file=sys.stderr)
+	sys.stdout.flush()
+
+	total_stats = collections.Counter()
+	for pid, stats in sorted(worker_stats.items()):
+		_print_preprocess_stats(stats, f'worker {pid}')
+		total_stats.update(stats)
+	_print_preprocess_stats(total_stats, FLAGS.input_file)
+	print(f'pre-process {line_count} lines with {len(worker_stats)} workers in {int(time.time() - start_time)} seconds, {line_count/(time.time() - start_time):.1f} rows/sec', file=sys.stderr)
+
+
+def _reservoir_sample(items, sample_count, seed):
+	import random
+	rand = random.Random(seed)
+	samples = []
+	for idx, item in enumerate(items):
+		if len(samples) < sample_count:
+			samples.append(item)
+		else:
+			r = rand.randint(0, idx)
+			if r < sample_count:
+				samples[r] = item
+	return samples
+
+def index_gz(FLAGS):
+	"""copy input_file into a block gzip file x.bgz (one gzip member per gz_block_rows lines, which is a valid gzip file
+	with the same content) and write the row index of members to x.bgz.idx for dtitle_reader(start_row, end_row).
+	input_file is not changed, so its md5 (all-data.md5) and the make rules depending on it stay valid"""
+	assert FLAGS.input_file and FLAGS.input_file.endswith('.gz'), 'index-gz needs a .gz input_file'
+	bgz_file = _bgz_file(FLAGS.input_file)
+	tmp_file = bgz_file + '.tmp'
+	start_time = time.time()
+	index, row_count = [], 0
+	with open(tmp_file, 'wb') as fo, _open_input(FLAGS.input_file) as fin:
+		while True:
+			lines = list(itertools.islice(fin, FLAGS.gz_block_rows))
+			if not lines:
+				break
+			index.append((row_count, fo.tell()))
+			fo.write(gzip.compress(b''.join(lines), compresslevel=FLAGS.gz_compress_level))
+			row_count += len(lines)
+		index.append((row_count, fo.tell()))
+	os.replace(tmp_file, bgz_file)
+	with open(_gz_index_file(bgz_file), 'wb') as fo:
+		np.save(fo, np.array(index, dtype=np.int64))
+	print(f'index {row_count} rows of {FLAGS.input_file} in {len(index) - 1} gzip members of {bgz_file}, in {time.time() - start_time:.1f} seconds', file=sys.stderr)
+
+
+def bench_html_segmenter(FLAGS):
+	"""compare HtmlSegmenter with the original regex chain on sampled rows of one .raw.gz shard"""
+	htmls = (row.CleanedHtmlBody if hasattr(row, 'CleanedHtmlBody') else '' for row in dtitle_reader(FLAGS.input_file, FLAGS.input_schema))
+	htmls = _reservoir_sample((html for html in htmls if html), FLAGS.bench_sample_count, FLAGS.bench_seed)
+	print(f'sampled {len(htmls)} html from {FLAGS.input_file}, {sum(len(h) for h in htmls)/max(len(htmls), 1)/1024:.1f}KB in average')
+
+	start_time = time.time()
+	legacy_outputs = [_segment_html_legacy(html, FLAGS) for html in htmls]
+	legacy_time = time.time() - start_time
+
+	segmenter = _get_html_segmenter(FLAGS)
+	start_time = time.time()
+	outputs = [segmenter.segment(html) for html in htmls]
+	segmenter_time = time.time() - start_time
+
+	mismatched = sum(a != b for a, b in zip(legacy_outputs, outputs))
+	print(f'regex chain: {legacy_time:.3f} seconds, {len(htmls)/legacy_time:.1f} rows/sec')
+	print(f'HtmlSegmenter: {segmenter_time:.3f} seconds, {len(htmls)/segmenter_time:.1f} rows/sec, {legacy_time/segmenter_time:.2f}x')
+	print(f'{mismatched} of {len(htmls)} outputs mismatched')
+
+
+def check_encoder(FLAGS):
+	"""check SubwordTrieEncoder and TFSubwordEncoder (in one batch) against tfds SubwordTextEncoder on sampled rows (ids and decoded texts),
+	and compare their throughput"""
+	from subword_encoder import SubwordTrieEncoder
+	from tf_subword_encoder import TFSubwordEncoder
+	tfds_encoder = tfds.deprecated.text.SubwordTextEncoder.load_from_file(FLAGS.vocab_file)
+	trie_encoder = SubwordTrieEncoder.load_from_file(FLAGS.vocab_file)
+	assert tfds_encoder.vocab_size == trie_encoder.vocab_size, f'vocab size mismatched: {tfds_encoder.vocab_size} vs {trie_encoder.vocab_size}'
+
+	schema = FLAGS.dtitle_schema if FLAGS.input_file and '.dtitle' in FLAGS.input_file else FLAGS.input_schema
+	rows = _reservoir_sample(dtitle_reader(FLAGS.input_file, schema), FLAGS.bench_sample_count, FLAGS.bench_seed)
+	texts = [text.lower() if FLAGS.use_lower_case else text for row in rows for text in row]
+	# escaping and byte-fallback cases which are rare in sampled rows
+	texts += ['', ' ', '  ', '_', '__ _', 'a_b c_', '\\&undsc', 'a\\&undsc b', '\\&undsc x', '_\\&undsc_ ', 'x  y\t\n', '\u4e2d\u6587 \U0001f600 \u00e9t\u00e9']
+	texts += [w + ' ' + w for w in tfds_encoder.subwords[::max(len(tfds_encoder.subwords) // 1000, 1)]]
+	print(f'sampled {len(rows)} rows from {FLAGS.input_file}, check {len(texts)} texts, {sum(len(t) for t in texts)/max(len(texts), 1):.1f} chars in average')
+
+	tf_encode = tf.function(TFSubwordEncoder(trie_encoder).encode)
+	tf_encode(tf.constant(texts[:1]))
+	outputs = {}
+	for name, encode_fn in [('tfds', tfds_encoder.encode), ('trie', trie_encoder.encode), ('tf', None)]:
+		start_time = time.time()
+		if encode_fn is None:
+			outputs[name] = tf_encode(tf.constant(texts)).to_list()
+		else:
+			outputs[name] = [encode_fn(text) for text in texts]
+		encode_time = time.time() - start_time
+		print(f'{name} encoder: {encode_time:.3f} seconds, {len(texts)/encode_time:.1f} texts/sec, {sum(len(t) for t in texts)/encode_time/2**20:.2f}MB/sec')
+
+	mismatched = 0
+	for text, tfds_ids, trie_ids, tf_ids in zip(texts, outputs['tfds'], outputs['trie'], outputs['tf']):
+		if tfds_ids != trie_ids or tfds_ids != tf_ids or tfds_encoder.decode(tfds_ids) != trie_encoder.decode(tfds_ids):
+			mismatched += 1
+			if mismatched <= 10:
+				print(f'mismatched: {repr(text)}\n\ttfds: {tfds_ids}\n\ttrie: {trie_ids}\n\ttf:   {tf_ids}')
+	print(f'{mismatched} of {len(texts)} texts mismatched')
+	if mismatched:
+		sys.exit(1)
+
+
+_VOCAB_RESERVED_TOKENS = ['<EOS>'] + [f'<BOS#{i}>' for i in range(10)] + [f'<EOS#{i}>' for i in range(10)]
+
+def _get_vocab_column_limits(FLAGS):
+	columns = [col.split(':') for col in FLAGS.vocab_corpus_columns.split(',')]
+	return [(col[0], int(col[1]) if len(col) > 1 else 128) for col in columns]
+
+def _iter_vocab_corpus(rows, column_with_limits, use_lower_case):
+	for row in rows:
+		for col in column_with_limits:
+			text = getattr(row, col[0])[:col[1]]
+			if text:
+				if use_lower_case: text = text.lower()
+				yield text
 
 def build_vocab(FLAGS):
 	def _get_vocab_corpus():
 		import glob
-		columns = [col.split(':') for col in FLAGS.vocab_corpus_columns.split(',')]
-		column_with_limits = [(col[0], int(col[1]) if len(col) > 1 else 128) for col in columns]
+		column_with_limits = _get_vocab_column_limits(FLAGS)
 
 		quota = int(FLAGS.max_corpus_chars*(2**30))
 		if FLAGS.input_file:
 			for fp in sorted(glob.glob(FLAGS.input_file)):
 				print(f'read from {fp} with quota={quota//(1024*1024)}MB, at {time.asctime()}')
-				for row in dtitle_reader(str(fp), FLAGS.input_schema, 100*1024):
-					for col in column_with_limits:
-						text = getattr(row, col[0])[:col[1]]
-						if text:
-							#print(f'col={col}, len={len(text)}, text={text[:100]}')
-							if FLAGS.use_lower_case: text = text.lower()
-							btext = text.encode()
-							yield btext
-							quota -= len(btext)
-							if quota < 0:
-								print(f'reach limit and stop.')
-								return
+				for text in _iter_vocab_corpus(dtitle_reader(str(fp), FLAGS.input_schema, 100*1024), column_with_limits, FLAGS.use_lower_case):
+					btext = text.encode()
+					yield btext
+					quota -= len(btext)
+					if quota < 0:
+						print(f'reach limit and stop.')
+						return
 		else:
 			print(f'read from stdin with quota={quota//(1024*1024)}MB, starts at {time.asctime()}')
-			for row in dtitle_reader(None, FLAGS.input_schema, 100*1024):
-				for col in column_with_limits:
-					text = getattr(row, col[0])[:col[1]]
-					if text:
-						#print(f'col={col}, len={len(text)}, text={text[:100]}')
-						if FLAGS.use_lower_case: text = text.lower()
-						btext = text.encode()
-						yield btext
-						quota -= len(btext)
-						if quota < 0:
-							print(f'reach limit and stop.')
-							return
+			for text in _iter_vocab_corpus(dtitle_reader(None, FLAGS.input_schema, 100*1024), column_with_limits, FLAGS.use_lower_case):
+				btext = text.encode()
+				yield btext
+				quota -= len(btext)
+				if quota < 0:
+					print(f'reach limit and stop.')
+					return
 
 	target_vocab_file = FLAGS.vocab_file
 	print('{}: start to build a subwords tokenizer({}) with max_subword_length={}, max_corpus_chars={}GB and target_vocab_size={}.'.format(time.asctime(), target_vocab_file, FLAGS.max_subword_length, FLAGS.max_corpus_chars, FLAGS.target_vocab_size))
@@ -202,14 +490,85 @@ def build_vocab(FLAGS):
 			target_vocab_size = FLAGS.target_vocab_size,
 			max_subword_length = FLAGS.max_subword_length,
 			max_corpus_chars = int(FLAGS.max_corpus_chars*(2**30)),
-			reserved_tokens = ['<EOS>'] + [f'<BOS#{i}>' for i in range(10)] + [f'<EOS#{i}>' for i in range(10)])
+			reserved_tokens = _VOCAB_RESERVED_TOKENS)
 	tokenizer.save_to_file(target_vocab_file)
 	_save_FLAGS_and_code(FLAGS, target_vocab_file + '.log')
 	print('{}: the subwords tokenizer({}) is ready.'.format(time.asctime(), target_vocab_file))
 
 
+# build-vocab-mp splits SubwordTextEncoder.build_from_corpus into token counting and subword induction, both are private
+# helpers of tensorflow_datasets, pinned to tensorflow_datasets 4.x (tested with 4.9.10), re-check them on a tfds upgrade
+def _tfds_token_counts(texts, max_chars):
+	from tensorflow_datasets.core.deprecated.text import subword_text_encoder
+	return subword_text_encoder._token_counts_from_generator(texts, max_chars, _VOCAB_RESERVED_TOKENS)
+
+def _tfds_build_from_token_counts(token_counts, min_token_count, max_subword_length):
+	return tfds.deprecated.text.SubwordTextEncoder._build_from_token_counts(token_counts=token_counts, min_token_count=min_token_count,
+			reserved_tokens=_VOCAB_RESERVED_TOKENS, num_iterations=4, max_subword_length=max_subword_length)
+
+def _count_vocab_tokens(fp, max_chars):
+	"""count tokens (prepared for encode, like build_from_corpus) of one shard, reservoir-sample rows when vocab_sample_rows is set"""
+	FLAGS = flags.FLAGS
+	start_time = time.time()
+	rows = dtitle_reader(fp, FLAGS.input_schema)
+	if FLAGS.vocab_sample_rows:
+		rows = _reservoir_sample(rows, FLAGS.vocab_sample_rows, f'{FLAGS.bench_seed}:{fp}')
+	chars = 0
+	def _count_chars(texts):
+		nonlocal chars
+		for text in texts:
+			chars += len(text)
+			yield text
+	token_counts = _tfds_token_counts(_count_chars(_iter_vocab_corpus(rows, _get_vocab_column_limits(FLAGS), FLAGS.use_lower_case)), max_chars)
+	chars = min(chars, max_chars)
+	return fp, chars, collections.Counter(token_counts), time.time() - start_time
+
+def build_vocab_mp(FLAGS):
+	"""build vocab from shards (input_file is a glob): count tokens of each shard in parallel, merge the counts, then
+	run the subword induction of SubwordTextEncoder.build_from_corpus (a binary search of min_token_count) on them"""
+	import glob
+	assert FLAGS.input_file, 'build-vocab-mp needs input_file (a glob of shards)'
+	files = sorted(glob.glob(FLAGS.input_file))
+	assert files, f'no file matches {FLAGS.input_file}'
+	target_vocab_file = FLAGS.vocab_file
+	# max_corpus_chars is shared by shards evenly
+	max_chars = int(FLAGS.max_corpus_chars*(2**30)) // len(files)
+	print(f'{time.asctime()}: start to build a subwords tokenizer({target_vocab_file}) from {len(files)} shards with quota={max_chars//(1024*1024)}MB per shard, max_subword_length={FLAGS.max_subword_length} and target_vocab_size={FLAGS.target_vocab_size}.')
+
+	token_counts = collections.Counter()
+	with Pool(FLAGS.mp_processes) as pool:
+		for fp, chars, counts, seconds in pool.imap_unordered(partial(_count_vocab_tokens, max_chars=max_chars), files):
+			token_counts.update(counts)
+			print(f'counted {len(counts)} tokens from {chars//(1024*1024)}MB text of {fp} in {seconds:.1f} seconds, {len(token_counts)} tokens in total, at {time.asctime()}')
+	if FLAGS.vocab_min_word_count > 1:
+		token_counts = collections.Counter({t: c for t, c in token_counts.items() if c >= FLAGS.vocab_min_word_count})
+		print(f'keep {len(token_counts)} tokens seen at least {FLAGS.vocab_min_word_count} times')
+	assert token_counts, f'no token is counted from {FLAGS.input_file} (vocab_corpus_columns={FLAGS.vocab_corpus_columns}, vocab_min_word_count={FLAGS.vocab_min_word_count})'
+
+	# the same search as SubwordTextEncoder.build_from_corpus
+	def _binary_search(min_token_count, max_token_count):
+		candidate_min = (min_token_count + max_token_count) // 2
+		encoder = _tfds_build_from_token_counts(token_counts, candidate_min, FLAGS.max_subword_length)
+		vocab_size = encoder.vocab_size
+		print(f'{time.asctime()}: min_token_count={candidate_min} gets vocab_size={vocab_size}')
+		# being within 1% of the target vocab size is ok
+		if abs(vocab_size - FLAGS.target_vocab_size) * 100 < FLAGS.target_vocab_size or min_token_count >= max_token_count or candidate_min <= 1:
+			return encoder
+		if vocab_size > FLAGS.target_vocab_size:
+			next_encoder = _binary_search(candidate_min + 1, max_token_count)
+		else:
+			next_encoder = _binary_search(min_token_count, candidate_min - 1)
+		# return the one that's closest to the target_vocab_size
+		return encoder if abs(vocab_size - FLAGS.target_vocab_size) < abs(next_encoder.vocab_size - FLAGS.target_vocab_size) else next_encoder
+	tokenizer = _binary_search(max(min(token_counts.values()), 1), max(token_counts.values()))
+
+	tokenizer.save_to_file(target_vocab_file)
+	_save_FLAGS_and_code(FLAGS, target_vocab_file + '.log')
+	print(f'{time.asctime()}: the subwords tokenizer({target_vocab_file}) is ready, vocab_size={tokenizer.vocab_size}.')
+
+
 def tokenize_dtitle(FLAGS):
-	_initialize_tokenizer(FLAGS.vocab_file)
+	_initialize_tokenizer(FLAGS.vocab_file, FLAGS.subword_encoder)
 
 	assert FLAGS.input_file.endswith('.dtitle.gz')
 	tfrecord_file = FLAGS.input_file[:-10] + '.tokenized-tfrecord'
@@ -261,7 +620,7 @@ def _create_example(row):
 
 
 def tokenize_dtitle_mp(FLAGS):
-	_initialize_tokenizer(FLAGS.vocab_file)
+	_initialize_tokenizer(FLAGS.vocab_file, FLAGS.subword_encoder)
 
 	assert FLAGS.input_file.endswith('.dtitle.gz')
 	tfrecord_file = FLAGS.input_file[:-10] + '.tokenized-tfrecord'
@@ -276,23 +635,7 @@ def tokenize_dtitle_mp(FLAGS):
 	print(f'complete tokenization of {FLAGS.input_file}, token limit = {FLAGS.html_token_limit}. write {count} records to {tfrecord_file}.')
 
 
-def _create_example_v2(row, col_names_and_limits, to_lower):
-	def _create_int64List_feature(text, limit):
-		if to_lower: text = text.lower()
-		arr = _tokenizer.encode(text)
-		if limit: arr = arr[:limit]
-		return tf.train.Feature(int64_list=tf.train.Int64List(value=arr))
-
-	example = {col: _create_int64List_feature(text, limit) for (col, limit), text in zip(col_names_and_limits, row)}
-	return tf.train.Example(features=tf.train.Features(feature=example)).SerializeToString()
-
-
-def tokenize_dtitle_v2(FLAGS):
-	_initialize_tokenizer(FLAGS.vocab_file)
-
-	assert FLAGS.input_file.endswith('.dtitle.gz')
-	tfrecord_file = FLAGS.input_file[:-10] + '.dtitle.tokenized.gz'
-
+def _get_column_limits(FLAGS):
 	def _get_column_limit(col):
 		if col == 'HtmlHead':
 			return FLAGS.head_token_limit or 1024000
@@ -300,15 +643,117 @@ def tokenize_dtitle_v2(FLAGS):
 			return FLAGS.html_token_limit or 1024000
 		else:
 			return FLAGS.default_token_limit
-	col_names_and_limits = [(col, _get_column_limit(col)) for idx, col in enumerate(FLAGS.dtitle_schema.split(','))]
-	_create_example_v2_wrapper = partial(_create_example_v2, col_names_and_limits=col_names_and_limits, to_lower=FLAGS.use_lower_case)
+	return [_get_column_limit(col) for col in FLAGS.dtitle_schema.split(',')]
+
+def _tokenize_block(lines, col_limits, to_lower, col_indices=None):
+	"""tokenize one block of .dtitle lines, returns token ids packed as int32 arrays:
+	lengths[row_count, col_count] and ids (all ids in row-major order), and the encoder cache stats of this block.
+	only columns in col_indices are tokenized when it's set"""
+	Row = _get_row_type(flags.FLAGS.dtitle_schema)
+	col_indices = range(len(col_limits)) if col_indices is None else col_indices
+	before = _tokenizer.stats()
+	lengths, ids = [], []
+	for l in lines:
+		row = _parse_row(l, Row)
+		if row is None:
+			continue
+		for c in col_indices:
+			text, limit = row[c], col_limits[c]
+			if to_lower: text = text.lower()
+			arr = _tokenizer.encode(text, Row._fields[c])
+			if limit: arr = arr[:limit]
+			lengths.append(len(arr))
+			ids.extend(arr)
+	return np.array(lengths, dtype=np.int32).reshape(-1, len(col_indices)), np.array(ids, dtype=np.int32), _tokenizer.stats() - before
+
+def _packed_block_to_examples(col_names, lengths, ids):
+	"""build serialized tf.train.Example protos from the outputs of _tokenize_block"""
+	ids = ids.tolist()
+	offsets = [0] + np.cumsum(lengths, axis=None).tolist()
+	col_count = len(col_names)
+	for r in range(lengths.shape[0]):
+		o = offsets[r * col_count:(r + 1) * col_count + 1]
+		example = {col: tf.train.Feature(int64_list=tf.train.Int64List(value=ids[o[i]:o[i + 1]])) for i, col in enumerate(col_names)}
+		yield tf.train.Example(features=tf.train.Features(feature=example)).SerializeToString()
 
-	count = 0
-	with tf.io.TFRecordWriter(tfrecord_file, 'GZIP') as tfwriter, Pool() as pool:
-		for proto in pool.imap(_create_example_v2_wrapper, (tuple(row) for row in dtitle_reader(FLAGS.input_file, FLAGS.dtitle_schema))):
-			tfwriter.write(proto)
-			count += 1
-	print(f'complete tokenization of {FLAGS.input_file}, token limit = {FLAGS.html_token_limit}. write {count} records to {tfrecord_file}.')
+
+def tokenize_dtitle_v2(FLAGS):
+	"""tokenize one .dtitle.gz file, workers tokenize blocks of raw lines and return packed token ids,
+	which are written as tf.train.Example protos (.dtitle.tokenized.gz) or in the columnar format (.dtitle.columnar).
+	with stage_cache_dir, tfrecord outputs are cached as a whole and columnar outputs are cached by column,
+	so changing the token limit of one column only re-tokenizes that column"""
+	_initialize_cached_tokenizer(FLAGS)
+
+	assert FLAGS.input_file.endswith('.dtitle.gz')
+	col_names = FLAGS.dtitle_schema.split(',')
+	cache = _get_stage_cache(FLAGS)
+	start_time = time.time()
+	if FLAGS.tokenized_format == 'columnar':
+		output_file = FLAGS.input_file[:-10] + '.dtitle.columnar'
+		if cache:
+			count, token_count = _tokenize_columns_with_cache(FLAGS, cache, col_names, output_file)
+		else:
+			from columnar import ColumnarWriter
+			with ColumnarWriter(output_file, col_names, _tokenizer.vocab_size) as writer:
+				count, token_count = _tokenize_blocks(FLAGS, writer.write_block)
+	else:
+		output_file = FLAGS.input_file[:-10] + '.dtitle.tokenized.gz'
+		if cache:
+			key = cache.key('tokenize-dtitle', [FLAGS.input_file, FLAGS.vocab_file + '.subwords'], _get_flag_values(FLAGS, _TOKENIZE_FLAGS), _get_code_files(_TOKENIZE_CODE))
+			cached_file = cache.get('tokenize-dtitle', key, '.tokenized.gz')
+			if cached_file:
+				shutil.copyfile(cached_file, output_file)
+				print(f'reuse tokenized records of {FLAGS.input_file} in {cached_file}, write to {output_file}.')
+				return
+		with tf.io.TFRecordWriter(output_file, 'GZIP') as writer:
+			def write_block(lengths, ids):
+				for proto in _packed_block_to_examples(col_names, lengths, ids):
+					writer.write(proto)
+			count, token_count = _tokenize_blocks(FLAGS, write_block)
+		if cache:
+			cache.add_file('tokenize-dtitle', key, output_file, '.tokenized.gz')
+	print(f'complete tokenization of {FLAGS.input_file}, token limit = {FLAGS.html_token_limit}. write {count} records ({token_count} tokens) to {output_file} in {time.time() - start_time:.1f} seconds.')
+
+def _tokenize_blocks(FLAGS, write_block, col_indices=None):
+	"""tokenize input_file with a pool of workers and write packed blocks in input order, returns (row count, token count)"""
+	_tokenize_block_wrapper = partial(_tokenize_block, col_limits=_get_column_limits(FLAGS), to_lower=FLAGS.use_lower_case, col_indices=col_indices)
+
+	start_time = time.time()
+	count, token_count, cache_stats = 0, 0, collections.Counter()
+	with Pool(FLAGS.mp_processes) as pool:
+		for lengths, ids, stats in pool.imap(_tokenize_block_wrapper, _read_line_blocks(FLAGS.input_file, FLAGS.tokenize_block_size)):
+			write_block(lengths, ids)
+			count += lengths.shape[0]
+			token_count += ids.size
+			cache_stats.update(stats)
+	if cache_stats:
+		print('encoder cache stats:\n' + _tokenizer.format_stats(cache_stats))
+	print(f'tokenize {count} rows of {FLAGS.input_file} in {time.time() - start_time:.1f} seconds, {count/(time.time() - start_time):.1f} rows/sec.')
+	return count, token_count
+
+def _tokenize_columns_with_cache(FLAGS, cache, col_names, output_file):
+	"""tokenize the columns missing in the stage cache, and build the columnar output from cached columns.
+	a column is keyed by the input, the vocab, the column (and its position in dtitle_schema), its token limit and use_lower_case"""
+	from columnar import ColumnarWriter, write_columns
+	input_files = [FLAGS.input_file, FLAGS.vocab_file + '.subwords']
+	code_files = _get_code_files(_TOKENIZE_CODE)
+	keys = [cache.key('tokenize-column', input_files, {'dtitle_schema': FLAGS.dtitle_schema, 'column': col, 'token_limit': limit, 'use_lower_case': FLAGS.use_lower_case,
+		'subword_encoder': FLAGS.subword_encoder}, code_files)
+		for col, limit in zip(col_names, _get_column_limits(FLAGS))]
+	missing = [c for c, key in enumerate(keys) if not cache.get('tokenize-column', key, '.offsets')]
+	print(cache.format_stats())
+	if missing:
+		print(f'tokenize column(s) {",".join(col_names[c] for c in missing)} missing in {cache.cache_dir}')
+		tmp_dir = output_file + '.tmp'
+		with ColumnarWriter(tmp_dir, [col_names[c] for c in missing], _tokenizer.vocab_size) as writer:
+			_tokenize_blocks(FLAGS, writer.write_block, col_indices=missing)
+		for c in missing:
+			# .offsets is added last, an entry is complete when it exists
+			cache.add_file('tokenize-column', keys[c], os.path.join(tmp_dir, f'{col_names[c]}.tokens'), '.tokens')
+			cache.add_file('tokenize-column', keys[c], os.path.join(tmp_dir, f'{col_names[c]}.offsets'), '.offsets')
+		shutil.rmtree(tmp_dir)
+	column_files = {col: (cache.path('tokenize-column', key, '.tokens'), cache.path('tokenize-column', key, '.offsets')) for col, key in zip(col_names, keys)}
+	return write_columns(output_file, column_files, _tokenizer.vocab_size)
 
 
 def print_flags(FLAGS, file=None):
@@ -317,18 +762,96 @@ def print_flags(FLAGS, file=None):
 		print('    {}: {}'.format(f.name, f.value), file=file)
 
 
+_STATS_CHUNK_SIZE = 1 << 24
+
+def _add_counts(total, counts):
+	"""add a np.bincount output into total, which grows when counts is longer"""
+	if len(counts) > len(total):
+		total = np.pad(total, (0, len(counts) - len(total)))
+	total[:len(counts)] += counts
+	return total
+
+def _columnar_shard_stats(path):
+	"""(length histogram, token frequencies) of each column of one .dtitle.columnar shard, bincounts of memory-mapped arrays"""
+	from columnar import ColumnarReader
+	reader = ColumnarReader(path)
+	stats = {}
+	for col in reader.columns:
+		tokens, freq = reader.tokens[col], np.zeros([0], dtype=np.int64)
+		for start in range(0, len(tokens), _STATS_CHUNK_SIZE):
+			freq = _add_counts(freq, np.bincount(tokens[start:start + _STATS_CHUNK_SIZE]))
+		stats[col] = (np.bincount(np.diff(reader.offsets[col])), freq)
+	return stats
+
+def _tokenized_shards_stats(files, col_names, block_size):
+	"""the same as _columnar_shard_stats for .dtitle.tokenized(.gz) shards, which are read and parsed in parallel by tf.data"""
+	description = {col: tf.io.RaggedFeature(tf.int64, row_splits_dtype=tf.int64) for col in col_names}
+	def _parse_block(protos):
+		ex = tf.io.parse_example(protos, description)
+		return {col: (ex[col].row_lengths(), ex[col].flat_values) for col in col_names}
+
+	ds = tf.data.Dataset.from_tensor_slices(files)
+	ds = ds.interleave(lambda f: tf.data.TFRecordDataset(f, compression_type='GZIP' if files[0].endswith('.gz') else None),
+		cycle_length=len(files), num_parallel_calls=tf.data.experimental.AUTOTUNE, deterministic=False)
+	ds = ds.batch(block_size).map(_parse_block, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+	for block in ds:
+		yield {col: (np.bincount(lengths.numpy()), np.bincount(ids.numpy())) for col, (lengths, ids) in block.items()}
+
+def _truncated_ratio(length_hist, limit):
+	"""the ratio of rows longer than limit-2 tokens, which are truncated by Col:limit, every non-empty row when limit < 2"""
+	rows = length_hist.sum()
+	kept = length_hist[:max(limit - 2, 0) + 1].sum()
+	return 1 - kept / max(rows, 1)
+
 def check_stats(FLAGS):
-	import numpy as np
-	length_data, token_data = [], []
-	for row in dtitle_reader(FLAGS.input_file, FLAGS.dtitle_schema):
-		l = len(row.html)
-		length_data.append(l)
-	print('Stats of raw html length:')
-	print('Start\tFreq')
-	hist, bin_edges = np.histogram(length_data, 100)
-	for i in range(100):
-		print('%d\t%d' % (bin_edges[i], hist[i]))
-	print('%d\t-' % bin_edges[100])
+	"""statistics of each column of tokenized shards (input_file is a glob or a comma separated list of .dtitle.tokenized.gz
+	or .dtitle.columnar), to choose the limits of training_schema, e.g. Url:128:
+		length percentiles, the empty ratio and the truncation rates at stats_limits (rows longer than limit-2, which is truncated by Col:limit)
+		the ratio of byte-encoded (OOV) tokens when vocab_file is set, and token frequencies written to stats_token_freq_file"""
+	import glob
+	files = sorted(set(f for pattern in FLAGS.input_file.split(',') for f in glob.glob(pattern)))
+	assert files, f'no file matches {FLAGS.input_file}'
+	start_time = time.time()
+	totals = {}
+	def _add_stats(stats):
+		for col, (length_hist, freq) in stats.items():
+			total = totals.setdefault(col, [np.zeros([0], dtype=np.int64), np.zeros([0], dtype=np.int64)])
+			total[0], total[1] = _add_counts(total[0], length_hist), _add_counts(total[1], freq)
+
+	if all(f.rstrip('/').endswith('.dtitle.columnar') for f in files):
+		with Pool(FLAGS.mp_processes) as pool:
+			for stats in pool.imap_unordered(_columnar_shard_stats, files):
+				_add_stats(stats)
+	elif all('.dtitle.tokenized' in f for f in files):
+		for stats in _tokenized_shards_stats(files, FLAGS.dtitle_schema.split(','), FLAGS.stats_block_size):
+			_add_stats(stats)
+	else:
+		raise ValueError(f'check-stats needs .dtitle.tokenized(.gz) or .dtitle.columnar shards: {files}')
+
+	byte_offset = None
+	if FLAGS.vocab_file:
+		from subword_encoder import SubwordTrieEncoder
+		byte_offset = len(SubwordTrieEncoder.load_from_file(FLAGS.vocab_file).subwords) + 1
+	limits = [int(l) for l in FLAGS.stats_limits.split(',')]
+	percentiles = [50, 90, 95, 99, 100]
+	print(f'stats of {len(files)} shard(s) in {time.time() - start_time:.1f} seconds')
+	print('\t'.join(['column', 'rows', 'empty', 'mean'] + [f'p{p}' for p in percentiles] + [f'trunc@{l}' for l in limits] + ['oov']))
+	for col, (length_hist, freq) in totals.items():
+		rows = int(length_hist.sum())
+		cum = np.cumsum(length_hist)
+		mean = (length_hist * np.arange(len(length_hist))).sum() / max(rows, 1)
+		values = [col, str(rows), f'{length_hist[0] / max(rows, 1):.2%}', f'{mean:.1f}']
+		values += [str(int(np.searchsorted(cum, p / 100 * rows))) for p in percentiles]
+		values += [f'{_truncated_ratio(length_hist, l):.2%}' for l in limits]
+		values.append(f'{freq[byte_offset:byte_offset + 256].sum() / max(freq.sum(), 1):.2%}' if byte_offset else '-')
+		print('\t'.join(values))
+
+	if FLAGS.stats_token_freq_file:
+		with open(FLAGS.stats_token_freq_file, 'w') as fo:
+			for col, (_, freq) in totals.items():
+				for token_id in np.flatnonzero(freq):
+					fo.write(f'{col}\t{token_id}\t{freq[token_id]}\n')
+		print(f'write token frequencies to {FLAGS.stats_token_freq_file}')
 
 
 def _save_FLAGS_and_code(FLAGS, filename):
@@ -344,14 +867,24 @@ def main(_):
 	FLAGS = flags.FLAGS
 	if FLAGS.cmd == 'pre-process':
 		preprocess_raw_input(FLAGS)
+	elif FLAGS.cmd == 'pre-process-mp':
+		preprocess_raw_input_mp(FLAGS)
 	elif FLAGS.cmd == 'build-vocab':
 		build_vocab(FLAGS)
+	elif FLAGS.cmd == 'build-vocab-mp':
+		build_vocab_mp(FLAGS)
 	elif FLAGS.cmd == 'tokenize-dtitle':
 		tokenize_dtitle(FLAGS)
 	elif FLAGS.cmd == 'tokenize-dtitle-mp':
 		tokenize_dtitle_mp(FLAGS)
 	elif FLAGS.cmd == 'tokenize-dtitle-v2':
 		tokenize_dtitle_v2(FLAGS)
+	elif FLAGS.cmd == 'bench-html-segmenter':
+		bench_html_segmenter(FLAGS)
+	elif FLAGS.cmd == 'check-encoder':
+		check_encoder(FLAGS)
+	elif FLAGS.cmd == 'index-gz':
+		index_gz(FLAGS)
 	elif FLAGS.cmd == 'check-stats':
 		check_stats(FLAGS)
 	elif FLAGS.cmd == 'print-flags':
@@ -359,12 +892,19 @@ def main(_):
 
 
 if __name__ == '__main__':
-	flags.DEFINE_enum('cmd', None, ['pre-process', 'build-vocab', 'check-stats', 'print-flags', 'tokenize-dtitle', 'tokenize-dtitle-mp', 'tokenize-dtitle-v2'], 'the command to execute')
+	flags.DEFINE_enum('cmd', None, ['pre-process', 'pre-process-mp', 'build-vocab', 'build-vocab-mp', 'check-stats', 'bench-html-segmenter', 'check-encoder', 'index-gz', 'print-flags', 'tokenize-dtitle', 'tokenize-dtitle-mp', 'tokenize-dtitle-v2'], 'the command to execute')
 	flags.mark_flag_as_required('cmd')
 	flags.DEFINE_string('input_file', None, 'input dtitle file name for pre-process and build-vocab, will read from sys.stdin when omitted.')
 	# params for dtitle_reader
 	flags.DEFINE_string('input_schema', 'Url,DocumentUrl,Language,LanguageAnchor,DocumentType,AHtmlTitle,AMetaDesc,AOGTitle,AOGDesc,InjHdr_CDG_H,InjHdr_CDG_E,Wiki_Name,ODPTitle,CaptionAnchorText,CleanedHtmlBody,RandomValue', 'input file schema, used fields: url,title,hostname,html')
 	flags.DEFINE_string('dtitle_schema', 'Url,DocumentUrl,Language,LanguageAnchor,DocumentType,AHtmlTitle,AMetaDesc,AOGTitle,AOGDesc,InjHdr_CDG_H,InjHdr_CDG_E,Wiki_Name,ODPTitle,CaptionAnchorText,TargetTitle', 'input file schema, used fields: url,title,hostname,html')
+	# params for check-stats
+	flags.DEFINE_string('stats_limits', '8,16,32,64,128,256,512,1024', 'candidate column limits (Col:limit of training_schema) of check-stats, whose truncation rates are reported')
+	flags.DEFINE_integer('stats_block_size', 4096, 'protos parsed as a block in check-stats')
+	flags.DEFINE_string('stats_token_freq_file', None, 'write token frequencies of check-stats to this file, as column<TAB>id<TAB>count lines')
+	# params for index-gz
+	flags.DEFINE_integer('gz_block_rows', 4096, 'rows in one gzip member of index-gz')
+	flags.DEFINE_integer('gz_compress_level', 6, 'compress level of index-gz, the default level of gzip command')
 	# params for pre-process
 	flags.DEFINE_boolean('mask_html_title', True, 'remove content in <title> tag (html_title) from html')
 	flags.DEFINE_boolean('mask_title_fields', False, 'remove meta-title, og-title from html')
@@ -378,10 +918,18 @@ if __name__ == '__main__':
 	flags.DEFINE_string('title_segmentmatch_schema', 'DocumentUrl,Wiki_Name,ODPTitle', 'additional fields to match')
 	flags.DEFINE_integer('htmlhead_length_limit', 10*1024, 'max allowed html head length')
 	flags.DEFINE_float('htmlbody_token_length_ratio', 3.2, 'max allowed html body length is html_token_limit * this ratio')
-	flags.DEFINE_boolean('truncate_by_token', False, 'truncate by html_token_limit tokens after truncate by characters')
+	flags.DEFINE_boolean('truncate_by_token', False, 'truncate by html_token_limit tokens after truncate by characters, needs vocab_file, the Makefile turns it on')
 	flags.DEFINE_boolean('for_inference', False, 'when its'' True, by pass some filtering logic in data pre-process')
 	flags.DEFINE_boolean('include_twitter_in_training', True, 'inlucde twitter handle in training regardless the html-body is empty')
 	flags.DEFINE_boolean('for_wikipedia', False, 'when its'' True, filter data by Sentence field.')
+	# params for pre-process-mp
+	flags.DEFINE_integer('mp_processes', None, 'worker count of pre-process-mp, tokenize-dtitle-v2 and build-vocab-mp, use cpu count when None')
+	flags.DEFINE_integer('mp_block_size', 2048, 'rows sent to one worker as a task in pre-process-mp')
+	flags.DEFINE_integer('mp_log_per_n_blocks', 256, 'log throughput every n blocks in pre-process-mp')
+	flags.DEFINE_enum('subword_encoder', 'trie', ['trie', 'tfds'], 'encoder used by pre-process and tokenize-dtitle, trie is SubwordTrieEncoder which outputs the same ids as tfds SubwordTextEncoder')
+	# params for bench-html-segmenter and check-encoder
+	flags.DEFINE_integer('bench_sample_count', 10000, 'count of rows sampled from input_file for benchmark')
+	flags.DEFINE_integer('bench_seed', 0, 'random seed of sampling for benchmark and build-vocab-mp')
 	# params for build-vocab
 	flags.DEFINE_string('vocab_corpus_columns', 'Url:256,InjHdr_CDG_H,InjHdr_CDG_E,AHtmlTitle,AMetaDesc:512,Wiki_Name,CaptionAnchorText:256,CleanedHtmlBody:4096',
 			'list of column_name:length_limit to build vocab, default length_limit is 128')
@@ -389,11 +937,20 @@ if __name__ == '__main__':
 	flags.DEFINE_integer('target_vocab_size', 8192, 'target vocab size in build-vocab')
 	flags.DEFINE_integer('max_subword_length', 16, 'the max token length for building vocab')
 	flags.DEFINE_float('max_corpus_chars', 4, 'unit GB(2**30 bytes)')
+	flags.DEFINE_integer('vocab_sample_rows', None, 'rows reservoir-sampled from each shard in build-vocab-mp, read rows in order (up to the quota) when None')
+	flags.DEFINE_integer('vocab_min_word_count', 1, 'drop tokens seen fewer times before the subword induction of build-vocab-mp')
 	flags.DEFINE_boolean('use_lower_case', True, 'convert text to lower case in build-vocab and tokenize-dtitle')
 	# params for tokenize-dtitle
 	flags.DEFINE_integer('html_token_limit', 1024, 'max allowed token count for htmlbody, 0 means no limit (1M tokens)')
 	flags.DEFINE_integer('head_token_limit', 256, 'max allowed token count for htmlhead, 0 means no limit (1M tokens)')
 	flags.DEFINE_integer('default_token_limit', 256, 'max allowed token count for fields other than htmlhead/body')
+	flags.DEFINE_integer('encoder_cache_size', 65536, 'LRU cache size (texts) of each column in encoder_cache_columns')
+	flags.DEFINE_string('encoder_cache_columns', 'LanguageAnchor,AHtmlTitle,AMetaDesc,AOGTitle,AOGDesc,InjHdr_CDG_H,InjHdr_CDG_E,Wiki_Name,ODPTitle,CaptionAnchorText,TargetTitle',
+			'columns encoded with a LRU cache in tokenize-dtitle-v2')
+	flags.DEFINE_string('encoder_dict_columns', 'Language,DocumentType', 'low cardinality columns encoded with an unbounded dict cache in tokenize-dtitle-v2')
+	flags.DEFINE_enum('tokenized_format', 'tfrecord', ['tfrecord', 'columnar'], 'output format of tokenize-dtitle-v2, tfrecord (.dtitle.tokenized.gz) or columnar (.dtitle.columnar, see columnar.py)')
+	flags.DEFINE_integer('tokenize_block_size', 1024, 'rows sent to one worker as a task in tokenize-dtitle-v2')
+	flags.DEFINE_string('stage_cache_dir', None, 'cache outputs of pre-process (with input_file) and tokenize-dtitle-v2 in this dir, keyed by contents of the input and the vocab, stage flags and code, see stage_cache.py')
 	flags.DEFINE_enum('compression_type', 'GZIP', ['', 'GZIP'], 'compression type used for tfrecord files')
 
 	app.run(main)
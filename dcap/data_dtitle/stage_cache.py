@@ -0,0 +1,84 @@
+"""Content-addressed cache of stage outputs of the data_dtitle pipeline.
+
+An entry is keyed by the sha1 of the stage name, the content of its input files (e.g. the raw shard and the vocab),
+the values of the flags used by the stage and the source code of the stage. So outputs are reused across TAGs,
+and changing one flag only re-runs the stages reading it. Layout of cache_dir:
+	digests/<sha1 of path, size and mtime>: memoized content digest of a file
+	<stage>/<key><suffix>: cached output files
+"""
+
+import os
+import gzip
+import json
+import shutil
+import hashlib
+import contextlib
+
+
+_READ_CHUNK_SIZE = 1 << 20
+
+class StageCache():
+	def __init__(self, cache_dir):
+		self.cache_dir = cache_dir
+		self.hits, self.misses = 0, 0
+
+	def file_digest(self, path):
+		"""sha1 of the content of path, .gz files are decompressed since gzip headers hold file names and mtimes.
+		digests are memoized by (path, size, mtime), so an unchanged shard is read only once"""
+		st = os.stat(path)
+		memo_key = hashlib.sha1(f'{os.path.abspath(path)}:{st.st_size}:{st.st_mtime_ns}'.encode()).hexdigest()
+		memo_file = os.path.join(self.cache_dir, 'digests', memo_key)
+		if os.path.isfile(memo_file):
+			with open(memo_file) as fi:
+				return fi.read()
+		h = hashlib.sha1()
+		with (gzip.open(path) if path.endswith('.gz') else open(path, 'rb')) as fi:
+			for chunk in iter(lambda: fi.read(_READ_CHUNK_SIZE), b''):
+				h.update(chunk)
+		with self._put_file(memo_file) as tmp_file, open(tmp_file, 'w') as fo:
+			fo.write(h.hexdigest())
+		return h.hexdigest()
+
+	def key(self, stage, input_files, flag_values, code_files):
+		"""flag_values is a dict of the flags (and other parameters) which change the outputs of the stage"""
+		desc = {
+			'stage': stage,
+			'inputs': [self.file_digest(f) for f in input_files],
+			'flags': flag_values,
+			'code': [self.file_digest(f) for f in code_files],
+		}
+		return hashlib.sha1(json.dumps(desc, sort_keys=True).encode()).hexdigest()
+
+	def path(self, stage, key, suffix=''):
+		return os.path.join(self.cache_dir, stage, key + suffix)
+
+	def get(self, stage, key, suffix=''):
+		"""return the path of the cached file, or None when it's not cached"""
+		path = self.path(stage, key, suffix)
+		if os.path.isfile(path):
+			self.hits += 1
+			return path
+		self.misses += 1
+		return None
+
+	def put(self, stage, key, suffix=''):
+		"""context manager of a temp file path to write, which is moved into the cache when the block exits without error"""
+		return self._put_file(self.path(stage, key, suffix))
+
+	def add_file(self, stage, key, src_file, suffix=''):
+		with self.put(stage, key, suffix) as tmp_file:
+			shutil.copyfile(src_file, tmp_file)
+
+	@contextlib.contextmanager
+	def _put_file(self, path):
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		tmp_file = f'{path}.tmp{os.getpid()}'
+		try:
+			yield tmp_file
+			os.replace(tmp_file, path)
+		finally:
+			if os.path.exists(tmp_file):
+				os.remove(tmp_file)
+
+	def format_stats(self):
+		return f'stage cache {self.cache_dir}: {self.hits} hit(s), {self.misses} miss(es)'
@@ -0,0 +1,309 @@
+"""Subword encoders used by process_dtitle_data.py, they load the same <vocab>.subwords files as tfds.deprecated.text.SubwordTextEncoder."""
+
+import collections
+import functools
+import re
+
+
+_UNDERSCORE_REPLACEMENT = '\\&undsc'
+_ALL_REGEX = re.compile(r'(\W+)')
+# tokens of SubwordTextEncoder are word or non-word runs, a single space after a word (then a word or the end) is merged into the word
+_TOKEN_REGEX = re.compile(r'\w+(?: (?!\W))?|\W+')
+_WORD_START_REGEX = re.compile(r'\w')
+_SINGLE_SPACE_REGEX = re.compile(r' (?!\W)')
+_NUM_BYTES = 2**8
+
+def _is_mixed_alphanum(token):
+	return len([s for s in _ALL_REGEX.split(token) if s]) > 1
+
+def _read_subwords_from_file(filename):
+	"""read subwords from a .subwords file saved by SubwordTextEncoder.save_to_file"""
+	with open(filename, 'rb') as f:
+		lines = [line.decode('utf-8')[:-1] for line in f]
+	if lines[0] != '### SubwordTextEncoder':
+		raise ValueError(f'File {filename} does not seem to have been created from SubwordTextEncoder.save_to_file.')
+	return [line[1:-1] for line in lines[2:]]
+
+def _build_trie_pattern(words):
+	"""build a regex pattern from words whose match is the longest word at the position, the pattern is a trie:
+	each node is an alternation of its children, the subtree of a child is optional when the child ends a word"""
+	trie = {}
+	for w in words:
+		node = trie
+		for c in w:
+			node = node.setdefault(c, {})
+		node[''] = True
+
+	def _node_to_pattern(node):
+		alternatives = []
+		for c, child in sorted((c, child) for c, child in node.items() if c):
+			sub = _node_to_pattern(child) if len(child) > ('' in child) else ''
+			if sub:
+				sub = f'(?:{sub})?' if '' in child else f'(?:{sub})'
+			alternatives.append(re.escape(c) + sub)
+		return '|'.join(alternatives)
+	return _node_to_pattern(trie)
+
+
+class SubwordTrieEncoder():
+	"""a drop-in replacement of tfds.deprecated.text.SubwordTextEncoder for encode/decode, the ids are identical.
+
+	texts are split into tokens by one regex (_TOKEN_REGEX) instead of tokenize + _prepare_tokens_for_encode,
+	the greedy longest-match of subwords runs in one regex compiled from a trie of the vocab (see _build_trie_pattern),
+	and the ids of each token are cached in a dict, which is cleared when it holds more than token_cache_size tokens.
+	"""
+	def __init__(self, subwords, token_cache_size=2**20):
+		subwords = [s for s in subwords if s]
+		self._subwords = subwords
+		self._subword_to_id = {s: i + 1 for i, s in enumerate(subwords)}
+		self._byte_offset = len(subwords) + 1
+		# a subword or one char when no subword matches
+		self._subword_regex = re.compile('(?:{})|.'.format(_build_trie_pattern(list(self._subword_to_id) + [_UNDERSCORE_REPLACEMENT])), flags=re.S)
+
+		# build the set in the same way as tfds, its iteration order is the alternation order of the tfds regex
+		reserved_tokens = set([_UNDERSCORE_REPLACEMENT])
+		for t in subwords:
+			if _is_mixed_alphanum(t):
+				reserved_tokens.add(t)
+		self._reserved_token_order = {t: i for i, t in enumerate(reserved_tokens)}
+		self._reserved_token_lengths = sorted(set(len(t) for t in reserved_tokens))
+		self._reserved_tokens_regex = re.compile(_build_trie_pattern(reserved_tokens))
+
+		self._token_cache = {}
+		self._token_cache_size = token_cache_size
+
+		# decode table: (text, add_space) for subwords and bytes for byte ids
+		self._id_to_piece = [None]
+		for s in subwords:
+			self._id_to_piece.append((s[:-1], True) if s.endswith('_') else (s, False))
+		self._id_to_piece.extend(bytes([i]) for i in range(_NUM_BYTES))
+
+	@classmethod
+	def load_from_file(cls, filename_prefix):
+		return cls(_read_subwords_from_file(filename_prefix + '.subwords'))
+
+	@property
+	def vocab_size(self):
+		return 1 + len(self._subwords) + _NUM_BYTES
+
+	@property
+	def subwords(self):
+		return list(self._subwords)
+
+	@property
+	def reserved_tokens(self):
+		"""reserved tokens in the alternation order of the tfds Tokenizer"""
+		return list(self._reserved_token_order)
+
+	def _split_reserved_tokens(self, s):
+		"""the same as re.split by the alternation of reserved tokens in tfds Tokenizer, reserved tokens are at odd indices.
+		it's a generator, so texts after a token budget are not scanned.
+
+		the trie regex finds the leftmost position where any reserved token matches, then the token picked by the
+		alternation is the matched one which comes first in the alternation order"""
+		pos = 0
+		m = self._reserved_tokens_regex.search(s)
+		while m:
+			start = m.start()
+			token = min((s[start:start + l] for l in self._reserved_token_lengths if s[start:start + l] in self._reserved_token_order),
+					key=self._reserved_token_order.get)
+			yield s[pos:start]
+			yield token
+			pos = start + len(token)
+			m = self._reserved_tokens_regex.search(s, pos)
+		yield s[pos:]
+
+	def _subwords_to_ids(self, token):
+		"""greedy longest-match of one prepared token, the same as SubwordTextEncoder._token_to_ids"""
+		ids = []
+		for subword in self._subword_regex.findall(token):
+			if subword == _UNDERSCORE_REPLACEMENT:
+				ids.append(self._byte_offset + ord('_'))
+				continue
+			subword_id = self._subword_to_id.get(subword)
+			if subword_id is not None:
+				ids.append(subword_id)
+			elif subword == '_':
+				ids.append(self._byte_offset + ord(' '))
+			else:
+				ids.extend(self._byte_offset + b for b in subword.encode('utf-8'))
+		return ids
+
+	@staticmethod
+	def _prepare_token(token):
+		"""token is a match of _TOKEN_REGEX, a word token followed by a single space is prepared as word + '_'"""
+		if not _WORD_START_REGEX.match(token):
+			return token
+		if token.endswith(' '):
+			return token[:-1].replace('_', _UNDERSCORE_REPLACEMENT) + '_'
+		return token.replace('_', _UNDERSCORE_REPLACEMENT)
+
+	def _token_to_ids(self, token):
+		ids = tuple(self._subwords_to_ids(self._prepare_token(token)))
+		if len(self._token_cache) >= self._token_cache_size:
+			self._token_cache.clear()
+		self._token_cache[token] = ids
+		return ids
+
+	def _reserved_token_to_ids(self, token, next_is_space):
+		if token == _UNDERSCORE_REPLACEMENT:
+			# broken into 2 tokens, and the single space after it is not skipped
+			return self._subwords_to_ids('\\&') + self._subwords_to_ids('undsc_' if next_is_space else 'undsc')
+		return self._subwords_to_ids(token.replace('_', _UNDERSCORE_REPLACEMENT) + ('_' if next_is_space else ''))
+
+	def _iter_token_ids(self, s):
+		"""yield (token, ids, is_reserved) for tokens of s, the tokens concatenate to s"""
+		if isinstance(s, bytes):
+			s = s.decode('utf-8')
+		cache = self._token_cache
+		substrs = self._split_reserved_tokens(s)
+		substr = next(substrs)
+		while True:
+			for token in _TOKEN_REGEX.findall(substr):
+				yield token, cache.get(token) or self._token_to_ids(token), False
+			token = next(substrs, None)
+			if token is None:
+				return
+			# a reserved token, followed by a single space if the next substr starts with ' ' then a word char or ends
+			substr = next(substrs)
+			next_is_space = _SINGLE_SPACE_REGEX.match(substr) is not None
+			ids = self._reserved_token_to_ids(token, next_is_space)
+			if next_is_space and token != _UNDERSCORE_REPLACEMENT:
+				token, substr = token + ' ', substr[1:]
+			yield token, ids, True
+
+	def encode(self, s):
+		"""encode text into a list of ids, the same as SubwordTextEncoder.encode"""
+		ids = []
+		for _, token_ids, _ in self._iter_token_ids(s):
+			ids.extend(token_ids)
+		return ids
+
+	def encode_until(self, s, max_tokens):
+		"""encode text until max_tokens ids, return (ids, char_offset), ids is the same as encode(s)[:max_tokens] and
+		s[:char_offset] is the text fully encoded by ids, e.g. a char whose utf-8 bytes are cut by max_tokens is excluded,
+		and so are reserved tokens which are cut. texts after the budget are not tokenized."""
+		ids, offset = [], 0
+		for token, token_ids, is_reserved in self._iter_token_ids(s):
+			if len(ids) + len(token_ids) <= max_tokens:
+				ids.extend(token_ids)
+				offset += len(token)
+				continue
+			budget = max_tokens - len(ids)
+			if is_reserved:
+				ids.extend(token_ids[:budget])
+			else:
+				offset += self._encode_token_until(token, budget, ids)
+			break
+		return ids, offset
+
+	def _encode_token_until(self, token, budget, ids):
+		"""append the first budget ids of token to ids, return the count of chars in token fully encoded by them"""
+		prepared = self._prepare_token(token)
+		# source char count of prefixes of the prepared token which end at a char boundary, '\\&undsc' is one char '_'
+		char_counts = {0: 0}
+		p = 0
+		while p < len(prepared):
+			p += len(_UNDERSCORE_REPLACEMENT) if prepared.startswith(_UNDERSCORE_REPLACEMENT, p) else 1
+			char_counts[p] = len(char_counts)
+		char_count = 0
+		for m in self._subword_regex.finditer(prepared):
+			subword_ids = self._subwords_to_ids(m.group())
+			if len(subword_ids) > budget:
+				ids.extend(subword_ids[:budget])
+				break
+			ids.extend(subword_ids)
+			budget -= len(subword_ids)
+			char_count = char_counts.get(m.end(), char_count)
+		return char_count
+
+	def decode(self, ids):
+		"""decode ids into text, the same as SubwordTextEncoder.decode"""
+		ids = list(ids)
+		while ids and not ids[-1]:
+			ids.pop()
+		pieces, prev_bytes = [], []
+		for i in ids:
+			if i <= 0 or i >= self.vocab_size:
+				raise ValueError('Received id %d which is invalid. Ids must be within [0, %d).' % (i, self.vocab_size))
+			piece = self._id_to_piece[i]
+			if isinstance(piece, bytes):
+				prev_bytes.append(piece)
+				continue
+			if prev_bytes:
+				pieces.append(b''.join(prev_bytes).decode('utf-8', 'replace'))
+				prev_bytes = []
+			pieces.append(piece[0])
+			if piece[1]:
+				pieces.append(' ')
+		if prev_bytes:
+			pieces.append(b''.join(prev_bytes).decode('utf-8', 'replace'))
+		return ''.join(pieces)
+
+
+class CachedEncoder():
+	"""wrap an encoder with one cache per column, encode(text, column) returns the same ids as encoder.encode(text).
+
+	columns in cache_columns use a LRU cache of cache_size texts, columns in dict_columns (low cardinality ones
+	like Language or DocumentType) use an unbounded dict, other columns are encoded by the wrapped encoder directly.
+	"""
+	def __init__(self, encoder, cache_size=65536, cache_columns=(), dict_columns=()):
+		self._encoder = encoder
+		self._encode_fns = {}
+		self._dicts = {}
+		self._dict_stats = collections.Counter()
+		for col in cache_columns:
+			self._encode_fns[col] = functools.lru_cache(maxsize=cache_size)(self._encode_to_tuple)
+		for col in dict_columns:
+			self._dicts[col] = {}
+			self._encode_fns[col] = functools.partial(self._encode_with_dict, col=col)
+
+	@classmethod
+	def from_flags(cls, encoder, FLAGS):
+		def _split(columns):
+			return [col for col in columns.split(',') if col]
+		return cls(encoder, FLAGS.encoder_cache_size, _split(FLAGS.encoder_cache_columns), _split(FLAGS.encoder_dict_columns))
+
+	@property
+	def vocab_size(self):
+		return self._encoder.vocab_size
+
+	def _encode_to_tuple(self, text):
+		return tuple(self._encoder.encode(text))
+
+	def _encode_with_dict(self, text, col):
+		d = self._dicts[col]
+		ids = d.get(text)
+		if ids is None:
+			ids = d[text] = self._encode_to_tuple(text)
+			self._dict_stats[col + '.misses'] += 1
+		else:
+			self._dict_stats[col + '.hits'] += 1
+		return ids
+
+	def encode(self, text, column=None):
+		encode_fn = self._encode_fns.get(column)
+		if encode_fn is None:
+			return self._encoder.encode(text)
+		return list(encode_fn(text))
+
+	def decode(self, ids):
+		return self._encoder.decode(ids)
+
+	def stats(self):
+		"""return a Counter of <column>.hits and <column>.misses, worker stats can be merged by Counter.update"""
+		stats = self._dict_stats.copy()
+		for col, encode_fn in self._encode_fns.items():
+			if col not in self._dicts:
+				info = encode_fn.cache_info()
+				stats[col + '.hits'] += info.hits
+				stats[col + '.misses'] += info.misses
+		return stats
+
+	@staticmethod
+	def format_stats(stats):
+		lines = []
+		for col in sorted(set(k.rsplit('.', 1)[0] for k in stats)):
+			hits, misses = stats[col + '.hits'], stats[col + '.misses']
+			lines.append(f'{col}: {hits} hits, {misses} misses, hit rate {hits/((hits + misses) or 1)*100:.2f}%')
+		return '\n'.join(lines)
@@ -0,0 +1,21 @@
+"""data_dtitle modules import each other as siblings, the same as running process_dtitle_data.py in data_dtitle"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sample_texts import CORPUS
+
+@pytest.fixture(scope='session')
+def vocab_file(tmp_path_factory):
+	"""prefix of a small .subwords vocab built by tfds SubwordTextEncoder, with the reserved tokens of build-vocab"""
+	import tensorflow_datasets as tfds
+	from process_dtitle_data import _VOCAB_RESERVED_TOKENS
+	encoder = tfds.deprecated.text.SubwordTextEncoder.build_from_corpus(CORPUS, target_vocab_size=300,
+		reserved_tokens=_VOCAB_RESERVED_TOKENS + ['http://', '.com', 'html5.'])
+	prefix = str(tmp_path_factory.mktemp('vocab') / 'vocab')
+	encoder.save_to_file(prefix)
+	return prefix
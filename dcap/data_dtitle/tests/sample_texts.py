@@ -0,0 +1,7 @@
+"""texts shared by the tests, a plain module since the conftest of another test directory may be imported as conftest first"""
+
+# texts covering reserved tokens, escaping of '_' and '\&undsc', and the byte fallback of chars without subwords
+EDGE_TEXTS = ['', ' ', '  ', '_', '__ _', 'a_b c_', '\\&undsc', 'a\\&undsc b', '\\&undsc x', '_\\&undsc_ ', 'x  y\t\n',
+	'中文 \U0001f600 été', '<EOS>', 'a<BOS#1>b <EOS#2> c', 'mp3 player', 'http://x.com and http://www.y.com', 'html5.com html5. .com_']
+CORPUS = ['the quick brown fox jumps over the lazy dog', 'the title of a web page', 'home page of the news site',
+	'news about the web and the page', 'mp3 player html5 video', 'quick news: the fox and the dog'] * 20
@@ -0,0 +1,17 @@
+import collections
+
+from sample_texts import CORPUS
+from process_dtitle_data import _VOCAB_RESERVED_TOKENS, _tfds_token_counts, _tfds_build_from_token_counts
+
+
+def test_merged_shard_counts_equal_corpus_counts():
+	merged = collections.Counter()
+	for shard in [CORPUS[0::2], CORPUS[1::2]]:
+		merged.update(_tfds_token_counts(iter(shard), 10**6))
+	assert merged == collections.Counter(_tfds_token_counts(iter(CORPUS), 10**6))
+
+def test_build_from_token_counts():
+	encoder = _tfds_build_from_token_counts(collections.Counter(_tfds_token_counts(iter(CORPUS), 10**6)), 1, 20)
+	assert encoder.subwords[:len(_VOCAB_RESERVED_TOKENS)] == _VOCAB_RESERVED_TOKENS
+	for text in CORPUS[:6] + ['<EOS#3>']:
+		assert encoder.decode(encoder.encode(text)) == text
@@ -0,0 +1,11 @@
+import numpy as np
+import pytest
+
+from process_dtitle_data import _truncated_ratio
+
+# rows of lengths 0, 0, 1, 2, 2, 5
+_LENGTH_HIST = np.bincount([0, 0, 1, 2, 2, 5])
+
+@pytest.mark.parametrize('limit, ratio', [(0, 4/6), (1, 4/6), (2, 4/6), (3, 3/6), (4, 1/6), (7, 0), (100, 0)])
+def test_truncated_ratio(limit, ratio):
+	assert _truncated_ratio(_LENGTH_HIST, limit) == pytest.approx(ratio)
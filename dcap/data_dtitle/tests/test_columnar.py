@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+from columnar import ColumnarReader, ColumnarWriter, write_columns
+
+_COLUMNS = ['url', 'title']
+_ROWS = [[[1, 2, 3], [4]], [[], [5, 6]], [[7], []], [[8, 9], [10, 11, 12]]]
+
+def _pack(rows):
+	"""the packed block of tokenize-dtitle-v2 workers, lengths[row_count, col_count] and ids of the row-major cells"""
+	return np.array([[len(cell) for cell in row] for row in rows], dtype=np.int64).reshape([-1, len(_COLUMNS)]), np.array([t for row in rows for cell in row for t in cell], dtype=np.int32)
+
+@pytest.mark.parametrize('vocab_size, dtype', [(300, np.uint16), (70000, np.int32)])
+def test_write_and_read_rows(tmp_path, vocab_size, dtype):
+	path = str(tmp_path / 't.dtitle.columnar')
+	with ColumnarWriter(path, _COLUMNS, vocab_size) as writer:
+		writer.write_block(*_pack(_ROWS[:3]))
+		writer.write_block(*_pack(_ROWS[:0]))
+		writer.write_block(*_pack(_ROWS[3:]))
+	reader = ColumnarReader(path)
+	assert len(reader) == len(_ROWS) and reader.columns == _COLUMNS
+	assert reader.tokens['url'].dtype == dtype
+	for idx, row in enumerate(_ROWS):
+		assert {col: list(reader[idx][col]) for col in _COLUMNS} == dict(zip(_COLUMNS, row))
+		assert list(reader.get_column('title', idx)) == row[1]
+	assert list(reader[-1]['url']) == _ROWS[-1][0]
+	with pytest.raises(IndexError):
+		reader[len(_ROWS)]
+
+def test_get_block(tmp_path):
+	path = str(tmp_path / 't.dtitle.columnar')
+	with ColumnarWriter(path, _COLUMNS, 300) as writer:
+		writer.write_block(*_pack(_ROWS))
+	tokens, row_lengths = ColumnarReader(path, ['title']).get_block('title', 1, 4)
+	assert list(tokens) == [5, 6, 10, 11, 12]
+	assert list(row_lengths) == [2, 0, 3]
+	with pytest.raises(ValueError):
+		ColumnarReader(path, ['html'])
+
+def test_write_columns_from_column_files(tmp_path):
+	src = str(tmp_path / 'src.dtitle.columnar')
+	with ColumnarWriter(src, _COLUMNS, 300) as writer:
+		writer.write_block(*_pack(_ROWS))
+	column_files = {col: (f'{src}/{col}.tokens', f'{src}/{col}.offsets') for col in reversed(_COLUMNS)}
+	assert write_columns(str(tmp_path / 'dst.dtitle.columnar'), column_files, 300) == (len(_ROWS), 12)
+	reader = ColumnarReader(str(tmp_path / 'dst.dtitle.columnar'))
+	assert reader.columns == list(reversed(_COLUMNS))
+	assert [list(reader[idx]['url']) for idx in range(len(_ROWS))] == [row[0] for row in _ROWS]
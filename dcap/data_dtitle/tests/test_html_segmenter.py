@@ -0,0 +1,37 @@
+import types
+
+import pytest
+
+from html_segmenter import HtmlSegmenter
+from process_dtitle_data import _segment_html_legacy
+
+_FLAGS = types.SimpleNamespace(mask_html_title=True, mask_title_fields=True, mask_description_fields=True, mask_og_sitename=True)
+
+@pytest.mark.parametrize('html', [
+	'<html><head><title>t</title><meta property="og:title" content="x"></head><body>b</body></html>',
+	'<HEAD>\n<meta name="description" content="d">\n</HEAD>b<head>x</head>',
+	'<head\n<x></head>',
+	'<head <head\n</head>',
+	'<head<meta property="og:title" content="x">\nabc</head>',
+	'<head <head<meta name="title">\n</head><meta name="x">/head>',
+	'<head <head<meta name="title"><meta property="og:site_name" c="s">\n</head>',
+	'<head<meta name="title">x</head>',
+	'<head<title>t</title>x</head>',
+	'<head></head',
+])
+def test_segment_is_the_same_as_the_regex_chain(html):
+	assert HtmlSegmenter.from_flags(_FLAGS).segment(html) == _segment_html_legacy(html, _FLAGS)
+
+@pytest.mark.parametrize('flags', [(True, False, False, False), (False, True, True, True), (True, True, False, True), (False, False, False, False)])
+@pytest.mark.parametrize('html', [
+	'a<TITLE>t</title>b<META property="og:site_name" content="s">c<Head>h</HEAD>',
+	'<meta name="description" x><meta name="title" x>',
+	# masks are applied one by one, a removed tag may form the tag of the next mask
+	'<me<meta name="title">ta name="description"> <<meta name="title">head>x</head>',
+	'<tıtle>t</tıtle><meta name="tıtle"><head\u0130>x</head><meta name="ſite_name">',
+	'<head\u0130 <title>\u0130</title></head> <hEaD>x</HeAd><head>',
+	'no tags <b>here</b>', 'no tags at all',
+])
+def test_mask_flags(flags, html):
+	flags = types.SimpleNamespace(**dict(zip(['mask_html_title', 'mask_title_fields', 'mask_description_fields', 'mask_og_sitename'], flags)))
+	assert HtmlSegmenter.from_flags(flags).segment(html) == _segment_html_legacy(html, flags)
@@ -0,0 +1,18 @@
+import gzip
+import types
+
+from process_dtitle_data import _open_input_rows, index_gz
+
+
+def test_index_gz_keeps_the_input_and_reads_row_ranges(tmp_path):
+	gz_file = tmp_path / 'data-00.raw.gz'
+	lines = [f'url{i}\ttitle {i}\n'.encode() for i in range(10)]
+	gz_file.write_bytes(gzip.compress(b''.join(lines)))
+	original = gz_file.read_bytes()
+	index_gz(types.SimpleNamespace(input_file=str(gz_file), gz_block_rows=3, gz_compress_level=6))
+	assert gz_file.read_bytes() == original
+	bgz_file = tmp_path / 'data-00.raw.bgz'
+	assert (tmp_path / 'data-00.raw.bgz.idx').is_file()
+	assert gzip.decompress(bgz_file.read_bytes()) == b''.join(lines)
+	for start_row, end_row in [(0, None), (4, 8), (3, 6), (9, 10)]:
+		assert list(_open_input_rows(str(bgz_file), start_row, end_row)) == lines[start_row:end_row]
@@ -0,0 +1,65 @@
+import gzip
+import os
+import time
+
+from stage_cache import StageCache
+
+
+def _write_gz(path, content, mtime):
+	with open(path, 'wb') as fo, gzip.GzipFile(filename=os.path.basename(path), mode='wb', fileobj=fo, mtime=mtime) as fz:
+		fz.write(content)
+
+def test_gz_digest_ignores_gzip_headers(tmp_path):
+	cache = StageCache(str(tmp_path / 'cache'))
+	_write_gz(str(tmp_path / 'a.gz'), b'row 1\nrow 2\n', mtime=1)
+	_write_gz(str(tmp_path / 'b.gz'), b'row 1\nrow 2\n', mtime=2)
+	_write_gz(str(tmp_path / 'c.gz'), b'row 1\nrow 3\n', mtime=1)
+	assert cache.file_digest(str(tmp_path / 'a.gz')) == cache.file_digest(str(tmp_path / 'b.gz'))
+	assert cache.file_digest(str(tmp_path / 'a.gz')) != cache.file_digest(str(tmp_path / 'c.gz'))
+
+def test_digest_is_updated_when_the_file_changes(tmp_path):
+	cache = StageCache(str(tmp_path / 'cache'))
+	path = str(tmp_path / 'a.txt')
+	with open(path, 'w') as fo:
+		fo.write('a')
+	digest = cache.file_digest(path)
+	assert cache.file_digest(path) == digest
+	with open(path, 'w') as fo:
+		fo.write('bb')
+	os.utime(path, ns=(time.time_ns(), time.time_ns() + 10**9))
+	assert cache.file_digest(path) != digest
+
+def test_key_depends_on_stage_inputs_flags_and_code(tmp_path):
+	cache = StageCache(str(tmp_path / 'cache'))
+	files = []
+	for name in ['input', 'other', 'code.py']:
+		files.append(str(tmp_path / name))
+		with open(files[-1], 'w') as fo:
+			fo.write(name)
+	input_file, other_file, code_file = files
+	key = cache.key('pre-process', [input_file], {'html_token_limit': 1024, 'subword_encoder': 'trie'}, [code_file])
+	assert key == cache.key('pre-process', [input_file], {'subword_encoder': 'trie', 'html_token_limit': 1024}, [code_file])
+	assert key != cache.key('tokenize-dtitle', [input_file], {'html_token_limit': 1024, 'subword_encoder': 'trie'}, [code_file])
+	assert key != cache.key('pre-process', [other_file], {'html_token_limit': 1024, 'subword_encoder': 'trie'}, [code_file])
+	assert key != cache.key('pre-process', [input_file], {'html_token_limit': 1024, 'subword_encoder': 'tfds'}, [code_file])
+	assert key != cache.key('pre-process', [input_file], {'html_token_limit': 1024, 'subword_encoder': 'trie'}, [other_file])
+
+def test_put_and_get(tmp_path):
+	cache = StageCache(str(tmp_path / 'cache'))
+	assert cache.get('pre-process', 'k', '.dtitle') is None
+	with cache.put('pre-process', 'k', '.dtitle') as tmp_file, open(tmp_file, 'w') as fo:
+		fo.write('output')
+	with open(cache.get('pre-process', 'k', '.dtitle')) as fi:
+		assert fi.read() == 'output'
+	assert (cache.hits, cache.misses) == (1, 1)
+
+def test_failed_put_is_not_cached(tmp_path):
+	cache = StageCache(str(tmp_path / 'cache'))
+	try:
+		with cache.put('pre-process', 'k', '.dtitle') as tmp_file, open(tmp_file, 'w') as fo:
+			fo.write('partial')
+			raise RuntimeError('stage failed')
+	except RuntimeError:
+		pass
+	assert cache.get('pre-process', 'k', '.dtitle') is None
+	assert os.listdir(os.path.dirname(cache.path('pre-process', 'k'))) == []
@@ -0,0 +1,41 @@
+import pytest
+
+from sample_texts import CORPUS, EDGE_TEXTS
+from subword_encoder import SubwordTrieEncoder, CachedEncoder
+
+
+@pytest.fixture(scope='module')
+def encoders(vocab_file):
+	import tensorflow_datasets as tfds
+	return tfds.deprecated.text.SubwordTextEncoder.load_from_file(vocab_file), SubwordTrieEncoder.load_from_file(vocab_file)
+
+def test_trie_encoder_ids_are_the_same_as_tfds(encoders):
+	tfds_encoder, trie_encoder = encoders
+	assert trie_encoder.vocab_size == tfds_encoder.vocab_size
+	for text in EDGE_TEXTS + CORPUS[:6] + [w + ' ' + w for w in tfds_encoder.subwords]:
+		assert trie_encoder.encode(text) == tfds_encoder.encode(text), repr(text)
+
+def test_trie_encoder_decode_is_the_same_as_tfds(encoders):
+	tfds_encoder, trie_encoder = encoders
+	for text in EDGE_TEXTS + CORPUS[:6]:
+		ids = tfds_encoder.encode(text)
+		assert trie_encoder.decode(ids) == tfds_encoder.decode(ids), repr(text)
+
+def test_encode_until_is_a_prefix_of_encode(encoders):
+	_, trie_encoder = encoders
+	for text in EDGE_TEXTS + CORPUS[:6]:
+		ids = trie_encoder.encode(text)
+		for n in range(len(ids) + 2):
+			prefix, offset = trie_encoder.encode_until(text, n)
+			assert prefix == ids[:n], (repr(text), n)
+			# text[:offset] is fully encoded by the prefix
+			assert trie_encoder.encode(text[:offset]) == prefix[:len(trie_encoder.encode(text[:offset]))], (repr(text), n)
+			assert 0 <= offset <= len(text)
+
+def test_cached_encoder_is_the_same_as_its_encoder(encoders):
+	_, trie_encoder = encoders
+	cached = CachedEncoder(trie_encoder, cache_size=4, cache_columns=['Url'], dict_columns=['Language'])
+	for _ in range(2):
+		for text in EDGE_TEXTS:
+			for column in [None, 'Url', 'Language']:
+				assert list(cached.encode(text, column)) == trie_encoder.encode(text), (repr(text), column)
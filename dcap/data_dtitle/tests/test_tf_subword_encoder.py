@@ -0,0 +1,13 @@
+import tensorflow as tf
+
+from sample_texts import CORPUS, EDGE_TEXTS
+from subword_encoder import SubwordTrieEncoder
+from tf_subword_encoder import TFSubwordEncoder
+
+
+def test_tf_encoder_ids_are_the_same_as_trie(vocab_file):
+	trie_encoder = SubwordTrieEncoder.load_from_file(vocab_file)
+	texts = EDGE_TEXTS + CORPUS[:6] + [w + ' ' + w for w in trie_encoder.subwords]
+	tf_ids = tf.function(TFSubwordEncoder.load_from_file(vocab_file).encode)(tf.constant(texts)).to_list()
+	for text, ids in zip(texts, tf_ids):
+		assert ids == trie_encoder.encode(text), repr(text)
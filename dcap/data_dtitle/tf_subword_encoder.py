@@ -0,0 +1,147 @@
+"""Graph-native subword encoder, encode() is built of TF ops so it runs inside tf.data without tf.py_function.
+
+The ids are the same as SubwordTrieEncoder (and tfds SubwordTextEncoder) on the same .subwords vocab:
+	1. reserved (mixed alphanumeric) tokens are split by one RE2 alternation in the same order as tfds,
+	   RE2 picks the leftmost-first alternative like python re
+	2. the other texts are split into word and non-word runs, python's unicode \\w is rebuilt as a RE2 char class
+	3. a word or reserved token followed by a token of exactly ' ' is prepared as token + '_' and the space is dropped
+	4. greedy longest-match of subwords by a hash table lookup of all prefixes of the remaining chars,
+	   chars without subwords fall back to utf-8 bytes
+texts are separated by '\\x00' and '\\x01' internally, texts with these chars are not supported.
+"""
+
+import functools
+import sys
+
+import tensorflow as tf
+
+
+_UNDERSCORE_REPLACEMENT = '\\&undsc'
+# max utf-8 bytes of one char
+_MAX_CHAR_BYTES = 4
+
+@functools.lru_cache(maxsize=None)
+def _word_char_class():
+	"""RE2 char class of python's \\w (str.isalnum() or '_'), RE2 \\w is ASCII only and its \\p{L} tables may differ from python's"""
+	ranges, start = [], None
+	for i in range(sys.maxunicode + 2):
+		is_word = i <= sys.maxunicode and (chr(i).isalnum() or i == ord('_'))
+		if is_word and start is None:
+			start = i
+		elif not is_word and start is not None:
+			ranges.append(f'\\x{{{start:x}}}' if start == i - 1 else f'\\x{{{start:x}}}-\\x{{{i - 1:x}}}')
+			start = None
+	return ''.join(ranges)
+
+def _escape(token):
+	return ''.join(f'\\x{{{ord(c):x}}}' if c.isascii() and not c.isalnum() else c for c in token)
+
+
+class TFSubwordEncoder():
+	"""encode a batch of texts into a tf.RaggedTensor of ids, built from a SubwordTrieEncoder of the same vocab"""
+	def __init__(self, encoder):
+		subword_to_id = {s: i + 1 for i, s in enumerate(encoder.subwords)}
+		self._byte_offset = len(encoder.subwords) + 1
+		self.vocab_size = encoder.vocab_size
+		# '\&undsc' is matched like a subword and encoded as the byte '_'
+		subword_to_id[_UNDERSCORE_REPLACEMENT] = self._byte_offset + ord('_')
+		self._max_subword_length = max(len(s) for s in subword_to_id)
+		self._subword_table = tf.lookup.StaticHashTable(
+			tf.lookup.KeyValueTensorInitializer(list(subword_to_id), list(subword_to_id.values()), key_dtype=tf.string, value_dtype=tf.int32),
+			default_value=-1)
+
+		word = _word_char_class()
+		self._reserved_regex = '|'.join(_escape(t) for t in encoder.reserved_tokens)
+		# reserved tokens marked by '\x01' are kept as they are
+		self._run_regex = f'\\x01[^\\x00]*|[{word}]+|[^{word}\\x00\\x01]+'
+		self._word_start_regex = f'(?s)[{word}].*'
+
+	@classmethod
+	def load_from_file(cls, filename_prefix):
+		from subword_encoder import SubwordTrieEncoder
+		return cls(SubwordTrieEncoder.load_from_file(filename_prefix))
+
+	def encode(self, texts):
+		"""encode a 1-D string tensor into ids[batch, (ids)], the same as [SubwordTrieEncoder.encode(t) for t in texts]"""
+		tokens = self._split_tokens(tf.convert_to_tensor(texts, tf.string))
+		# tokens are zipf distributed, only unique ones are matched
+		unique_tokens, unique_index = tf.unique(tokens.flat_values)
+		return tokens.with_flat_values(tf.gather(self._tokens_to_ids(unique_tokens), unique_index)).merge_dims(1, 2)
+
+	def _split_tokens(self, texts):
+		"""split texts into prepared tokens[batch, (tokens)], whose subwords are looked up directly"""
+		marked = tf.strings.regex_replace(texts, self._reserved_regex, '\x00\x01\\0\x00')
+		marked = tf.strings.regex_replace(marked, self._run_regex, '\x00\\0\x00')
+		tokens = tf.strings.split(marked, '\x00')
+		tokens = tf.ragged.boolean_mask(tokens, tf.strings.length(tokens) > 0)
+
+		flat, row_ids = tokens.flat_values, tokens.value_rowids()
+		is_reserved = tf.strings.substr(flat, 0, 1) == '\x01'
+		is_word = tf.strings.regex_full_match(flat, self._word_start_regex)
+		# a single space after a word or reserved token (then a word, a reserved token or the end) is merged into the token
+		next_is_space = tf.concat([(flat[1:] == ' ') & (row_ids[1:] == row_ids[:-1]), [False]], axis=0)
+		merged = (is_word | is_reserved) & next_is_space
+
+		lengths = tf.strings.length(flat)
+		text = tf.where(is_reserved, tf.strings.substr(flat, tf.ones_like(lengths), lengths - 1), flat)
+		escaped = tf.strings.regex_replace(text, '_', '\\\\&undsc')
+		prepared = tf.strings.join([escaped, tf.where(merged, '_', '')])
+		# the reserved token '\&undsc' is broken into 2 tokens '\&' and 'undsc', and the space after it is not dropped,
+		# see SubwordTrieEncoder._reserved_token_to_ids
+		is_underscore = is_reserved & (text == _UNDERSCORE_REPLACEMENT)
+		prepared = tf.where(is_underscore, tf.strings.join(['\\&\x00undsc', tf.where(merged, '_', '')]), prepared)
+		keep = tf.logical_not(tf.concat([[False], (merged & tf.logical_not(is_underscore))[:-1]], axis=0))
+
+		tokens = tf.RaggedTensor.from_value_rowids(prepared[keep], row_ids[keep], nrows=tokens.nrows())
+		return tf.strings.split(tokens, '\x00').merge_dims(1, 2)
+
+	def _tokens_to_ids(self, tokens):
+		"""greedy longest-match of a 1-D tensor of prepared tokens, returns ids[tokens, (ids)].
+		each step matches one subword (or one char of byte ids) for the tokens which are not fully matched"""
+		token_count = tf.size(tokens, out_type=tf.int64)
+		char_lengths = tf.strings.length(tokens, unit='UTF8_CHAR')
+		subword_lengths = tf.range(1, self._max_subword_length + 1)
+		byte_index = tf.range(_MAX_CHAR_BYTES)
+
+		def _step(active, pos, token_indices, step_ids, step_counts):
+			active_tokens, active_pos = tf.gather(tokens, active), tf.gather(pos, active)
+			remaining = tf.gather(char_lengths, active) - active_pos
+			n = tf.size(active)
+			prefixes = tf.strings.substr(
+				tf.broadcast_to(active_tokens[:, None], [n, self._max_subword_length]),
+				tf.broadcast_to(active_pos[:, None], [n, self._max_subword_length]),
+				tf.broadcast_to(subword_lengths[None], [n, self._max_subword_length]), unit='UTF8_CHAR')
+			prefix_ids = self._subword_table.lookup(prefixes)
+			matched_length = tf.reduce_max(tf.where((prefix_ids >= 0) & (subword_lengths[None] <= remaining[:, None]), subword_lengths[None], 0), axis=1)
+			matched = matched_length > 0
+			subword_id = tf.gather(prefix_ids, tf.maximum(matched_length - 1, 0), batch_dims=1)
+
+			# byte ids of one char without subwords, '_' (which ends a word with a space) falls back to the byte ' '
+			char = tf.strings.substr(active_tokens, active_pos, tf.ones_like(active_pos), unit='UTF8_CHAR')
+			byte_ids = self._byte_offset + tf.cast(tf.io.decode_raw(char, tf.uint8, fixed_length=_MAX_CHAR_BYTES), tf.int32)
+			is_underscore = char == '_'
+			byte_ids = tf.where(is_underscore[:, None], self._byte_offset + ord(' '), byte_ids)
+			byte_count = tf.where(is_underscore, 1, tf.strings.length(char))
+
+			ids = tf.where(matched[:, None], tf.pad(subword_id[:, None], [[0, 0], [0, _MAX_CHAR_BYTES - 1]]), byte_ids)
+			counts = tf.where(matched, 1, byte_count)
+			pos = tf.tensor_scatter_nd_add(pos, active[:, None], tf.where(matched, matched_length, 1))
+			step = token_indices.size()
+			token_indices = token_indices.write(step, active)
+			step_ids = step_ids.write(step, ids)
+			step_counts = step_counts.write(step, counts)
+			return tf.boolean_mask(active, tf.gather(pos, active) < tf.gather(char_lengths, active)), pos, token_indices, step_ids, step_counts
+
+		_, _, token_indices, step_ids, step_counts = tf.while_loop(
+			lambda active, *_: tf.size(active) > 0, _step,
+			(tf.where(char_lengths > 0)[:, 0], tf.zeros_like(char_lengths),
+			 tf.TensorArray(tf.int64, 0, dynamic_size=True, infer_shape=False, element_shape=[None]),
+			 tf.TensorArray(tf.int32, 0, dynamic_size=True, infer_shape=False, element_shape=[None, _MAX_CHAR_BYTES]),
+			 tf.TensorArray(tf.int32, 0, dynamic_size=True, infer_shape=False, element_shape=[None])),
+			shape_invariants=(tf.TensorShape([None]), tf.TensorShape([None]), None, None, None))
+		token_indices, counts = token_indices.concat(), step_counts.concat()
+		# steps are written in order, a stable sort by token keeps the order of subwords in each token
+		order = tf.argsort(token_indices, stable=True)
+		ids = tf.gather(step_ids.concat(), order)
+		ids = tf.boolean_mask(ids, byte_index[None] < tf.gather(counts, order)[:, None])
+		return tf.RaggedTensor.from_row_lengths(ids, tf.math.unsorted_segment_sum(tf.cast(counts, tf.int64), token_indices, token_count))
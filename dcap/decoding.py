@@ -0,0 +1,181 @@
+"""Decoding strategies of the predict mode of Transformer and Reformer.
+
+Strategies (params["decode_strategy"]):
+ - beam: beam search of beam_size beams to max_decode_length, EOS is not
+   checked, so every sequence runs max_decode_length steps.
+ - beam_early_exit: beam search which finishes a sequence at EOS, the search
+   stops when no alive sequence can beat the finished ones.
+ - greedy: the token of the max logit at each step.
+ - top_k: sampling from the top decode_top_k tokens at each step.
+greedy and top_k drop the rows which have generated EOS from the batch, so the
+decoder only runs on the unfinished rows. beam search doesn't compact the
+batch: the finished rows (and their beams) run every step until the search
+stops, and beam_early_exit only stops early when every row is done.
+
+The decoded ids of every strategy are padded to max_decode_length, so the
+outputs of batches are concatenated by Model.predict. The scores are the log
+probabilities of the decoded ids normalized by the length penalty of beam
+search, ((5 + length) / 6) ** alpha, where the length counts EOS, or is
+max_decode_length for a sequence without EOS.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import tensorflow as tf
+
+from official.nlp.modeling.ops import beam_search
+
+
+DECODE_STRATEGIES = ["beam", "beam_early_exit", "greedy", "top_k"]
+
+
+def decode(symbols_to_logits_fn, initial_ids, initial_cache, params,
+           max_decode_length):
+  """Decodes by params["decode_strategy"].
+
+  Args:
+    symbols_to_logits_fn: a function of (ids, i, cache) returning (logits of
+      the next tokens with shape [batch_size, vocab_size], updated cache).
+    initial_ids: int tensor with shape [batch_size], the start ids.
+    initial_cache: dict of tensors whose first dimension is batch_size.
+    params: hyperparameter object, decode_strategy, beam_size, alpha,
+      decode_top_k, eos_id, vocab_size, padded_decode and dtype are used.
+    max_decode_length: the maximum number of decoding steps.
+
+  Returns:
+    Tuple of (decoded ids with shape [batch_size, max_decode_length] without
+    the start ids and padded by 0, length-normalized scores with shape
+    [batch_size]).
+  """
+  strategy = params.get("decode_strategy") or "beam"
+  if strategy in ("beam", "beam_early_exit"):
+    # An id out of the vocabulary is never generated, so beam search never
+    # finishes a sequence before max_decode_length.
+    eos_id = (params["eos_id"] if strategy == "beam_early_exit" else
+              params["vocab_size"] + 1)
+    decoded_ids, scores = beam_search.sequence_beam_search(
+        symbols_to_logits_fn=symbols_to_logits_fn,
+        initial_ids=initial_ids,
+        initial_cache=initial_cache,
+        vocab_size=params["vocab_size"],
+        beam_size=params["beam_size"],
+        alpha=params["alpha"],
+        max_decode_length=max_decode_length,
+        eos_id=eos_id,
+        padded_decode=params["padded_decode"],
+        dtype=params["dtype"])
+    # Get the top sequence for each batch element, beam_early_exit returns
+    # the sequences of the last step, which may be shorter.
+    decoded_ids, scores = decoded_ids[:, 0, 1:], tf.cast(scores[:, 0], tf.float32)
+    decoded_ids = tf.pad(
+        decoded_ids,
+        [[0, 0], [0, max_decode_length - tf.shape(decoded_ids)[1]]])
+    decoded_ids.set_shape([None, max_decode_length])
+    # The scores of finished sequences are normalized, a row without a
+    # finished sequence returns the log probabilities of its alive sequence.
+    finished = tf.reduce_any(tf.equal(decoded_ids, eos_id), axis=1)
+    return decoded_ids, tf.where(
+        finished, scores,
+        scores / _length_normalization(params["alpha"], max_decode_length))
+  elif strategy in ("greedy", "top_k"):
+    if params["padded_decode"]:
+      raise NotImplementedError(
+          "Padded decoding is not supported by %s decoding." % strategy)
+    decoded_ids, log_probs = sequence_sampling_search(
+        symbols_to_logits_fn, initial_ids, initial_cache, max_decode_length,
+        params["eos_id"],
+        top_k=params["decode_top_k"] if strategy == "top_k" else 1)
+    eos = tf.equal(decoded_ids, params["eos_id"])
+    lengths = tf.where(
+        tf.reduce_any(eos, axis=1),
+        tf.argmax(tf.cast(eos, tf.int32), axis=1, output_type=tf.int32) + 1,
+        max_decode_length)
+    return decoded_ids, log_probs / _length_normalization(
+        params["alpha"], lengths)
+  else:
+    raise ValueError("invalid decode_strategy: %s, should be one of %s" %
+                     (strategy, DECODE_STRATEGIES))
+
+
+def _length_normalization(alpha, length):
+  """The length penalty of beam search (see beam_search.py)."""
+  return tf.pow((5. + tf.cast(length, tf.float32)) / 6., alpha)
+
+
+def sequence_sampling_search(symbols_to_logits_fn, initial_ids, initial_cache,
+                             max_decode_length, eos_id, top_k=1):
+  """Greedy (top_k = 1) or top-k sampling search with batch compaction.
+
+  The rows which have generated eos_id are gathered out of the decoded ids and
+  the cache, so each step only runs on the alive rows, and the loop stops when
+  no row is alive.
+
+  Args:
+    symbols_to_logits_fn: see decode().
+    initial_ids: int tensor with shape [batch_size].
+    initial_cache: dict of tensors whose first dimension is batch_size.
+    max_decode_length: the maximum number of decoding steps.
+    eos_id: the id which finishes a sequence.
+    top_k: the number of tokens of the highest logits to sample from.
+
+  Returns:
+    Tuple of (decoded ids with shape [batch_size, max_decode_length], padded by
+    0 after eos_id, sum of the log probabilities of the decoded ids with shape
+    [batch_size]).
+  """
+  batch_size = tf.shape(initial_ids)[0]
+
+  def _gather_rows(structure, rows):
+    return tf.nest.map_structure(lambda t: tf.gather(t, rows), structure)
+
+  def _step(i, alive_rows, alive_ids, alive_cache, decoded_ids, scores):
+    logits, alive_cache = symbols_to_logits_fn(alive_ids, i, alive_cache)
+    logits = tf.cast(logits, tf.float32)
+    if top_k > 1:
+      top_logits, top_ids = tf.math.top_k(logits, k=top_k)
+      sampled = tf.random.categorical(top_logits, 1, dtype=tf.int32)
+      next_ids = tf.gather(top_ids, sampled[:, 0], batch_dims=1)
+    else:
+      next_ids = tf.argmax(logits, axis=-1, output_type=tf.int32)
+    log_probs = tf.gather(tf.nn.log_softmax(logits), next_ids, batch_dims=1)
+
+    indices = tf.stack([alive_rows, tf.fill(tf.shape(alive_rows), i)], axis=1)
+    decoded_ids = tf.tensor_scatter_nd_update(decoded_ids, indices, next_ids)
+    scores = tf.tensor_scatter_nd_add(scores, alive_rows[:, None], log_probs)
+    alive_ids = tf.concat([alive_ids, next_ids[:, None]], axis=1)
+
+    # Compact the finished rows out of the batch, the gather is skipped when
+    # no row is finished at this step.
+    alive = tf.not_equal(next_ids, eos_id)
+    keep = tf.cast(tf.where(alive)[:, 0], tf.int32)
+    alive_rows, alive_ids, alive_cache = tf.cond(
+        tf.reduce_all(alive),
+        lambda: (alive_rows, alive_ids, alive_cache),
+        lambda: _gather_rows((alive_rows, alive_ids, alive_cache), keep))
+    return i + 1, alive_rows, alive_ids, alive_cache, decoded_ids, scores
+
+  def _continue_search(i, alive_rows, *_):
+    return tf.logical_and(i < max_decode_length, tf.size(alive_rows) > 0)
+
+  loop_vars = (
+      tf.constant(0),
+      tf.range(batch_size),
+      initial_ids[:, None],
+      initial_cache,
+      tf.zeros([batch_size, max_decode_length], dtype=tf.int32),
+      tf.zeros([batch_size], dtype=tf.float32))
+  # The batch dimension of the alive tensors and the length of the cached keys
+  # and values change across steps.
+  shape_invariants = (
+      tf.TensorShape([]),
+      tf.TensorShape([None]),
+      tf.TensorShape([None, None]),
+      tf.nest.map_structure(
+          lambda t: tf.TensorShape([None] * t.shape.rank), initial_cache),
+      tf.TensorShape([None, max_decode_length]),
+      tf.TensorShape([None]))
+  _, _, _, _, decoded_ids, scores = tf.while_loop(
+      _continue_search, _step, loop_vars, shape_invariants=shape_invariants)
+  return decoded_ids, scores
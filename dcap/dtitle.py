@@ -12,7 +12,15 @@ import sys
 import time
 import re
 import html
+import json
+import shutil
+import queue
+import hashlib
+import itertools
+import threading
+import subprocess
 import collections
+import concurrent.futures
 import numpy as np
 
 from absl import app
@@ -20,7 +28,6 @@ from absl import flags
 from absl import logging
 
 import tensorflow as tf
-import tensorflow_datasets as tfds
 
 import misc
 import transformer
@@ -31,8 +38,11 @@ from official.utils.misc import keras_utils
 from official.utils.misc import distribution_utils
 import metrics
 import utils
+from prediction_cache import PredictionCache
 
 from data_dtitle.process_dtitle_data import dtitle_reader
+from data_dtitle.subword_encoder import SubwordTrieEncoder
+from data_dtitle.columnar import ColumnarReader
 
 
 class Seq2SeqTask():
@@ -71,6 +81,7 @@ class Seq2SeqTask():
     params["test_num_hashes"] = flags_obj.test_num_hashes
     params["use_full_attention_in_reformer"] = flags_obj.use_full_attention_in_reformer
     params["bucket_size"] = flags_obj.bucket_size
+    params["pack_examples"] = flags_obj.pack_examples
 
     if flags_obj.one_dropout is not None:
       params['layer_postprocess_dropout'] = flags_obj.one_dropout
@@ -83,9 +94,13 @@ class Seq2SeqTask():
     logging.info(f'attention_padding_strategy = {flags_obj.attention_padding_strategy}')
 
     assert self.flags_obj.vocab_file, 'vocab file is None'
-    self.tokenizer = tfds.deprecated.text.SubwordTextEncoder.load_from_file(self.flags_obj.vocab_file)
+    # the same ids as tfds.deprecated.text.SubwordTextEncoder, checked by process_dtitle_data.py --cmd=check-encoder
+    self.tokenizer = SubwordTrieEncoder.load_from_file(self.flags_obj.vocab_file)
     self.EOS_id = self.tokenizer.encode('<EOS>')[0]
     params["vocab_size"] = self.tokenizer.vocab_size
+    params["eos_id"] = self.EOS_id
+    params["decode_strategy"] = flags_obj.decode_strategy
+    params["decode_top_k"] = flags_obj.decode_top_k
     logging.info('loaded vocab from {}, vocab_size={} and EOS_id={}'.format(self.flags_obj.vocab_file, self.tokenizer.vocab_size, self.EOS_id))
     logging.info(f'training_schema = [{self.flags_obj.training_schema}]')
 
@@ -112,14 +127,15 @@ class Seq2SeqTask():
     else:
       logging.info("Not using any distribution strategy.")
 
-  def create_model(self, mode):
+  def create_model(self, mode, params=None):
+    params = params or self.params
     logging.info('use_reformer = {}'.format(self.flags_obj.use_reformer))
     if self.flags_obj.use_reformer:
-      logging.info(f'num_hashes, test_num_hashes = {self.params["num_hashes"]}, {self.params["test_num_hashes"]}')
+      logging.info(f'num_hashes, test_num_hashes = {params["num_hashes"]}, {params["test_num_hashes"]}')
       logging.info(f'allow_duplicated_attention = {self.flags_obj.allow_duplicated_attention}')
-      return reformer.create_model(self.params, mode=mode)
+      return reformer.create_model(params, mode=mode)
     else:
-      return transformer.create_model(self.params, mode=mode)
+      return transformer.create_model(params, mode=mode)
 
   def train(self):
     """Trains the model."""
@@ -129,8 +145,10 @@ class Seq2SeqTask():
     keras_utils.set_session_config(
         enable_xla=flags_obj.enable_xla)
 
-    train_ds = self._create_dataset(params['data_dir'], repeat=None)
-    val_ds = self._create_dataset(params['val_data_dir'] or re.sub(r'-training.*', '-test.dtitle.tokenized.gz', params['data_dir']), repeat=1)
+    # validation keeps the training targets (training=False would cut them to EOS), but neither buckets batches by length
+    # nor reads the shards in a new random order each run
+    val_ds = self._create_dataset(self._get_val_data_file(params['data_dir'], params['val_data_dir']), repeat=1, batch_tokens=0,
+                                  pack_examples=params['pack_examples'], shuffle_seed=0)
     val_ds = val_ds.take(flags_obj.validation_example_count // params["batch_size"]).cache()
 
     with distribution_utils.get_strategy_scope(self.distribution_strategy):
@@ -141,14 +159,30 @@ class Seq2SeqTask():
       os.mkdir(flags_obj.model_dir)
 
     current_step = 0
-    checkpoint = tf.train.Checkpoint(model=model)
+    # the position of the training input in its pass (see _resume_records), saved with the model so a restart continues after it
+    with tf.device('/CPU:0'):
+      input_position = tf.Variable(0, dtype=tf.int64, trainable=False, name='input_position')
+    checkpoint = tf.train.Checkpoint(model=model, input_position=input_position)
     ckpt_mgr = tf.train.CheckpointManager(checkpoint, flags_obj.model_dir, max_to_keep=3, keep_checkpoint_every_n_hours=24)
     if ckpt_mgr.latest_checkpoint:
       #self._print_variables_and_exit(flags_obj.model_dir)
-      model.fit([tf.ones([params["batch_size"], params['max_input_length']], tf.int32), tf.ones([params["batch_size"], params['max_target_length']], tf.int32)],
-                tf.ones([params["batch_size"], params['max_target_length']], tf.int32),
-                verbose=0)
-      checkpoint.restore(ckpt_mgr.latest_checkpoint).assert_consumed()
+      # create the slot variables of the optimizer (wrapped by LossScaleOptimizer with fp16) by applying zero gradients instead of
+      # a dummy fit, so the whole checkpoint is restored. the weights and the step are overwritten by the restore
+      def _create_slots():
+        variables = model.trainable_variables
+        model.optimizer.apply_gradients(zip([tf.zeros_like(v) for v in variables], variables))
+      with distribution_utils.get_strategy_scope(self.distribution_strategy):
+        if self.distribution_strategy:
+          self.distribution_strategy.run(_create_slots)
+        else:
+          _create_slots()
+      if any(name.startswith('input_position/') for name, _ in tf.train.list_variables(ckpt_mgr.latest_checkpoint)):
+        checkpoint.restore(ckpt_mgr.latest_checkpoint).assert_consumed()
+      else:
+        logging.info('the checkpoint has no input position, the input starts at the head')
+        tf.train.Checkpoint(model=model).restore(ckpt_mgr.latest_checkpoint).assert_consumed()
+      if not flags_obj.resume_input:
+        input_position.assign(0)
       current_step = model.optimizer.iterations.numpy() - 1
       logging.info("Loaded checkpoint %s, current_step %d", ckpt_mgr.latest_checkpoint, current_step)
 
@@ -156,6 +190,16 @@ class Seq2SeqTask():
       logging.info("Reach the target train_steps({}) and exit.".format(flags_obj.train_steps))
       return None
 
+    # a restart doesn't replay the trained examples: a single-file input continues after the records read before the checkpoint,
+    # which are skipped before parsing, and the shuffle order (and the order of shards) is a function of shuffle_seed and the global step
+    train_ds = self._create_dataset(params['data_dir'], repeat=None, shuffle_size=flags_obj.shuffle_buffer_size, shuffle_seed=flags_obj.shuffle_seed + current_step,
+                                    pack_examples=params['pack_examples'], input_position=input_position)
+
+    if flags_obj.batch_tokens or params['pack_examples']:
+      # the logged datasets don't move the input position
+      self._log_padding_ratio(self._create_dataset(params['data_dir'], repeat=1, batch_tokens=0), 'fixed-size batches')
+      self._log_padding_ratio(self._create_dataset(params['data_dir'], repeat=1, pack_examples=params['pack_examples']), f'batches of {flags_obj.batch_tokens} tokens' if flags_obj.batch_tokens else f'batches of up to {params["pack_examples"]} packed examples per row')
+
     logging.info(f'Start train iteration at global step: {current_step}')
     model.summary()
     #print(model.variables)
@@ -183,7 +227,7 @@ class Seq2SeqTask():
       self._load_model_weights(model)
 
     N = self.flags_obj.validation_example_count // self.params["batch_size"]
-    ds = self._create_dataset(self.params['data_dir'], repeat=1).take(N)
+    ds = self._create_dataset(self.params['data_dir'], repeat=1, pack_examples=self.params['pack_examples']).take(N)
     res = model.evaluate(ds, steps=N)
     logging.info('Evaluate {} batches, res={}'.format(N, res))
 
@@ -272,16 +316,15 @@ class Seq2SeqTask():
       inputs += [inputs[0]] * (128 - original_inputs_len)
       logging.info(f'len(inputs)={original_inputs_len}, append inputs to {len(inputs)}')
     X = np.vstack(inputs)
-    Y = np.ones([len(inputs), 1], np.int32)
     logging.info(f'load {len(targets)} examples from {params["data_dir"]}, ignore {ignored_count} examples')
 
     correct, total = 0, 0
-    mpred = model.predict([X, Y], batch_size=params['batch_size'], verbose=1 if flags_obj.dev_mode else 0)
-    for ind, (pred_ids, score, logits) in enumerate(zip(*mpred)):
+    mpred = model.predict(X, batch_size=params['batch_size'], verbose=1 if flags_obj.dev_mode else 0)
+    for ind, (_, pred_ids, score, null_prob) in enumerate(zip(*mpred)):
       if original_inputs_len and original_inputs_len == ind: break
       preds.append(pred_ids)
       pred_scores.append(score)
-      null_probs.append(tf.nn.softmax(logits[0])[1])
+      null_probs.append(null_prob)
       pred_strings.append(self._trim_and_decode(preds[-1]))
       total += 1
       correct += 1 if pred_strings[-1] == target_strings[ind][0] else 0
@@ -427,7 +470,8 @@ class Seq2SeqTask():
 
 
   def predict_express(self):
-    """Predicts result from the model."""
+    """Predicts result from the model batch by batch, predictions are decoded and written by a writer thread
+    while the next batches are predicted. the output is flushed per batch, so the memory is flat and partial results are kept"""
     params = self.params
     flags_obj = self.flags_obj
 
@@ -441,23 +485,272 @@ class Seq2SeqTask():
     if flags_obj.max_predict_count:
       ds = ds.take(flags_obj.max_predict_count//self.params['batch_size'])
 
-    ds = ds.map(lambda X, Y: (X,))
-    mpred = model.predict(ds, verbose=1 if flags_obj.dev_mode else 0)
-
-    if flags_obj.prediction_compact_file:
-      start_time = time.time()
-      out_path = flags_obj.prediction_compact_file
-      if flags_obj.prediction_compact_file == '#model_dir':
-        out_path = os.path.join(self.flags_obj.model_dir, 'prediction-compact-{}.txt'.format(int(time.time())))
-      with open(out_path, 'w', encoding='utf8') as f:
-        f.write('NormalizedUrl\tPredict\tNullProb\n')
-        for (input_ids, pred_ids, score, null_prob) in zip(*mpred):
-          url = [re.sub(r'<[EB]OS#\d>', '', s) for s in self._trim_and_decode(input_ids, [12], concatenate_segments=False)][0]
-          pred = self._trim_and_decode(pred_ids)
-          pred = re.sub(r'[\t\r\n]+', ' ', html.unescape(pred)) # pred may contains '\n' after unescape
-          f.write('{}\t{}\t{}\n'.format(url, pred, null_prob))
+    out_path = flags_obj.prediction_compact_file
+    if flags_obj.prediction_compact_file == '#model_dir':
+      out_path = os.path.join(self.flags_obj.model_dir, 'prediction-compact-{}.txt'.format(int(time.time())))
+
+    cache = self._open_prediction_cache()
+    self._predict_to_file(model, ds, out_path, cache)
+    if cache:
+      cache.close()
+
+  def _predict_to_file(self, model, ds, out_path, cache=None):
+    """predict batches of ds by model, and write the compact predictions to out_path by a writer thread.
+    with a PredictionCache, only the inputs which are not cached are predicted, once per batch for duplicated inputs"""
+    start_time = time.time()
+    # the queue holds up to predict_queue_size batches, predict_on_batch waits when the writer falls behind
+    results, errors = queue.Queue(maxsize=self.flags_obj.predict_queue_size), []
+    writer = threading.Thread(target=self._write_compact_predictions, args=(out_path, results, errors, cache))
+    writer.start()
+    try:
+      for batch, (X, _) in enumerate(ds):
+        if errors:
+          break
+        input_ids = X[0].numpy()
+        if cache:
+          keys = cache.keys(input_ids)
+          cached = cache.get(keys)
+          # the first row of each key which is not cached
+          missed = {}
+          for row, key in enumerate(keys):
+            if key not in cached:
+              missed.setdefault(key, row)
+          outputs = model.predict_on_batch(tf.gather(X[0], list(missed.values()))) if missed else None
+          results.put((input_ids, keys, cached, list(missed), outputs))
+        else:
+          keys = list(range(len(input_ids)))
+          results.put((input_ids, keys, {}, keys, model.predict_on_batch(X[0])))
+        if (batch + 1) % 100 == 0:
+          logging.info(f'predict {batch + 1} batches in {int(time.time() - start_time)} seconds')
+    finally:
+      results.put(None)
+      writer.join()
+    if errors:
+      raise errors[0]
+    if out_path:
       logging.info(f'write compact prediction to {out_path}, takes {int(time.time() - start_time)} seconds')
+    if cache:
+      logging.info(cache.format_stats())
 
+  def _open_prediction_cache(self):
+    """the PredictionCache of prediction_cache_file, or None when it's not set"""
+    if not self.flags_obj.prediction_cache_file:
+      return None
+    checkpoint_path = tf.train.latest_checkpoint(self.flags_obj.model_dir)
+    decode_params = {k: self.params.get(k) for k in ['beam_size', 'alpha', 'extra_decode_length', 'decode_max_length', 'max_input_length', 'max_target_length',
+                                                     'test_num_hashes', 'use_full_attention_in_reformer', 'decode_strategy', 'decode_top_k']}
+    model_key = json.dumps({'checkpoint': os.path.abspath(checkpoint_path), 'params': decode_params,
+                            'use_reformer': self.flags_obj.use_reformer, 'training_schema': self.flags_obj.training_schema}, sort_keys=True)
+    logging.info(f'open prediction cache {self.flags_obj.prediction_cache_file} of {model_key}')
+    return PredictionCache(self.flags_obj.prediction_cache_file, model_key)
+
+  def predict_driver(self):
+    """Predicts the splits of a large input in one process, replacing the per-split runs of --mode=predict-express.
+    the model is created and restored once per device (one per GPU, or predict_workers on CPU), a device takes the next split
+    when it finishes one, and splits are tokenized by prediction_tokenize_cmd ahead of prediction. the predictions of a split
+    are written to <split>.predict next to prediction_compact_file, existing ones are reused, then merged in the order of splits.
+    devices are driven by threads of this process: the model calls release the GIL, but detokenizing and writing the predictions
+    (_write_compact_predictions) hold it, so on CPU predict_workers beyond 2-4 mostly contend for the GIL, and separate processes
+    on disjoint --prediction_split_files scale better"""
+    flags_obj = self.flags_obj
+    split_files = self._list_data_files(flags_obj.prediction_split_files)
+    out_path = flags_obj.prediction_compact_file
+    out_dir = os.path.dirname(os.path.abspath(out_path))
+    devices = [d.name for d in tf.config.list_logical_devices('GPU')] or ['/CPU:0'] * flags_obj.predict_workers
+    logging.info(f'predict {len(split_files)} splits on {len(devices)} devices: {devices}')
+
+    models = []
+    for device in devices:
+      with tf.device(device):
+        model = self.create_model(mode='predict')
+        self._load_model_weights(model)
+      models.append(model)
+
+    def _split_name(split_file):
+      # split-000.raw.gz or split-000.test.dtitle.tokenized.gz => split-000
+      return os.path.basename(split_file).split('.')[0]
+
+    if len(set(map(_split_name, split_files))) != len(split_files):
+      raise ValueError(f'splits of {flags_obj.prediction_split_files} have duplicated names')
+
+    def _tokenize(split_file):
+      if not flags_obj.prediction_tokenize_cmd:
+        return split_file
+      tokenized_file = os.path.join(out_dir, _split_name(split_file) + '.test.dtitle.tokenized.gz')
+      if not os.path.exists(tokenized_file):
+        start_time = time.time()
+        cmd = flags_obj.prediction_tokenize_cmd.format(input=os.path.abspath(split_file), output=tokenized_file)
+        subprocess.run(cmd, shell=True, check=True)
+        logging.info(f'tokenize {split_file} to {tokenized_file} in {int(time.time() - start_time)} seconds')
+      return tokenized_file
+
+    def _predict_worker(device, model):
+      while True:
+        item = splits.get()
+        if item is None:
+          break
+        if errors:
+          continue
+        split_file, tokenized = item
+        predict_file = os.path.join(out_dir, _split_name(split_file) + '.predict')
+        try:
+          ds = self._create_dataset(tokenized.result(), repeat=1, training=False)
+          with tf.device(device):
+            self._predict_to_file(model, ds, predict_file + '.tmp', cache)
+          os.replace(predict_file + '.tmp', predict_file)
+          logging.info(f'{device}: write predictions of {split_file} to {predict_file}')
+        except Exception as e:
+          errors.append(e)
+
+    cache = self._open_prediction_cache()
+    start_time = time.time()
+    # a split waiting in the queue is being tokenized, so the next split is ready when a device finishes one
+    splits, errors = queue.Queue(maxsize=len(devices)), []
+    workers = [threading.Thread(target=_predict_worker, args=args) for args in zip(devices, models)]
+    for worker in workers:
+      worker.start()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(devices)) as tokenizer_pool:
+      try:
+        for split_file in split_files:
+          if errors:
+            break
+          if os.path.exists(os.path.join(out_dir, _split_name(split_file) + '.predict')):
+            logging.info(f'skip {split_file}, whose predictions exist')
+            continue
+          splits.put((split_file, tokenizer_pool.submit(_tokenize, split_file)))
+      finally:
+        for _ in workers:
+          splits.put(None)
+        for worker in workers:
+          worker.join()
+    if cache:
+      cache.close()
+    if errors:
+      raise errors[0]
+
+    with open(out_path, 'w', encoding='utf8') as fo:
+      for idx, split_file in enumerate(split_files):
+        with open(os.path.join(out_dir, _split_name(split_file) + '.predict'), encoding='utf8') as fi:
+          header = fi.readline()
+          if idx == 0:
+            fo.write(header)
+          shutil.copyfileobj(fi, fo)
+    logging.info(f'merge predictions of {len(split_files)} splits to {out_path}, takes {int(time.time() - start_time)} seconds')
+
+  def _write_compact_predictions(self, out_path, results, errors, cache=None):
+    """the writer thread of predict_express, writes batches of (input_ids, keys, cached, missed_keys, outputs) from the results queue
+    until None, outputs are the model outputs of missed_keys, and the predictions of the other keys are in cached.
+    the new predictions are put into the cache. the exception is appended to errors, and the rest batches are drained without writing"""
+    with open(out_path or os.devnull, 'w', encoding='utf8') as f:
+      f.write('NormalizedUrl\tPredict\tNullProb\n')
+      while True:
+        item = results.get()
+        if item is None:
+          break
+        if errors:
+          continue
+        try:
+          input_ids, keys, cached, missed_keys, outputs = item
+          predictions = {}
+          for key, (_, pred_ids, score, null_prob) in zip(missed_keys, zip(*outputs) if outputs else []):
+            pred = self._trim_and_decode(pred_ids)
+            pred = re.sub(r'[\t\r\n]+', ' ', html.unescape(pred)) # pred may contains '\n' after unescape
+            predictions[key] = (pred, str(null_prob))
+          if cache:
+            cache.put(predictions)
+          predictions.update(cached)
+          for ids, key in zip(input_ids, keys):
+            url = [re.sub(r'<[EB]OS#\d>', '', s) for s in self._trim_and_decode(ids, [12], concatenate_segments=False)][0]
+            f.write('{}\t{}\t{}\n'.format(url, *predictions[key]))
+          f.flush()
+        except Exception as e:
+          errors.append(e)
+
+
+  def bench_parse(self):
+    """compare examples/sec of per-example and batched proto parsing on the dtitle-tokenized dataset in data_dir"""
+    import zlib
+    params = self.params
+    data_file = params['data_dir']
+    assert data_file.endswith('.dtitle.tokenized') or data_file.endswith('.dtitle.tokenized.gz'), f'bench-parse needs a .dtitle.tokenized(.gz) file: {data_file}'
+    checksums = {}
+    for name, parse_batch_size in [('per-example', 0), ('batched', self.flags_obj.dtitle_parse_batch_size or 1024)]:
+      ds = self._create_dtitle_tokenized_dataset(data_file, params['batch_size'], params['max_input_length'], params['max_target_length'],
+          None, None, None, self.EOS_id, training=True, parse_batch_size=parse_batch_size)
+      start_time = time.time()
+      count, checksum = 0, 0
+      for inputs, target in ds:
+        count += inputs.shape[0]
+        checksum = zlib.crc32(target.numpy().tobytes(), zlib.crc32(inputs.numpy().tobytes(), checksum))
+      elapsed = time.time() - start_time
+      checksums[name] = checksum
+      logging.info(f'{name} parsing: {count} examples in {elapsed:.1f} seconds, {count/elapsed:.1f} examples/sec, checksum = {checksum:08x}')
+    if len(set(checksums.values())) != 1:
+      logging.error(f'batches of the 2 parsing paths mismatched: {checksums}')
+
+  def bench_input(self):
+    """throughput of the input pipelines of bench_input_files (data_dir by default), and the waste of model steps on them
+    when bench_model_steps > 0, the step time is measured by training on __random_input__ which is never input-bound"""
+    params, flags_obj = self.params, self.flags_obj
+    batch_count = flags_obj.bench_batches
+    step_time = None
+    if flags_obj.bench_model_steps:
+      ds = iter(self._create_dataset('__random_input__', repeat=None, pack_examples=params['pack_examples']))
+      with distribution_utils.get_strategy_scope(self.distribution_strategy):
+        model = self.create_model(mode='train')
+        model.compile(optimizer=self._create_optimizer(), loss=self._create_loss_fn(params))
+      model.train_on_batch(*next(ds))
+      start_time = time.time()
+      for _ in range(flags_obj.bench_model_steps):
+        model.train_on_batch(*next(ds))
+      step_time = (time.time() - start_time) / flags_obj.bench_model_steps
+      logging.info(f'model step time on __random_input__: {step_time*1000:.1f} ms')
+
+    for data_file in flags_obj.bench_input_files or [params['data_dir']]:
+      ds = self._create_dataset(data_file, repeat=None, pack_examples=params['pack_examples'])
+      # the first batch builds the pipeline and fills the prefetch buffers
+      it = iter(ds)
+      next(it)
+      start_time, start_cpu = time.time(), time.process_time()
+      batches, rows, tokens, padded = 0, 0, 0, 0
+      for (inputs, target, *_), _ in itertools.islice(it, batch_count):
+        batches += 1
+        rows += inputs.shape[0]
+        tokens += int(tf.math.count_nonzero(inputs)) + int(tf.math.count_nonzero(target))
+        padded += int(tf.size(inputs)) + int(tf.size(target))
+      elapsed, cpu = time.time() - start_time, time.process_time() - start_cpu
+      logging.info(f'{data_file}: {batches} batches in {elapsed:.1f} seconds, {batches/elapsed:.1f} batches/sec, {rows/elapsed:.1f} examples/sec, '
+                   f'{tokens/elapsed:.1f} tokens/sec, padding {1 - tokens/max(padded, 1):.2%}, CPU utilization {cpu/elapsed/os.cpu_count():.1%} of {os.cpu_count()} CPUs')
+      if step_time:
+        batch_time = elapsed / max(batches, 1)
+        logging.info(f'{data_file}: {batch_time*1000:.1f} ms per batch vs {step_time*1000:.1f} ms per model step, '
+                     f'the accelerator would wait for input {max(0, 1 - step_time/batch_time):.1%} of the time')
+
+  def bench_decode(self):
+    """latency and quality of the decode strategies of bench_decode_strategies on the first bench_batches batches of data_dir,
+    e.g. the test split. the quality is the exact match and ROUGE scores (when calc_rouge_scores) of the predictions to the targets"""
+    params, flags_obj = self.params, self.flags_obj
+    batches = [X for X, _ in itertools.islice(self._create_dataset(params['data_dir'], repeat=1, training=False), flags_obj.bench_batches)]
+    references = [[self._trim_and_decode(ids)] for _, targets in batches for ids in targets.numpy()]
+    logging.info(f'bench decode strategies {flags_obj.bench_decode_strategies} on {len(references)} examples of {params["data_dir"]}')
+
+    reports = []
+    for strategy in flags_obj.bench_decode_strategies:
+      with distribution_utils.get_strategy_scope(self.distribution_strategy):
+        model = self.create_model(mode='predict', params=dict(params, decode_strategy=strategy))
+        self._load_model_weights(model)
+      # the first batch builds the decoding graph of the strategy
+      model.predict_on_batch(batches[0][0])
+      start_time = time.time()
+      outputs = [model.predict_on_batch(inputs) for inputs, _ in batches]
+      elapsed = time.time() - start_time
+      preds = [self._trim_and_decode(ids) for _, pred_ids, _, _ in outputs for ids in pred_ids]
+      exact_match = sum(pred == ref[0] for pred, ref in zip(preds, references)) / max(len(references), 1)
+      rouge = self._calculate_rouge_scores(preds, references) if flags_obj.calc_rouge_scores else None
+      rouge_desc = ', ROUGE-1/2/L F1 {:.4f} / {:.4f} / {:.4f}'.format(*[rouge[f'ROUGE-{n}-F'] for n in '12L']) if rouge else ''
+      reports.append(f'{strategy:16}: {elapsed*1000/len(batches):.1f} ms per batch, {len(preds)/elapsed:.1f} examples/sec, exact match {exact_match:.2%}{rouge_desc}')
+      logging.info(reports[-1])
+    logging.info('decode strategies:\n' + '\n'.join(reports))
 
   def _create_callbacks(self, log_dir, init_steps, steps_per_epoch, params, ckpt_mgr):
     """Creates a list of callbacks."""
@@ -509,8 +802,10 @@ class Seq2SeqTask():
       label_smoothing = params["label_smoothing"]
       vocab_size = params["vocab_size"]
       def loss(y_true, y_pred):
-        y_true = tf.reshape(y_true, [params['batch_size'], -1])
-        y_pred = tf.reshape(y_pred, [params['batch_size'], -1, vocab_size])
+        # the batch size is dynamic when batches are bucketed by batch_tokens
+        batch_size = tf.shape(y_pred)[0]
+        y_true = tf.reshape(y_true, [batch_size, -1])
+        y_pred = tf.reshape(y_pred, [batch_size, -1, vocab_size])
         return metrics.transformer_loss(y_pred, y_true, label_smoothing, vocab_size)
       return loss
     else:
@@ -528,7 +823,8 @@ class Seq2SeqTask():
                                         output_shapes=((batch_size, max_input_length), (batch_size, max_target_length)))
     return ds
 
-  def _create_dtitle_dataset(self, data_file, batch_size, max_input_length, max_target_length, url_segment_limit, hostname_segment_limit, html_segment_limit, eos):
+  def _create_dtitle_dataset(self, data_file, batch_size, max_input_length, max_target_length, url_segment_limit, hostname_segment_limit, html_segment_limit, eos,
+                             input_position=None):
     def _dtitle_encode(ln):
       url, tar, hostname, html = tf.strings.split(ln, '\t')
 
@@ -562,17 +858,129 @@ class Seq2SeqTask():
         raise ValueError('invalid input_concat_schema: ' + self.flags_obj.input_concat_schema)
 
     ds = tf.data.TextLineDataset(data_file, compression_type='GZIP' if data_file.endswith('.gz') else None)
+    if input_position is not None:
+      ds = self._resume_records(ds, input_position)
+    if self.flags_obj.dtitle_tokenizer == 'graph':
+      return self._create_dtitle_graph_dataset(ds, batch_size, max_input_length, max_target_length, url_segment_limit, hostname_segment_limit, html_segment_limit, eos)
     ds = ds.map(lambda ln: tf.py_function(_dtitle_encode, [ln], [tf.int32, tf.int32]), num_parallel_calls=tf.data.experimental.AUTOTUNE)
     ds = ds.filter(lambda _, target: tf.size(target) <= max_target_length)
     ds = ds.padded_batch(batch_size, padded_shapes=([max_input_length], [max_target_length]), drop_remainder=True)
     return ds
 
-  def _create_tfrecord_dataset(self, data_file, batch_size, max_input_length, max_target_length):
+  def _create_dtitle_graph_dataset(self, ds, batch_size, max_input_length, max_target_length, url_segment_limit, hostname_segment_limit, html_segment_limit, eos, block_size=1024):
+    """the same examples as _dtitle_encode, lines are tokenized in blocks by TFSubwordEncoder without tf.py_function"""
+    from data_dtitle.tf_subword_encoder import TFSubwordEncoder
+    encoder = TFSubwordEncoder(self.tokenizer)
+    schema = self.flags_obj.input_concat_schema
+    if schema not in ['v0', 'v1', 'v2', 'v3']:
+      raise ValueError('invalid input_concat_schema: ' + schema)
+
+    def _segment(ids, limit, bos=None):
+      # [bos] + ids[:limit - 2] + [eos], or ids[:limit - 1] + [eos] without bos
+      rows = ids.nrows()
+      prefix = [tf.RaggedTensor.from_tensor(tf.fill([rows, 1], bos))] if bos is not None else []
+      return tf.concat(prefix + [ids[:, :limit - len(prefix) - 1], tf.RaggedTensor.from_tensor(tf.fill([rows, 1], eos))], axis=1)
+
+    def _padded(segment, limit):
+      return tf.RaggedTensor.from_tensor(segment.to_tensor(shape=[None, limit]))
+
+    def _encode_block(lines):
+      # rows of another field count fail like the unpacking of _dtitle_encode, instead of being padded or truncated,
+      # and '\x00' and '\x01' are the internal separators of TFSubwordEncoder
+      fields = tf.strings.split(lines, '\t')
+      with tf.control_dependencies([
+          tf.debugging.assert_equal(fields.row_lengths(), tf.constant(4, tf.int64),
+                                    message='a .dtitle line must have 4 tab-separated fields (url, title, hostname, html)'),
+          tf.debugging.assert_equal(tf.strings.regex_full_match(lines, '(?s).*[\\x00\\x01].*'), False,
+                                    message='a .dtitle line must not contain \\x00 or \\x01, use --dtitle_tokenizer=py_function')]):
+        fields = fields.to_tensor(shape=[None, 4])
+      url, tar, hostname, html = [encoder.encode(fields[:, i]) for i in range(4)]
+      if schema == 'v0':
+        inputs = _segment(html, max_input_length)
+      elif schema == 'v1':
+        inputs = tf.concat([_segment(url, url_segment_limit, eos+1), _segment(hostname, hostname_segment_limit, eos+2), _segment(html, html_segment_limit, eos+3)], axis=1)
+      elif schema == 'v2':
+        inputs = tf.concat([_padded(_segment(url, url_segment_limit, eos+1), url_segment_limit), _padded(_segment(hostname, hostname_segment_limit, eos+2), hostname_segment_limit), _segment(html, html_segment_limit, eos+3)], axis=1)
+      else:
+        inputs = tf.concat([_padded(_segment(url, url_segment_limit), url_segment_limit), _padded(_segment(hostname, hostname_segment_limit), hostname_segment_limit), _segment(html, html_segment_limit)], axis=1)
+      targets = tf.concat([tar, tf.RaggedTensor.from_tensor(tf.fill([tar.nrows(), 1], eos))], axis=1)
+      keep = targets.row_lengths() <= max_target_length
+      return (tf.ragged.boolean_mask(inputs, keep).to_tensor(shape=[None, max_input_length]),
+              tf.ragged.boolean_mask(targets, keep).to_tensor(shape=[None, max_target_length]))
+
+    ds = ds.batch(block_size)
+    ds = ds.map(_encode_block, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    ds = ds.unbatch().batch(batch_size, drop_remainder=True)
+    return ds
+
+  def _get_val_data_file(self, data_file, val_data_file=None):
+    """val_data_file, or the test split of a single data_file, e.g. x-training.dtitle.tokenized.gz => x-test.dtitle.tokenized.gz.
+    a glob or a list of training files needs val_data_file, and the validation files must not be training files"""
+    if data_file == '__random_input__':
+      return val_data_file or data_file
+    if not val_data_file:
+      if any(c in data_file for c in '*?[,'):
+        raise ValueError(f'--val_data_dir is required when data_dir is a glob or a list of files: {data_file}')
+      test_postfix = '-test.dtitle.columnar' if data_file.endswith('.dtitle.columnar') else '-test.dtitle.tokenized.gz'
+      val_data_file = re.sub(r'-training.*', test_postfix, data_file)
+    overlapped = set(self._list_data_files(val_data_file)) & set(self._list_data_files(data_file))
+    if overlapped:
+      raise ValueError(f'validation data {val_data_file} includes training files {sorted(overlapped)}, set --val_data_dir')
+    return val_data_file
+
+  def _list_data_files(self, data_file):
+    """data_file is a file, a glob or a comma separated list of them, e.g. split_raw/cache_x/data-*.dtitle.tokenized.gz"""
+    files = []
+    for pattern in data_file.split(','):
+      matched = sorted(tf.io.gfile.glob(pattern)) if any(c in pattern for c in '*?[') else [pattern]
+      if not matched:
+        raise ValueError(f'no file matches {pattern}')
+      files += matched
+    return list(dict.fromkeys(files))
+
+  def _resume_records(self, records, input_position):
+    """repeated passes of the records (lines, serialized protos) of a training input, the first pass starts at the value of input_position
+    (restored from a checkpoint) and the records before it are dropped unparsed, then input_position follows the position in the pass
+    after the last record read. the pipeline reads ahead of training, so the records in its shuffle and prefetch buffers at a checkpoint
+    are skipped after a restart instead of being trained twice"""
+    start = int(input_position.numpy())
+    if start:
+      logging.info(f'resume the input at record {start} of the pass')
+    passes = records.skip(start).enumerate(start).concatenate(records.enumerate().repeat())
+
+    def _track(index, record):
+      with tf.control_dependencies([input_position.assign(index + 1)]):
+        return tf.identity(record)
+    return passes.map(_track)
+
+  def _create_record_dataset(self, data_file, training, shuffle_seed=None, input_position=None):
+    """serialized records of one or more TFRecord files, multiple shards are read by a parallel interleave,
+    and in training the order of shards is shuffled each epoch by shuffle_seed and records of shards are interleaved nondeterministically.
+    with a multi-worker distribution strategy, the shards are distributed to workers by the FILE auto-shard policy.
+    input_position: the records of a single file are repeated and resumed at it, see _resume_records"""
+    files = self._list_data_files(data_file)
+    compression_type = 'GZIP' if files[0].endswith('.gz') else None
+    if len(files) == 1:
+      ds = tf.data.TFRecordDataset(files[0], compression_type=compression_type)
+      return ds if input_position is None else self._resume_records(ds, input_position)
+
+    logging.info(f'read {len(files)} shards of {data_file}')
+    ds = tf.data.Dataset.from_tensor_slices(files)
+    if training:
+      ds = ds.shuffle(len(files), seed=shuffle_seed, reshuffle_each_iteration=True)
+    ds = ds.interleave(lambda f: tf.data.TFRecordDataset(f, compression_type=compression_type),
+                       cycle_length=min(len(files), self.flags_obj.input_shard_cycle_length),
+                       num_parallel_calls=tf.data.experimental.AUTOTUNE, deterministic=not training)
+    options = tf.data.Options()
+    options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.FILE
+    return ds.with_options(options)
+
+  def _create_tfrecord_dataset(self, data_file, batch_size, max_input_length, max_target_length, shuffle_seed=None, input_position=None):
     def _convert_proto_to_tensor(proto):
       X = tf.reshape(tf.io.parse_tensor(proto, tf.int32), shape=[-1, max_input_length + max_target_length])
       return X[:, :max_input_length], X[:, max_input_length:]
 
-    ds = tf.data.TFRecordDataset(data_file, compression_type='GZIP' if data_file.endswith('.gz') else None)
+    ds = self._create_record_dataset(data_file, training=True, shuffle_seed=shuffle_seed, input_position=input_position)
     ds = ds.map(_convert_proto_to_tensor, num_parallel_calls=tf.data.experimental.AUTOTUNE)
     ds = ds.unbatch().batch(batch_size, drop_remainder=True)
     return ds
@@ -580,7 +988,8 @@ class Seq2SeqTask():
   def _create_description_from_names(self, names):
       return {col: tf.io.FixedLenSequenceFeature([], tf.int64, allow_missing=True) for col in names}
 
-  def _create_tokenized_tfrecord_dataset(self, data_file, batch_size, max_input_length, max_target_length, url_segment_limit, hostname_segment_limit, html_segment_limit, eos):
+  def _create_tokenized_tfrecord_dataset(self, data_file, batch_size, max_input_length, max_target_length, url_segment_limit, hostname_segment_limit, html_segment_limit, eos, shuffle_seed=None,
+                                         input_position=None):
     description = self._create_description_from_names(['url', 'title', 'hostname', 'html'])
     def _tf_parse_and_truncate_v2(proto):
       ex = tf.io.parse_single_example(proto, description)
@@ -589,7 +998,7 @@ class Seq2SeqTask():
              tf.concat([[eos+3], tf.cast(ex['html'][:html_segment_limit-2], tf.int32), [eos]], axis=0),
              tf.concat([tf.cast(ex['title'], tf.int32), [eos]], axis=0) ]
 
-    ds = tf.data.TFRecordDataset(data_file, compression_type='GZIP' if data_file.endswith('.gz') else None)
+    ds = self._create_record_dataset(data_file, training=True, shuffle_seed=shuffle_seed, input_position=input_position)
     ds = ds.map(_tf_parse_and_truncate_v2, num_parallel_calls=tf.data.experimental.AUTOTUNE)
     ds = ds.filter(lambda _a, _b, _c, target: tf.size(target) <= max_target_length)
     ds = ds.padded_batch(batch_size, padded_shapes=([url_segment_limit], [hostname_segment_limit], [html_segment_limit], [max_target_length]), drop_remainder=True)
@@ -602,7 +1011,14 @@ class Seq2SeqTask():
     #targets_and_limits = [(v[0], int(v[1])) for v in [col.split(':') for col in target_schema.split(',')]]
     return inputs_and_limits, target_schema#targets_and_limits
 
-  def _create_dtitle_tokenized_dataset(self, data_file, batch_size, max_input_length, max_target_length, url_segment_limit, hostname_segment_limit, html_segment_limit, eos, training):
+  def _create_dtitle_tokenized_dataset(self, data_file, batch_size, max_input_length, max_target_length, url_segment_limit, hostname_segment_limit, html_segment_limit, eos, training, parse_batch_size=None,
+                                       shuffle_seed=None, input_position=None):
+    if parse_batch_size is None:
+      parse_batch_size = self.flags_obj.dtitle_parse_batch_size
+    if parse_batch_size:
+      return self._create_dtitle_tokenized_batch_dataset(data_file, batch_size, max_input_length, max_target_length, eos, training, parse_batch_size, shuffle_seed,
+                                                         input_position)
+
     description = self._create_description_from_names(self.flags_obj.dtitle_data_schema.split(','))
 
     names_limits, target_schema = self._get_training_schema()
@@ -633,7 +1049,7 @@ class Seq2SeqTask():
     #    else:
     #      return False
 
-    ds = tf.data.TFRecordDataset(data_file, compression_type='GZIP' if data_file.endswith('.gz') else None)
+    ds = self._create_record_dataset(data_file, training, shuffle_seed, input_position)
     ds = ds.map(_tf_parse_and_truncate_v3, num_parallel_calls=tf.data.experimental.AUTOTUNE)
     if training:
       ds = ds.filter(_filter_fn)
@@ -642,40 +1058,299 @@ class Seq2SeqTask():
     ds = ds.padded_batch(batch_size, padded_shapes=([max_input_length], [max_target_length]), drop_remainder=training)
     return ds
 
-  def _create_dataset(self, data_file, repeat, batch_size=None, shuffle_size=None, create_cache=False, training=True):
+  def _create_dtitle_tokenized_batch_dataset(self, data_file, batch_size, max_input_length, max_target_length, eos, training, parse_batch_size, shuffle_seed=None,
+                                             input_position=None):
+    """the same batches as _tf_parse_and_truncate_v3, protos are parsed by blocks into ragged tensors of the used columns only"""
+    names_limits, target_schema = self._get_training_schema()
+    columns = list(dict.fromkeys([name for name, _ in names_limits] + [target_schema]))
+    description = {col: tf.io.RaggedFeature(tf.int64, row_splits_dtype=tf.int64) for col in columns}
+
+    def _parse_block(protos):
+      ex = tf.io.parse_example(protos, description)
+      return self._create_inputs_and_target({col: tf.cast(ex[col], tf.int32) for col in columns}, names_limits, target_schema, eos, max_input_length, max_target_length, training)
+
+    ds = self._create_record_dataset(data_file, training, shuffle_seed, input_position)
+    ds = ds.batch(parse_batch_size)
+    ds = ds.map(_parse_block, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    ds = ds.unbatch().batch(batch_size, drop_remainder=training)
+    return ds
+
+  def _create_inputs_and_target(self, cols, names_limits, target_schema, eos, max_input_length, max_target_length, training):
+    """build padded (inputs, target) of a block from ragged columns, the same as _tf_parse_and_truncate_v3 on each row:
+    inputs are <BOS#i> column[:limit-2] <EOS#i> of columns in the training schema, truncated to max_input_length"""
+    row_count = cols[target_schema].nrows()
+    def _fill(value):
+      return tf.RaggedTensor.from_tensor(tf.fill([row_count, 1], value))
+    inputs = tf.concat([t for idx, (name, limit) in enumerate(names_limits) for t in [_fill(eos+idx+1), cols[name][:, :limit-2], _fill(eos+idx+11)]], axis=1)
+    target = tf.concat([cols[target_schema], _fill(eos)], axis=1)
+    if training:
+      kept = tf.where(target.row_lengths() <= max_target_length)[:, 0]
+      inputs, target = tf.gather(inputs, kept), tf.gather(target, kept)
+    else:
+      target = target[:, -1:]
+    # truncate and pad the whole block, instead of padded_batch on unbatched rows
+    return inputs.to_tensor(shape=[None, max_input_length]), target.to_tensor(shape=[None, max_target_length])
+
+  def _create_dtitle_columnar_dataset(self, data_file, batch_size, max_input_length, max_target_length, eos, training, block_size=1024, input_position=None):
+    """input_position: the rows are repeated, the first pass starts at the row of input_position, which then follows the row after
+    the last block read (see _resume_records)"""
+    names_limits, target_schema = self._get_training_schema()
+    columns = list(dict.fromkeys([name for name, _ in names_limits] + [target_schema]))
+    reader = ColumnarReader(data_file, columns)
+    first_row = 0 if input_position is None else int(input_position.numpy()) % max(len(reader), 1)
+    if first_row:
+      logging.info(f'resume the input at row {first_row}')
+
+    # blocks of rows as (end row, (tokens, row_lengths) of each column), sliced from memory-mapped arrays
+    def _generator():
+      row = first_row
+      while True:
+        for start in range(row, len(reader), block_size):
+          end = min(start + block_size, len(reader))
+          block = []
+          for col in columns:
+            tokens, row_lengths = reader.get_block(col, start, end)
+            block += [tokens.astype(np.int32), row_lengths]
+          yield (end,) + tuple(block)
+        if input_position is None or len(reader) == 0:
+          return
+        row = 0
+
+    def _block_to_inputs_and_target(*block):
+      cols = {col: tf.RaggedTensor.from_row_lengths(block[2*i], block[2*i+1]) for i, col in enumerate(columns)}
+      return self._create_inputs_and_target(cols, names_limits, target_schema, eos, max_input_length, max_target_length, training)
+
+    def _track(end, *block):
+      if input_position is None:
+        return block
+      with tf.control_dependencies([input_position.assign(end)]):
+        return tuple(tf.identity(col) for col in block)
+
+    ds = tf.data.Dataset.from_generator(_generator, output_signature=(tf.TensorSpec([], tf.int64),) + tuple(spec for _ in columns for spec in (tf.TensorSpec([None], tf.int32), tf.TensorSpec([None], tf.int64))))
+    ds = ds.map(_track)
+    ds = ds.map(_block_to_inputs_and_target, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    ds = ds.unbatch().batch(batch_size, drop_remainder=training)
+    return ds
+
+  def _shuffle_examples(self, ds, batch_size, shuffle_size, seed, training):
+    """shuffle the examples of padded batches by a buffer of shuffle_size examples and re-batch them,
+    the buffer is refilled in another order in each epoch"""
+    ds = ds.unbatch()
+    specs = tf.nest.flatten(ds.element_spec)
+    if all(spec.shape.is_fully_defined() for spec in specs):
+      example_bytes = sum(spec.shape.num_elements() * spec.dtype.size for spec in specs)
+      logging.info(f'shuffle examples by a buffer of {shuffle_size} examples * {example_bytes} bytes = {shuffle_size * example_bytes / 2**20:.1f}MB, seed = {seed}')
+    else:
+      logging.info(f'shuffle examples by a buffer of {shuffle_size} examples, seed = {seed}')
+    ds = ds.shuffle(shuffle_size, seed=seed, reshuffle_each_iteration=True)
+    return ds.batch(batch_size, drop_remainder=training)
+
+  def _trim_padding(self, inputs, target):
+    # only trailing zeros are paddings, zeros inside inputs (fixed positions of input_concat_schema v2) are kept
+    def _length(x):
+      return tf.reduce_max(tf.where(x != 0, tf.range(1, tf.size(x) + 1), 0))
+    return inputs[:_length(inputs)], target[:_length(target)]
+
+  def _pack_examples(self, ds, batch_size, max_input_length, max_target_length, max_segments, training):
+    """greedily pack up to max_segments consecutive examples into one row of [max_input_length] inputs and [max_target_length] targets,
+    returns batches of (inputs, targets, inputs_segmentation, inputs_position, targets_segmentation, targets_position),
+    segment ids start from 1 in each row (0 for paddings) and positions restart from 0 in each segment"""
+    def _pack(row, example):
+      inputs, target = [tf.cast(t, tf.int32) for t in example]
+      segment_count = tf.reduce_max(tf.concat([[0], row[2]], axis=0))
+      fits = ((tf.size(row[0]) + tf.size(inputs) <= max_input_length) & (tf.size(row[1]) + tf.size(target) <= max_target_length)
+              & (segment_count < max_segments))
+      def _append(segment_id, row):
+        return (tf.concat([row[0], inputs], axis=0), tf.concat([row[1], target], axis=0),
+                tf.concat([row[2], tf.fill(tf.shape(inputs), segment_id)], axis=0), tf.concat([row[3], tf.range(tf.size(inputs))], axis=0),
+                tf.concat([row[4], tf.fill(tf.shape(target), segment_id)], axis=0), tf.concat([row[5], tf.range(tf.size(target))], axis=0))
+      new_row = tf.cond(fits, lambda: _append(segment_count + 1, row), lambda: _append(1, empty_row))
+      lengths = [max_input_length, max_target_length, max_input_length, max_input_length, max_target_length, max_target_length]
+      padded_row = tuple(tf.pad(t, [[0, length - tf.size(t)]]) for t, length in zip(row, lengths))
+      return new_row, (tf.logical_not(fits) & (segment_count > 0), padded_row)
+
+    empty_row = tuple(tf.zeros([0], tf.int32) for _ in range(6))
+    ds = ds.unbatch()
+    ds = ds.map(self._trim_padding, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    # an example longer than max_input_length flushes the last row at the end of the dataset
+    ds = ds.concatenate(tf.data.Dataset.from_tensors((tf.zeros([max_input_length + 1], ds.element_spec[0].dtype), tf.zeros([0], ds.element_spec[1].dtype))))
+    ds = ds.apply(tf.data.experimental.scan(empty_row, _pack))
+    ds = ds.filter(lambda emit, row: emit)
+    ds = ds.map(lambda emit, row: row)
+    ds = ds.batch(batch_size, drop_remainder=training)
+    return ds
+
+  def _bucket_by_length(self, ds, max_input_length, batch_tokens, min_boundary=8, boundary_step=1.1):
+    """re-batch padded batches by input length, each batch holds up to batch_tokens input tokens (rows * padded length),
+    inputs and targets are padded to the longest ones in the batch instead of max_input_length/max_target_length"""
+    boundaries = []
+    boundary = min_boundary
+    while boundary < max_input_length:
+      boundaries.append(boundary)
+      boundary = max(boundary + 1, int(boundary * boundary_step))
+    # inputs of bucket i are shorter than boundaries[i], the last bucket holds inputs up to max_input_length
+    batch_sizes = [max(batch_tokens // length, 1) for length in boundaries + [max_input_length]]
+    logging.info(f'bucket inputs by length, boundaries = {boundaries}, batch sizes = {batch_sizes}')
+
+    ds = ds.unbatch()
+    ds = ds.map(self._trim_padding, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    ds = ds.apply(tf.data.experimental.bucket_by_sequence_length(lambda inputs, target: tf.size(inputs), boundaries, batch_sizes))
+    return ds
+
+  def _log_padding_ratio(self, ds, name, batch_count=64):
+    """log the ratio of padding tokens in the first batch_count batches of a dataset created by _create_dataset"""
+    batches, rows, tokens, padded = 0, 0, [0, 0], [0, 0]
+    for (inputs, target, *_), _ in ds.take(batch_count):
+      batches += 1
+      rows += inputs.shape[0]
+      for i, t in enumerate([inputs, target]):
+        tokens[i] += int(tf.math.count_nonzero(t))
+        padded[i] += int(tf.size(t))
+    batches = max(batches, 1)
+    logging.info(f'padding ratio of {name}: inputs {1 - tokens[0]/max(padded[0], 1):.2%}, targets {1 - tokens[1]/max(padded[1], 1):.2%}, '
+                 f'{rows/batches:.1f} rows and {padded[0]/batches:.0f} padded input tokens per batch in average')
+
+  def _get_dataset_cache_desc(self, data_file, batch_size, max_input_length, max_target_length, url_segment_limit, hostname_segment_limit, html_segment_limit, training):
+    """all the parameters which affect the tensors of parsed batches, the dataset cache is keyed by the hash of them"""
+    def _file_stats(path):
+      paths = [os.path.join(path, f) for f in sorted(os.listdir(path))] if os.path.isdir(path) else [path]
+      return [(os.path.abspath(p), os.path.getsize(p), os.path.getmtime(p)) for p in paths]
+    return {
+        'data_file': [stats for f in self._list_data_files(data_file) for stats in _file_stats(f)],
+        'vocab_file': _file_stats(f'{self.flags_obj.vocab_file}.subwords'),
+        'vocab_size': self.params['vocab_size'],
+        'eos': int(self.EOS_id),
+        'lengths': [batch_size, max_input_length, max_target_length, url_segment_limit, hostname_segment_limit, html_segment_limit],
+        'drop_remainder': training,
+        'training_schema': self.flags_obj.training_schema,
+        'dtitle_data_schema': self.flags_obj.dtitle_data_schema,
+        'input_concat_schema': self.flags_obj.input_concat_schema,
+    }
+
+  def _open_dataset_cache(self, ds, data_file, cache_desc, create_cache, training):
+    """replace ds by its cache when it's valid, the cache is a directory of GZIP compressed shards of parsed batches (tf.data.experimental.save)
+    and a meta.json of cache_desc and element_spec, which is written at last. create_cache writes the cache when it doesn't exist"""
+    key = hashlib.sha1(json.dumps(cache_desc, sort_keys=True).encode()).hexdigest()
+    first_file = self._list_data_files(data_file)[0].rstrip('/')
+    cache_dir = os.path.join(self.flags_obj.dataset_cache_dir or os.path.dirname(os.path.abspath(first_file)), f'{os.path.basename(first_file)}.cache-{key[:16]}')
+    meta_file = os.path.join(cache_dir, 'meta.json')
+    meta = {'desc': cache_desc, 'element_spec': str(ds.element_spec)}
+    if os.path.isfile(meta_file):
+      with open(meta_file) as fi:
+        cached_meta = json.load(fi)
+      if cached_meta['desc'] != json.loads(json.dumps(cache_desc)) or cached_meta['element_spec'] != meta['element_spec']:
+        logging.warning(f'ignore the dataset cache {cache_dir}, which is created by different parameters')
+        return ds
+    elif create_cache:
+      shard_count = self.flags_obj.dataset_cache_shards
+      tmp_dir = f'{cache_dir}.tmp{os.getpid()}'
+      logging.info(f'write the dataset cache into {cache_dir} in {shard_count} shards')
+      start_time = time.time()
+      try:
+        tf.data.experimental.save(ds.enumerate(), tmp_dir, compression='GZIP', shard_func=lambda index, _: index % shard_count)
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w') as fo:
+          json.dump(dict(meta, shard_count=shard_count), fo)
+        os.replace(tmp_dir, cache_dir)
+      finally:
+        if os.path.isdir(tmp_dir):
+          shutil.rmtree(tmp_dir)
+      logging.info(f'wrote the dataset cache in {time.time() - start_time:.1f} seconds')
+      with open(meta_file) as fi:
+        cached_meta = json.load(fi)
+    else:
+      return ds
+
+    logging.info(f'open the dataset cache {cache_dir}')
+    # batch i is written into the shard i % shard_count, a deterministic round-robin interleave of the shards restores the order
+    shard_count = cached_meta['shard_count']
+    reader_func = lambda shards: shards.interleave(lambda shard: shard, cycle_length=shard_count, num_parallel_calls=tf.data.experimental.AUTOTUNE, deterministic=not training)
+    ds = tf.data.experimental.load(cache_dir, (tf.TensorSpec([], tf.int64), ds.element_spec), compression='GZIP', reader_func=reader_func)
+    return ds.map(lambda index, batch: batch)
+
+  def _create_dataset(self, data_file, repeat, batch_size=None, shuffle_size=None, create_cache=False, training=True, batch_tokens=None, pack_examples=0, shuffle_seed=None,
+                      input_position=None):
+    """input_position: a tf.Variable of the position in the records of a repeated training input, saved with the model, the records
+      before it are skipped unparsed (the columnar format seeks to the row) and it follows the records read (see _resume_records),
+      the shards of a multi-shard input and dataset caches are read in a random order and are reseeded by shuffle_seed instead
+    shuffle_seed: seed of the example shuffle and the order of shards in training
+    shuffle_size: shuffle examples before batching by a buffer of shuffle_size examples (see _shuffle_examples)
+    batch_tokens: bucket training batches by input length with this token budget (see _bucket_by_length), flags_obj.batch_tokens when None
+    pack_examples: pack up to pack_examples examples into one row (see _pack_examples), the features are
+      (inputs, targets, inputs_segmentation, inputs_position, targets_segmentation, targets_position) instead of (inputs, targets)"""
     batch_size = batch_size or self.params['batch_size']
     max_input_length = self.params['max_input_length']
     max_target_length = self.params['max_target_length']
     url_segment_limit = 64 # max url length
     hostname_segment_limit = 64 # max hostname length
     html_segment_limit = max_input_length - url_segment_limit - hostname_segment_limit # max html length
+    batch_tokens = self.flags_obj.batch_tokens if batch_tokens is None else batch_tokens
+    if data_file.endswith(('.dtitle', '.dtitle.gz', '.dtitle.columnar')) and any(c in data_file for c in '*?[,'):
+      raise ValueError(f'globs and lists of files are only supported by the TFRecord formats (.tfrecord, .tokenized-tfrecord and '
+                       f'.dtitle.tokenized), {data_file} must be one file')
+    if input_position is not None and not (training and repeat is None and data_file != '__random_input__' and len(self._list_data_files(data_file)) == 1):
+      if int(input_position.numpy()):
+        logging.info(f'the order of shards is not deterministic, reseed it by shuffle_seed {shuffle_seed} instead of resuming the input')
+      input_position.assign(0)
+      input_position = None
 
     if data_file == '__random_input__':
       logging.info(f'open one random dataset.')
       ds = self._create_random_dataset(self.params["vocab_size"], batch_size, max_input_length, max_target_length)
     elif data_file.endswith('.dtitle') or data_file.endswith('.dtitle.gz'):
       logging.info(f'open one dtitle dataset from "{data_file}".')
-      ds = self._create_dtitle_dataset(data_file, batch_size, max_input_length, max_target_length, url_segment_limit, hostname_segment_limit, html_segment_limit, self.EOS_id)
+      ds = self._create_dtitle_dataset(data_file, batch_size, max_input_length, max_target_length, url_segment_limit, hostname_segment_limit, html_segment_limit, self.EOS_id,
+                                       input_position)
     elif data_file.endswith('.tfrecord') or data_file.endswith('.tfrecord.gz'):
       logging.info(f'open one tfrecord dataset from "{data_file}".')
-      ds = self._create_tfrecord_dataset(data_file, batch_size, max_input_length, max_target_length)
+      ds = self._create_tfrecord_dataset(data_file, batch_size, max_input_length, max_target_length, shuffle_seed, input_position)
     elif data_file.endswith('.tokenized-tfrecord') or data_file.endswith('.tokenized-tfrecord.gz'):
       logging.info(f'open one tokenized-tfrecord dataset from "{data_file}".')
-      ds = self._create_tokenized_tfrecord_dataset(data_file, batch_size, max_input_length, max_target_length, url_segment_limit, hostname_segment_limit, html_segment_limit, self.EOS_id)
+      ds = self._create_tokenized_tfrecord_dataset(data_file, batch_size, max_input_length, max_target_length, url_segment_limit, hostname_segment_limit, html_segment_limit, self.EOS_id,
+                                                   shuffle_seed, input_position)
     elif data_file.endswith('.dtitle.tokenized') or data_file.endswith('.dtitle.tokenized.gz'):
       logging.info(f'open one dtitle-tokenized dataset from "{data_file}".')
-      ds = self._create_dtitle_tokenized_dataset(data_file, batch_size, max_input_length, max_target_length, url_segment_limit, hostname_segment_limit, html_segment_limit, self.EOS_id, training=training)
+      ds = self._create_dtitle_tokenized_dataset(data_file, batch_size, max_input_length, max_target_length, url_segment_limit, hostname_segment_limit, html_segment_limit, self.EOS_id, training=training,
+                                                 shuffle_seed=shuffle_seed, input_position=input_position)
+    elif data_file.endswith('.dtitle.columnar'):
+      logging.info(f'open one dtitle-columnar dataset from "{data_file}".')
+      ds = self._create_dtitle_columnar_dataset(data_file, batch_size, max_input_length, max_target_length, self.EOS_id, training=training, input_position=input_position)
     else:
       raise ValueError(f'invalid input file format: {data_file}')
 
-    cache_desc = f'{data_file}.{batch_size}_{max_input_length}_{max_target_length}_{url_segment_limit}_{hostname_segment_limit}.cache'
-    if create_cache or os.path.isfile(f'{cache_desc}.index'):
-      ds = ds.cache(cache_desc)
+    if data_file != '__random_input__':
+      cache_desc = self._get_dataset_cache_desc(data_file, batch_size, max_input_length, max_target_length, url_segment_limit, hostname_segment_limit, html_segment_limit, training)
+      # a cache of the repeated passes of a resumed input can't be written
+      cached_ds = self._open_dataset_cache(ds, data_file, cache_desc, create_cache and input_position is None, training)
+      if cached_ds is not ds and input_position is not None:
+        # the shards of a dataset cache are read in a random order too
+        if int(input_position.numpy()):
+          logging.info(f'the order of cached shards is not deterministic, reseed it by shuffle_seed {shuffle_seed} instead of resuming the input')
+        input_position.assign(0)
+      ds = cached_ds
+    if shuffle_size:
+      ds = self._shuffle_examples(ds, batch_size, shuffle_size, shuffle_seed, training)
+    if training and batch_tokens:
+      if self.flags_obj.use_reformer:
+        raise ValueError('batch_tokens is not supported by reformer, whose input length is static')
+      ds = self._bucket_by_length(ds, max_input_length, batch_tokens)
+    if pack_examples:
+      if self.flags_obj.use_reformer:
+        raise ValueError('pack_examples is not supported by reformer')
+      if batch_tokens:
+        raise ValueError('batch_tokens and pack_examples can not be used together')
+      ds = self._pack_examples(ds, batch_size, max_input_length, max_target_length, pack_examples, training)
     if repeat != 1:
       ds = ds.repeat(repeat)
-    if shuffle_size:
-      ds = ds.shuffle(shuffle_size // batch_size)
-    ds = ds.map(lambda x, y: ((x, y), y))
+    # every source format gives batches of (inputs, targets), _pack_examples adds the segment ids and positions
+    feature_count = len(ds.element_spec) if isinstance(ds.element_spec, tuple) else 1
+    if feature_count != (6 if pack_examples else 2):
+      raise ValueError(f'batches of {data_file} have {feature_count} features, (inputs, targets) are expected'
+                       + (' with the segment ids and positions of packed examples' if pack_examples else ''))
+    if pack_examples:
+      ds = ds.map(lambda inputs, targets, inputs_segmentation, inputs_position, targets_segmentation, targets_position:
+                  ((inputs, targets, inputs_segmentation, inputs_position, targets_segmentation, targets_position), targets))
+    else:
+      ds = ds.map(lambda inputs, targets: ((inputs, targets), targets))
     ds = ds.prefetch(tf.data.experimental.AUTOTUNE)
 
     return ds
@@ -732,25 +1407,9 @@ def test_read_and_dump_datasets(task):
     _dump_to_file(f'out-dtitle-tokenized-gz-{idx}.batch{bc}', task.params['data_dir'], batch_count=bc, decode_fn=task._trim_and_decode, repeat=repeat_times)
 
 
-def count_token_id_freq(task):
-  from collections import Counter
-  ds = task._create_dataset(task.params['data_dir'], repeat=1)
-  freq = Counter()
-  for batch, ((inp, tar), _) in enumerate(ds):
-    if batch % (1024) == 0:
-      print(f'batch = {batch//1024}K')
-    for inp1, tar1 in zip(inp, tar):
-      #freq.update(inp1.numpy())
-      freq.update(tar1.numpy())
-  print(f'batch = {batch}')
-  with open('token_id_freq.txt', 'w') as ow:
-    for key, value in freq.items():
-      ow.write(f'{key}\t{value}\n')
-
-
 def test(task):
+  # token frequencies and length stats: process_dtitle_data.py --cmd=check-stats
   test_read_and_dump_datasets(task)
-  #count_token_id_freq(task)
 
 def main(_):
   flags_obj = flags.FLAGS
@@ -758,6 +1417,7 @@ def main(_):
   if flags_obj.mode == "train":
     task.train()
   elif flags_obj.mode == "train-cache":
+    # write the dataset cache, then read it back to check it
     ds = task._create_dataset(task.params['data_dir'], repeat=1, create_cache=True)
     for idx, ((inp, tar), _) in enumerate(ds):
       if idx % 1024 == 0:
@@ -770,8 +1430,16 @@ def main(_):
     task.predict()
   elif flags_obj.mode == "predict-express":
     task.predict_express()
+  elif flags_obj.mode == "predict-driver":
+    task.predict_driver()
   elif flags_obj.mode == "eval":
     task.eval()
+  elif flags_obj.mode == 'bench-parse':
+    task.bench_parse()
+  elif flags_obj.mode == 'bench-input':
+    task.bench_input()
+  elif flags_obj.mode == 'bench-decode':
+    task.bench_decode()
   elif flags_obj.mode == 'test':
     test(task)
   else:
@@ -24,6 +24,8 @@ from absl import flags
 from official.nlp.transformer import model_params
 from official.utils.flags import core as flags_core
 
+import decoding
+
 FLAGS = flags.FLAGS
 
 TRIAL_PARAMS = model_params.BASE_PARAMS.copy()
@@ -223,6 +225,110 @@ def define_transformer_flags():
           'v2: concatenated and padded (url, hostname, html); '
           'v3: padded (url, hostname, html)'))
 
+  flags.DEFINE_enum(
+      name='dtitle_tokenizer', default='graph', enum_values=['graph', 'py_function'],
+      help=flags_core.help_wrap(
+          'tokenizer of .dtitle datasets. graph: TFSubwordEncoder built of TF ops, which fails on lines with \\x00 or \\x01; '
+          'py_function: SubwordTrieEncoder in tf.py_function, which holds the GIL'))
+
+  flags.DEFINE_integer(
+      name='dtitle_parse_batch_size', default=1024,
+      help=flags_core.help_wrap(
+          'protos of .dtitle.tokenized datasets are parsed in blocks of this size by tf.io.parse_example, '
+          'parse each proto by tf.io.parse_single_example when 0'))
+
+  flags.DEFINE_integer(
+      name='batch_tokens', default=0,
+      help=flags_core.help_wrap(
+          'when > 0, training examples are bucketed by input length and each batch holds up to '
+          'batch_tokens input tokens (rows * padded length) instead of batch_size rows. transformer only'))
+
+  flags.DEFINE_list(
+      name='bench_input_files', default=None,
+      help=flags_core.help_wrap(
+          'data files of --mode=bench-input, e.g. x.dtitle.gz,x.tfrecord.gz,x.dtitle.tokenized.gz,__random_input__. '
+          'data_dir when empty'))
+  flags.DEFINE_integer(
+      name='bench_batches', default=200,
+      help=flags_core.help_wrap('number of batches read from each data file by --mode=bench-input'))
+  flags.DEFINE_integer(
+      name='bench_model_steps', default=0,
+      help=flags_core.help_wrap(
+          'when > 0, --mode=bench-input measures the model step time by bench_model_steps steps on __random_input__, '
+          'and reports how long the model would wait for each input pipeline'))
+
+  flags.DEFINE_integer(
+      name='predict_queue_size', default=8,
+      help=flags_core.help_wrap('batches of predictions buffered for the writer thread of --mode=predict-express'))
+  flags.DEFINE_string(
+      name='prediction_split_files', default=None,
+      help=flags_core.help_wrap(
+          'splits of --mode=predict-driver, a glob or a comma separated list, e.g. pred/split-*.raw.gz. '
+          'they are tokenized by prediction_tokenize_cmd, or read as data files when it is None'))
+  flags.DEFINE_string(
+      name='prediction_tokenize_cmd', default=None,
+      help=flags_core.help_wrap(
+          'shell command of --mode=predict-driver to tokenize a split, {input} and {output} are replaced by the paths of '
+          'the split and its .test.dtitle.tokenized.gz, e.g. make -C data_dtitle {output} TEST_DATA={input} TAG=x'))
+  flags.DEFINE_string(
+      name='prediction_cache_file', default=None,
+      help=flags_core.help_wrap(
+          'sqlite file of the prediction cache of --mode=predict-express and predict-driver, keyed by the checkpoint and the input ids, '
+          'the cached inputs are not predicted again, disabled when None'))
+  flags.DEFINE_enum(
+      name='decode_strategy', default='beam', enum_values=decoding.DECODE_STRATEGIES,
+      help=flags_core.help_wrap(
+          'decoding of the predict modes. beam: beam search to max_target_length; beam_early_exit: beam search which finishes '
+          'sequences at EOS; greedy: the max logit; top_k: sampling from the top decode_top_k tokens. '
+          'greedy and top_k drop finished rows from the batch, see decoding.py'))
+  flags.DEFINE_integer(
+      name='decode_top_k', default=4,
+      help=flags_core.help_wrap('number of tokens to sample from at each step of --decode_strategy=top_k'))
+  flags.DEFINE_list(
+      name='bench_decode_strategies', default=decoding.DECODE_STRATEGIES,
+      help=flags_core.help_wrap(
+          'decode strategies compared by --mode=bench-decode, on the first bench_batches batches of data_dir'))
+  flags.DEFINE_integer(
+      name='predict_workers', default=1,
+      help=flags_core.help_wrap('model replicas of --mode=predict-driver when there is no GPU, one replica per GPU otherwise. '
+                                'replicas are threads sharing the GIL for postprocessing, see predict_driver'))
+  flags.DEFINE_bool(
+      name='resume_input', default=True,
+      help=flags_core.help_wrap(
+          'when training restarts from a checkpoint, a single-file data_dir continues at the input position saved in the checkpoint, '
+          'the records before it are skipped unparsed and a .dtitle.columnar data_dir seeks to the row. '
+          'multi-shard inputs and dataset caches are reseeded by shuffle_seed instead. disable it when data_dir is changed'))
+  flags.DEFINE_integer(
+      name='shuffle_buffer_size', default=0,
+      help=flags_core.help_wrap(
+          'when > 0, training examples are shuffled before batching by a buffer of shuffle_buffer_size examples, '
+          'whose memory is logged, e.g. 1M examples of max_input_length=128 and max_target_length=16 take 549MB'))
+  flags.DEFINE_integer(
+      name='shuffle_seed', default=0,
+      help=flags_core.help_wrap(
+          'seed of the training shuffle, it is added by the global step of the restored checkpoint, '
+          'so a restarted training reads the examples in a new order'))
+
+  flags.DEFINE_integer(
+      name='input_shard_cycle_length', default=16,
+      help=flags_core.help_wrap(
+          'number of shards read concurrently when data_dir is a glob or a comma separated list of TFRecord shards'))
+
+  flags.DEFINE_string(
+      name='dataset_cache_dir', default='',
+      help=flags_core.help_wrap(
+          'directory of dataset caches written by --mode=train-cache, the directory of data_dir when empty. '
+          'caches are keyed by the hash of all the parameters which affect the parsed batches'))
+  flags.DEFINE_integer(
+      name='dataset_cache_shards', default=8,
+      help=flags_core.help_wrap('number of GZIP compressed shards of a dataset cache, which are read in parallel'))
+
+  flags.DEFINE_integer(
+      name='pack_examples', default=0,
+      help=flags_core.help_wrap(
+          'when > 0, up to pack_examples consecutive training examples are packed into one row of '
+          'max_input_length/max_target_length, attentions across them are masked by segment ids. transformer only'))
+
   flags.DEFINE_bool(
       name='compact_predict_result', default=False,
       help=flags_core.help_wrap('Whether dump predict result as a TSV'))
@@ -277,7 +383,8 @@ def define_transformer_flags():
 
   flags.DEFINE_string(
       name='val_data_dir', default=None,
-      help=flags_core.help_wrap('validation data file used in training. If None, then try to find matching test file based on data_dir'))
+      help=flags_core.help_wrap('validation data file used in training. If None, then try to find matching test file based on data_dir, '
+                                'which must be one file. required when data_dir is a glob or a list of files'))
 
   flags.DEFINE_float(
       name='one_dropout', default=None,
@@ -0,0 +1,58 @@
+"""Persistent cache of compact predictions, keyed by the content of the model inputs.
+
+A key is the sha1 of the model key (the checkpoint and the parameters changing the predictions) and the input ids of
+one example, so recurring inputs of daily prediction jobs skip the decoding, and a new checkpoint never hits the
+predictions of an old one. Entries are rows of a sqlite table, shared by the threads of one process and by processes.
+"""
+
+import sqlite3
+import hashlib
+import threading
+
+import numpy as np
+
+
+# sqlite limits the number of host parameters of one statement
+_MAX_QUERY_KEYS = 500
+
+class PredictionCache():
+  def __init__(self, path, model_key):
+    self.path = path
+    self._model_key = hashlib.sha1(model_key.encode()).digest()
+    self._lock = threading.Lock()
+    self._conn = sqlite3.connect(path, timeout=600, check_same_thread=False)
+    self._conn.execute('CREATE TABLE IF NOT EXISTS predictions (key BLOB PRIMARY KEY, predict TEXT, null_prob TEXT)')
+    self._conn.commit()
+    self.hits, self.lookups = 0, 0
+
+  def keys(self, input_ids):
+    """keys of the rows of input_ids[batch, length]"""
+    input_ids = np.asarray(input_ids, dtype='<i4')
+    return [hashlib.sha1(self._model_key + ids.tobytes()).digest() for ids in input_ids]
+
+  def get(self, keys):
+    """return {key: (predict, null_prob)} of the cached keys"""
+    unique_keys = list(dict.fromkeys(keys))
+    cached = {}
+    with self._lock:
+      for start in range(0, len(unique_keys), _MAX_QUERY_KEYS):
+        chunk = unique_keys[start:start + _MAX_QUERY_KEYS]
+        rows = self._conn.execute(f'SELECT key, predict, null_prob FROM predictions WHERE key IN ({",".join("?" * len(chunk))})', chunk)
+        cached.update((key, (predict, null_prob)) for key, predict, null_prob in rows)
+      self.lookups += len(keys)
+      self.hits += sum(key in cached for key in keys)
+    return cached
+
+  def put(self, predictions):
+    """predictions is {key: (predict, null_prob)}"""
+    with self._lock:
+      self._conn.executemany('INSERT OR REPLACE INTO predictions VALUES (?, ?, ?)',
+                             [(key, predict, null_prob) for key, (predict, null_prob) in predictions.items()])
+      self._conn.commit()
+
+  def close(self):
+    with self._lock:
+      self._conn.close()
+
+  def format_stats(self):
+    return f'prediction cache {self.path}: {self.hits} hit(s) of {self.lookups} lookup(s), hit rate {self.hits/max(self.lookups, 1):.1%}'
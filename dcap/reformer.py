@@ -9,10 +9,10 @@ import tensorflow as tf
 
 import utils as model_utils
 import attention_layer
-from official.nlp.modeling.ops import beam_search
 from official.nlp.transformer import embedding_layer
 from official.nlp.transformer import ffn_layer
 import metrics
+import decoding
 
 
 flags.DEFINE_enum('positional_encoding_strategy', 'default',
@@ -41,13 +41,10 @@ def create_model(params, mode):
       return model
     else:
       inputs = tf.keras.layers.Input((input_len,), dtype="int32", name="inputs")
-      targets = tf.keras.layers.Input((None,), dtype="int32", name="targets")
       internal_model = Reformer(params, name="reformer")
       ret = internal_model([inputs], training=False)
-      logits = internal_model([inputs, targets], training=False)
-      null_logit = tf.nn.softmax(logits[0])[1]
-      outputs, scores = ret["outputs"], ret["scores"]
-      return tf.keras.Model([inputs, targets], [inputs, outputs, scores, null_logit])
+      outputs, scores, null_probs = ret["outputs"], ret["scores"], ret["null_probs"]
+      return tf.keras.Model(inputs, [inputs, outputs, scores, null_probs])
 
 
 class Reformer(tf.keras.Model):
@@ -98,7 +95,9 @@ class Reformer(tf.keras.Model):
       If target is none, then generate output sequence one token at a time.
         returns a dictionary {
           outputs: [batch_size, decoded length]
-          scores: [batch_size, float]}
+          scores: [batch_size, float]
+          null_probs: [batch_size, float], probability of the null title
+            (id 1) at the first decoding step}
       Even when float16 is used, the output tensor(s) are always float32.
 
     Raises:
@@ -320,24 +319,19 @@ class Reformer(tf.keras.Model):
     cache["encoder_outputs"] = encoder_outputs
     cache["encoder_decoder_attention_bias"] = encoder_decoder_attention_bias
 
-    # Use beam search to find the top beam_size sequences and scores.
-    decoded_ids, scores = beam_search.sequence_beam_search(
-        symbols_to_logits_fn=symbols_to_logits_fn,
-        initial_ids=initial_ids,
-        initial_cache=cache,
-        vocab_size=self.params["vocab_size"],
-        beam_size=self.params["beam_size"],
-        alpha=self.params["alpha"],
-        max_decode_length=max_decode_length,
-        eos_id=self.params["vocab_size"] + 1,  # EOS_ID,
-        padded_decode=self.params["padded_decode"],
-        dtype=self.params["dtype"])
-
-    # Get the top sequence for each batch element
-    top_decoded_ids = decoded_ids[:, 0, 1:]
-    top_scores = scores[:, 0]
-
-    return {"outputs": top_decoded_ids, "scores": top_scores}
+    # The first decoding step on a copy of the cache, its logits are the same
+    # as the first step of decoding, which are not returned by it.
+    first_logits, _ = symbols_to_logits_fn(
+        initial_ids[:, None], 0, tf.nest.map_structure(tf.identity, cache))
+    null_probs = tf.nn.softmax(tf.cast(first_logits, tf.float32))[:, 1]
+
+    # Decode by params["decode_strategy"], beam search by default.
+    top_decoded_ids, top_scores = decoding.decode(
+        symbols_to_logits_fn, initial_ids, cache, self.params,
+        max_decode_length)
+
+    return {"outputs": top_decoded_ids, "scores": top_scores,
+            "null_probs": null_probs}
 
 
 class LayerNormalization(tf.keras.layers.Layer):
@@ -0,0 +1,6 @@
+"""dcap modules are imported as top-level modules, the same as running dtitle.py in dcap"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,109 @@
+import numpy as np
+import pytest
+import tensorflow as tf
+
+pytest.importorskip('official.nlp.modeling.ops.beam_search')
+import decoding
+
+_BATCH_SIZE, _VOCAB_SIZE, _MAX_DECODE_LENGTH, _EOS_ID = 5, 7, 6, 1
+# row b generates EOS at step _STOPS[b], the last row never stops
+_STOPS = [0, 3, 1, 9, 2]
+
+
+def _symbols_to_logits_fn(ids, i, cache):
+  """a toy decoder whose next token depends on the last id and the cached keys of the row, which grow by one per step"""
+  stops = cache['encoder_outputs'][:, 0]
+  cache['layer_0']['k'] = tf.concat([cache['layer_0']['k'], stops[:, None, None]], axis=1)
+  token = 2 + tf.cast(tf.math.floormod(tf.reduce_sum(cache['layer_0']['k'], axis=[1, 2]) + tf.cast(ids[:, -1], tf.float32), 5), tf.int32)
+  token = tf.where(tf.cast(i, tf.float32) >= stops, _EOS_ID, token)
+  return tf.one_hot(token, _VOCAB_SIZE) * 5.0, cache
+
+
+def _initial_cache():
+  return {'layer_0': {'k': tf.zeros([_BATCH_SIZE, 0, 1])},
+          'encoder_outputs': tf.constant(_STOPS, tf.float32)[:, None]}
+
+
+def _reference_ids():
+  """the ids of _symbols_to_logits_fn decoded row by row in python, padded by 0 after EOS"""
+  ids = np.zeros([_BATCH_SIZE, _MAX_DECODE_LENGTH], np.int32)
+  for row, stop in enumerate(_STOPS):
+    last = 0
+    for i in range(_MAX_DECODE_LENGTH):
+      last = ids[row, i] = _EOS_ID if i >= stop else 2 + int((stop * (i + 1) + last) % 5)
+      if last == _EOS_ID:
+        break
+  return ids
+
+
+def _decode(strategy, **kwargs):
+  params = dict(decode_strategy=strategy, eos_id=_EOS_ID, vocab_size=_VOCAB_SIZE, beam_size=1, alpha=0.6,
+                decode_top_k=1, padded_decode=False, dtype=tf.float32)
+  params.update(kwargs)
+  return tf.function(lambda cache: decoding.decode(_symbols_to_logits_fn, tf.zeros([_BATCH_SIZE], tf.int32), cache,
+                                                   params, _MAX_DECODE_LENGTH))(_initial_cache())
+
+
+def test_compacted_greedy_search_is_the_same_as_row_by_row_decoding():
+  ids, scores = _decode('greedy')
+  np.testing.assert_array_equal(ids.numpy(), _reference_ids())
+  assert scores.shape == [_BATCH_SIZE]
+
+
+def test_greedy_is_the_same_as_beam_search_of_one_beam():
+  beam_ids, beam_scores = _decode('beam_early_exit')
+  # the ids of beam_early_exit are padded to _MAX_DECODE_LENGTH too, so the batches of predict are concatenated
+  assert beam_ids.shape == (_BATCH_SIZE, _MAX_DECODE_LENGTH)
+  greedy_ids, greedy_scores = _decode('greedy')
+  np.testing.assert_array_equal(beam_ids.numpy(), greedy_ids.numpy())
+  np.testing.assert_allclose(beam_scores.numpy(), greedy_scores.numpy(), rtol=1e-5)
+
+
+def test_scores_are_normalized_by_the_length_penalty():
+  ids = _reference_ids()
+  log_prob = 5.0 - np.log(np.exp(5.0) + _VOCAB_SIZE - 1)
+  lengths = np.array([np.flatnonzero(row == _EOS_ID)[0] + 1 if (row == _EOS_ID).any() else _MAX_DECODE_LENGTH for row in ids])
+  expected = log_prob * lengths / ((5.0 + lengths) / 6.0) ** 0.6
+  for strategy in ['greedy', 'beam_early_exit']:
+    np.testing.assert_allclose(_decode(strategy)[1].numpy(), expected, rtol=1e-5)
+  # beam never finishes a sequence, EOS is decoded as a token, so every row is normalized by _MAX_DECODE_LENGTH
+  beam_ids, beam_scores = _decode('beam')
+  assert beam_ids.shape == (_BATCH_SIZE, _MAX_DECODE_LENGTH)
+  np.testing.assert_allclose(beam_scores.numpy(), [expected[3]] * _BATCH_SIZE, rtol=1e-5)
+
+
+@pytest.mark.parametrize('strategy, compacted', [('greedy', True), ('beam_early_exit', False)])
+def test_only_sampling_search_compacts_finished_rows(strategy, compacted):
+  batch_sizes = []
+
+  def _recording_symbols_to_logits_fn(ids, i, cache):
+    tf.py_function(lambda size: batch_sizes.append(int(size)), [tf.shape(ids)[0]], [])
+    return _symbols_to_logits_fn(ids, i, cache)
+
+  params = dict(decode_strategy=strategy, eos_id=_EOS_ID, vocab_size=_VOCAB_SIZE, beam_size=1, alpha=0.6,
+                decode_top_k=1, padded_decode=False, dtype=tf.float32)
+  tf.function(lambda cache: decoding.decode(_recording_symbols_to_logits_fn, tf.zeros([_BATCH_SIZE], tf.int32), cache,
+                                            params, _MAX_DECODE_LENGTH))(_initial_cache())
+  assert batch_sizes[0] == _BATCH_SIZE
+  # row 0 finishes at the first step, row 3 never does
+  assert (batch_sizes[-1] < _BATCH_SIZE) == compacted
+
+
+def test_top_k_of_one_token_is_greedy():
+  np.testing.assert_array_equal(_decode('top_k', decode_top_k=1)[0].numpy(), _reference_ids())
+
+
+def test_top_k_pads_rows_after_eos():
+  tf.random.set_seed(1)
+  ids = _decode('top_k', decode_top_k=3)[0].numpy()
+  assert ids.shape == (_BATCH_SIZE, _MAX_DECODE_LENGTH)
+  for row in ids:
+    eos = np.flatnonzero(row == _EOS_ID)
+    assert len(eos) or (row != 0).all()
+    if len(eos):
+      assert (row[eos[0] + 1:] == 0).all()
+
+
+def test_invalid_strategy():
+  with pytest.raises(ValueError):
+    _decode('sample')
@@ -0,0 +1,187 @@
+import types
+
+import numpy as np
+import pytest
+import tensorflow as tf
+
+pytest.importorskip('official.nlp.transformer')
+import dtitle
+from data_dtitle.columnar import ColumnarWriter
+
+_EOS_ID = 1
+_MAX_INPUT_LENGTH, _MAX_TARGET_LENGTH = 12, 5
+_COLUMNS = ['url', 'hostname', 'html', 'title']
+# rows of (url, hostname, html, title), rows 2 and 5 have too long targets
+_ROWS = [([30, 31], [40], [50, 51, 52], [60, 61]), ([32, 33, 34, 35, 36, 37], [41], [], [62]),
+         ([38], [42, 43], [53] * 9, [63, 64, 65, 66, 67]), ([], [], [54], [68, 69]),
+         ([39, 30], [44], [55, 56], []), ([31], [45], [57], [70, 71, 72, 73, 77]),
+         ([32], [46], [58, 59], [74, 75, 76])] * 3
+
+
+@pytest.fixture
+def task():
+  """a Seq2SeqTask with the flags of the dataset methods only, without a model"""
+  task = dtitle.Seq2SeqTask.__new__(dtitle.Seq2SeqTask)
+  task.flags_obj = types.SimpleNamespace(training_schema='url:6,html:8=>title', max_input_length=_MAX_INPUT_LENGTH,
+                                         dtitle_data_schema=','.join(_COLUMNS), dtitle_parse_batch_size=0, input_shard_cycle_length=4)
+  return task
+
+
+def _to_lists(ds):
+  return [[t.numpy().tolist() for t in tf.nest.flatten(batch)] for batch in ds]
+
+
+def _write_tokenized(data_file, rows):
+  with tf.io.TFRecordWriter(data_file) as writer:
+    for row in rows:
+      features = {col: tf.train.Feature(int64_list=tf.train.Int64List(value=ids)) for col, ids in zip(_COLUMNS, row)}
+      writer.write(tf.train.Example(features=tf.train.Features(feature=features)).SerializeToString())
+
+
+def _write_columnar(data_file, rows):
+  columns = ['url', 'html', 'title']
+  with ColumnarWriter(data_file, columns, 100) as writer:
+    cells = [dict(zip(_COLUMNS, row)) for row in rows]
+    lengths = np.array([[len(cell[col]) for col in columns] for cell in cells], np.int64)
+    writer.write_block(lengths, np.array([t for cell in cells for col in columns for t in cell[col]], np.int32))
+
+
+def test_batched_parse_is_the_same_as_per_example_parse(task, tmp_path):
+  data_file = str(tmp_path / 'data.dtitle.tokenized')
+  _write_tokenized(data_file, _ROWS)
+  for training in [True, False]:
+    def _create(parse_batch_size):
+      return task._create_dtitle_tokenized_dataset(data_file, 4, _MAX_INPUT_LENGTH, _MAX_TARGET_LENGTH, 64, 64, _MAX_INPUT_LENGTH - 128, _EOS_ID,
+                                                   training, parse_batch_size=parse_batch_size)
+    expected = _to_lists(_create(0))
+    assert len(expected) == (15 // 4 if training else 6)
+    for parse_batch_size in [1, 3, 64]:
+      assert _to_lists(_create(parse_batch_size)) == expected
+
+
+def test_pack_examples_keeps_every_example(task):
+  examples = [([5, 6, 7], [8, 1]), ([9] * _MAX_INPUT_LENGTH, [10, 1]), ([11, 0, 12], [13, 14, 1]), ([15], [1]),
+              ([16, 17], [18, 19, 20, 1]), ([21], [22, 1]), ([23], [24, 1]), ([25, 26], [1])]
+  inputs = np.array([ids + [0] * (_MAX_INPUT_LENGTH - len(ids)) for ids, _ in examples], np.int32)
+  targets = np.array([ids + [0] * (_MAX_TARGET_LENGTH - len(ids)) for _, ids in examples], np.int32)
+  ds = tf.data.Dataset.from_tensor_slices((inputs, targets)).batch(3)
+  packed = task._pack_examples(ds, 2, _MAX_INPUT_LENGTH, _MAX_TARGET_LENGTH, 3, training=False)
+
+  unpacked = []
+  for batch in packed:
+    for packed_inputs, packed_targets, inputs_segmentation, inputs_position, targets_segmentation, targets_position in zip(*[t.numpy() for t in batch]):
+      assert packed_inputs.shape == (_MAX_INPUT_LENGTH,) and packed_targets.shape == (_MAX_TARGET_LENGTH,)
+      assert 1 <= inputs_segmentation.max() <= 3
+      for segment in range(1, inputs_segmentation.max() + 1):
+        in_segment, target_in_segment = inputs_segmentation == segment, targets_segmentation == segment
+        assert inputs_position[in_segment].tolist() == list(range(in_segment.sum()))
+        assert targets_position[target_in_segment].tolist() == list(range(target_in_segment.sum()))
+        unpacked.append((packed_inputs[in_segment].tolist(), packed_targets[target_in_segment].tolist()))
+      # paddings are zeros of segment 0
+      assert not packed_inputs[inputs_segmentation == 0].any() and not packed_targets[targets_segmentation == 0].any()
+  assert unpacked == examples
+
+
+@pytest.mark.parametrize('suffix', ['.dtitle.tokenized', '.dtitle.columnar'])
+@pytest.mark.parametrize('position', [0, 1, 6, 20])
+def test_resumed_input_starts_at_the_saved_position(task, tmp_path, suffix, position):
+  def _create(data_file, rows, input_position=None):
+    if suffix == '.dtitle.columnar':
+      _write_columnar(data_file, rows)
+      return task._create_dtitle_columnar_dataset(data_file, 4, _MAX_INPUT_LENGTH, _MAX_TARGET_LENGTH, _EOS_ID, training=True, block_size=4,
+                                                  input_position=input_position)
+    _write_tokenized(data_file, rows)
+    return task._create_dtitle_tokenized_dataset(data_file, 4, _MAX_INPUT_LENGTH, _MAX_TARGET_LENGTH, 64, 64, _MAX_INPUT_LENGTH - 128, _EOS_ID,
+                                                 training=True, input_position=input_position)
+
+  # the saved position skips the rows before it, and the next passes start at the head
+  expected = _to_lists(_create(str(tmp_path / ('expected' + suffix)), _ROWS[position:] + _ROWS * 2).take(6))
+  input_position = tf.Variable(position, dtype=tf.int64)
+  assert _to_lists(_create(str(tmp_path / ('data' + suffix)), _ROWS, input_position).take(6)) == expected
+  # the position follows the rows read, which are ahead of the batches taken
+  assert 0 < input_position.numpy() <= len(_ROWS)
+
+
+def _dataset_task(task, tmp_path, max_input_length):
+  vocab_file = tmp_path / 'vocab'
+  (tmp_path / 'vocab.subwords').write_text('')
+  task.flags_obj.__dict__.update(vocab_file=str(vocab_file), input_concat_schema='', dataset_cache_dir=None, batch_tokens=0, use_reformer=False)
+  task.params = {'batch_size': 2, 'max_input_length': max_input_length, 'max_target_length': _MAX_TARGET_LENGTH, 'vocab_size': 100}
+  task.EOS_id = _EOS_ID
+  return task
+
+
+def test_dataset_targets_of_tokenized_tfrecord(task, tmp_path):
+  # segments of url, hostname and html are concatenated into the inputs, the limits of hostname and url are 64
+  task = _dataset_task(task, tmp_path, 128 + 8)
+  data_file = str(tmp_path / 'data.tokenized-tfrecord')
+  _write_tokenized(data_file, _ROWS[:4])
+  (inputs, targets), labels = next(iter(task._create_dataset(data_file, repeat=1)))
+  assert inputs.shape == [2, 128 + 8]
+  assert targets.numpy().tolist() == labels.numpy().tolist() == [[60, 61, _EOS_ID, 0, 0], [62, _EOS_ID, 0, 0, 0]]
+
+
+def test_dataset_rejects_batches_of_other_features(task, tmp_path, monkeypatch):
+  task = _dataset_task(task, tmp_path, _MAX_INPUT_LENGTH)
+  data_file = tmp_path / 'data.tfrecord'
+  data_file.write_bytes(b'')
+  batch = tf.zeros([2, _MAX_INPUT_LENGTH], tf.int32)
+  monkeypatch.setattr(task, '_create_tfrecord_dataset', lambda *args: tf.data.Dataset.from_tensors((batch, batch, batch)))
+  with pytest.raises(ValueError, match='3 features'):
+    task._create_dataset(str(data_file), repeat=1)
+
+
+def test_dataset_resumes_a_single_file_and_reseeds_shards(task, tmp_path):
+  task = _dataset_task(task, tmp_path, 128 + 8)
+  for shard in range(2):
+    _write_tokenized(str(tmp_path / f'data-{shard}.tokenized-tfrecord'), _ROWS[shard::2])
+  input_position = tf.Variable(3, dtype=tf.int64)
+  (inputs, targets), _ = next(iter(task._create_dataset(str(tmp_path / 'data-0.tokenized-tfrecord'), repeat=None, input_position=input_position)))
+  # rows 6 and 8 of _ROWS, after the 3 rows skipped
+  assert targets.numpy().tolist() == [[74, 75, 76, _EOS_ID, 0], [62, _EOS_ID, 0, 0, 0]]
+  assert input_position.numpy() > 3
+
+  # the shards of a multi-shard input are read in a random order, which is reseeded instead
+  task._create_dataset(str(tmp_path / 'data-*.tokenized-tfrecord'), repeat=None, shuffle_seed=1, input_position=input_position)
+  assert input_position.numpy() == 0
+
+
+def test_val_data_file_is_never_a_training_file(task, tmp_path):
+  for name in ['x-training-0.dtitle.tokenized.gz', 'x-training-1.dtitle.tokenized.gz', 'x-test.dtitle.tokenized.gz']:
+    (tmp_path / name).write_bytes(b'')
+  training = str(tmp_path / 'x-training-0.dtitle.tokenized.gz')
+  assert task._get_val_data_file(training) == str(tmp_path / 'x-test.dtitle.tokenized.gz')
+  # the pattern derived from a glob would still match the training shards
+  glob = str(tmp_path / 'x-*.dtitle.tokenized.gz')
+  with pytest.raises(ValueError, match='--val_data_dir is required'):
+    task._get_val_data_file(glob)
+  assert task._get_val_data_file(glob, str(tmp_path / 'y-test.dtitle.tokenized.gz')) == str(tmp_path / 'y-test.dtitle.tokenized.gz')
+  with pytest.raises(ValueError, match='includes training files'):
+    task._get_val_data_file(str(tmp_path / 'x-training-*.dtitle.tokenized.gz'), training)
+  # without -training in the name, the derived file is data_file itself
+  with pytest.raises(ValueError, match='includes training files'):
+    task._get_val_data_file(str(tmp_path / 'x-test.dtitle.tokenized.gz'))
+
+
+@pytest.mark.parametrize('data_file', ['x-*.dtitle', 'x-0.dtitle.gz,x-1.dtitle.gz', 'x-?.dtitle.columnar'])
+def test_dataset_rejects_globs_of_text_and_columnar_formats(task, tmp_path, data_file):
+  task = _dataset_task(task, tmp_path, _MAX_INPUT_LENGTH)
+  with pytest.raises(ValueError, match='only supported by the TFRecord formats'):
+    task._create_dataset(str(tmp_path / data_file), repeat=1)
+
+
+# the graph of TFSubwordEncoder takes a while to build, so the bad lines are only of the field count and the separators
+@pytest.mark.parametrize('bad_line', [None, 'u\tt\th', 'u\tt\x01\th\th\x00tml'])
+def test_graph_tokenizer_rejects_bad_lines(task, tmp_path, bad_line):
+  task = _dataset_task(task, tmp_path, 128 + 8)
+  task.flags_obj.__dict__.update(dtitle_tokenizer='graph', input_concat_schema='v1')
+  (tmp_path / 'vocab.subwords').write_text('### SubwordTextEncoder\n### Metadata: {}\n' + ''.join(f"'{w}'\n" for w in ['<pad>', '<EOS>', 'http', 'a_', 'b_', 't']),
+                                           encoding='utf8')
+  task.tokenizer = dtitle.SubwordTrieEncoder.load_from_file(task.flags_obj.vocab_file)
+  data_file = tmp_path / 'data.dtitle'
+  data_file.write_text('\n'.join(['http://a\tta\ta\t<p>a'] + ([bad_line] if bad_line else []) + ['http://b\ttb\tb\t<p>b']) + '\n', encoding='utf8')
+  if bad_line is None:
+    assert len(list(task._create_dataset(str(data_file), repeat=1))) == 1
+  else:
+    with pytest.raises(tf.errors.InvalidArgumentError, match='.dtitle line must'):
+      list(task._create_dataset(str(data_file), repeat=1))
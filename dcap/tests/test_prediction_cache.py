@@ -0,0 +1,40 @@
+import numpy as np
+
+from prediction_cache import PredictionCache
+
+
+def test_get_returns_the_cached_keys(tmp_path):
+  cache = PredictionCache(str(tmp_path / 'cache.sqlite'), 'model-a')
+  keys = cache.keys(np.array([[1, 2, 0], [3, 4, 5], [1, 2, 0]]))
+  assert keys[0] == keys[2] and keys[0] != keys[1]
+  assert cache.get(keys) == {}
+  cache.put({keys[0]: ('title a', '0.1')})
+  assert cache.get(keys) == {keys[0]: ('title a', '0.1')}
+  assert (cache.hits, cache.lookups) == (2, 6)
+  cache.close()
+
+
+def test_keys_depend_on_the_model_key(tmp_path):
+  input_ids = np.array([[1, 2, 3]])
+  cache_a = PredictionCache(str(tmp_path / 'cache.sqlite'), 'model-a')
+  cache_b = PredictionCache(str(tmp_path / 'cache.sqlite'), 'model-b')
+  assert cache_a.keys(input_ids) != cache_b.keys(input_ids)
+  # the same ids of another int dtype have the same key
+  assert cache_a.keys(input_ids) == cache_a.keys(input_ids.astype(np.int64))
+  cache_a.put({cache_a.keys(input_ids)[0]: ('title a', '0.1')})
+  assert cache_b.get(cache_b.keys(input_ids)) == {}
+  cache_a.close()
+  cache_b.close()
+
+
+def test_predictions_persist_across_instances(tmp_path):
+  path = str(tmp_path / 'cache.sqlite')
+  cache = PredictionCache(path, 'model-a')
+  keys = cache.keys(np.arange(600 * 4).reshape([600, 4]))
+  cache.put({key: (f'title {idx}', '0.5') for idx, key in enumerate(keys)})
+  cache.close()
+  cache = PredictionCache(path, 'model-a')
+  cached = cache.get(keys)
+  assert len(cached) == 600 and cached[keys[599]] == ('title 599', '0.5')
+  assert cache.format_stats().endswith('hit rate 100.0%')
+  cache.close()
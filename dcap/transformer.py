@@ -25,11 +25,11 @@ import tensorflow as tf
 
 import utils as model_utils
 import attention_layer
-from official.nlp.modeling.ops import beam_search
 from official.nlp.transformer import embedding_layer
 from official.nlp.transformer import ffn_layer
 # TODO: ffn_layer adds another duplicated dropout layer?
 import metrics
+import decoding
 
 
 def create_model(params, mode):
@@ -38,25 +38,29 @@ def create_model(params, mode):
     if mode == 'train' or mode == 'eval':
       inputs = tf.keras.layers.Input((None,), dtype="int32", name="inputs")
       targets = tf.keras.layers.Input((None,), dtype="int32", name="targets")
+      model_inputs = [inputs, targets]
+      if params.get("pack_examples"):
+        # segment ids and positions of packed examples
+        model_inputs += [
+            tf.keras.layers.Input((None,), dtype="int32", name=name)
+            for name in ["inputs_segmentation", "inputs_position",
+                         "targets_segmentation", "targets_position"]]
       internal_model = Transformer(params, name="transformer_v2")
-      logits = internal_model([inputs, targets], training=mode == 'train')
+      logits = internal_model(model_inputs, training=mode == 'train')
       if params["enable_metrics_in_training"]:
         vocab_size = params["vocab_size"]
         label_smoothing = params["label_smoothing"]
         logits = metrics.MetricLayer(vocab_size, label_smoothing)([logits, targets])
       logits = tf.keras.layers.Lambda(lambda x: x, name="logits",
                                       dtype=tf.float32)(logits)
-      model = tf.keras.Model([inputs, targets], logits)
+      model = tf.keras.Model(model_inputs, logits)
       return model
     else:
       inputs = tf.keras.layers.Input((None,), dtype="int32", name="inputs")
-      targets = tf.keras.layers.Input((None,), dtype="int32", name="targets")
       internal_model = Transformer(params, name="transformer_v2")
       ret = internal_model([inputs], training=False)
-      logits = internal_model([inputs, targets], training=False)
-      null_logit = tf.nn.softmax(logits[0])[1]
-      outputs, scores = ret["outputs"], ret["scores"]
-      return tf.keras.Model([inputs, targets], [inputs, outputs, scores, null_logit])
+      outputs, scores, null_probs = ret["outputs"], ret["scores"], ret["null_probs"]
+      return tf.keras.Model(inputs, [inputs, outputs, scores, null_probs])
 
 
 class Transformer(tf.keras.Model):
@@ -93,10 +97,15 @@ class Transformer(tf.keras.Model):
     """Calculate target logits or inferred target sequences.
 
     Args:
-      inputs: input tensor list of size 1 or 2.
+      inputs: input tensor list of size 1, 2 or 6.
         First item, inputs: int tensor with shape [batch_size, input_length].
         Second item (optional), targets: None or int tensor with shape
           [batch_size, target_length].
+        The other 4 items (optional) of packed examples: int tensors of
+          inputs_segmentation, inputs_position with shape [batch_size,
+          input_length] and targets_segmentation, targets_position with shape
+          [batch_size, target_length]. Segment ids start from 1 in each row
+          and positions restart from 0 in each segment.
       training: boolean, whether in training mode or not.
 
     Returns:
@@ -105,13 +114,18 @@ class Transformer(tf.keras.Model):
       If target is none, then generate output sequence one token at a time.
         returns a dictionary {
           outputs: [batch_size, decoded length]
-          scores: [batch_size, float]}
+          scores: [batch_size, float]
+          null_probs: [batch_size, float], probability of the null title
+            (id 1) at the first decoding step}
       Even when float16 is used, the output tensor(s) are always float32.
 
     Raises:
       NotImplementedError: If try to use padded decode method on CPU/GPUs.
     """
-    if len(inputs) == 2:
+    segments = [None] * 4
+    if len(inputs) == 6:
+      inputs, targets, segments = inputs[0], inputs[1], inputs[2:]
+    elif len(inputs) == 2:
       inputs, targets = inputs[0], inputs[1]
     else:
       inputs, targets = inputs[0], None
@@ -123,26 +137,37 @@ class Transformer(tf.keras.Model):
     with tf.name_scope("Transformer"):
       # Calculate attention bias for encoder self-attention and decoder
       # multi-headed attention layers.
-      attention_bias = model_utils.get_padding_bias(inputs)
+      inputs_segmentation, inputs_position, targets_segmentation, targets_position = segments
+      attention_bias = model_utils.get_padding_bias(
+          inputs, segment_ids=inputs_segmentation)
 
       # Run the inputs through the encoder layer to map the symbol
       # representations to continuous representations.
-      encoder_outputs = self.encode(inputs, attention_bias, training)
+      encoder_outputs = self.encode(inputs, attention_bias, training,
+                                    inputs_position)
       # Generate output sequence if targets is None, or return logits if target
       # sequence is known.
       if targets is None:
         return self.predict(encoder_outputs, attention_bias, training)
       else:
-        logits = self.decode(targets, encoder_outputs, attention_bias, training)
+        if inputs_segmentation is not None:
+          attention_bias = model_utils.get_padding_bias(
+              inputs, segment_ids=inputs_segmentation,
+              query_segment_ids=targets_segmentation)
+        logits = self.decode(targets, encoder_outputs, attention_bias, training,
+                             targets_segmentation, targets_position)
         return logits
 
-  def encode(self, inputs, attention_bias, training):
+  def encode(self, inputs, attention_bias, training, positions=None):
     """Generate continuous representation for inputs.
 
     Args:
       inputs: int tensor with shape [batch_size, input_length].
-      attention_bias: float tensor with shape [batch_size, 1, 1, input_length].
+      attention_bias: float tensor with shape [batch_size, 1, 1, input_length],
+        or [batch_size, 1, input_length, input_length] of packed inputs.
       training: boolean, whether in training mode or not.
+      positions: optional int tensor with shape [batch_size, input_length],
+        positions of packed inputs in their segments.
 
     Returns:
       float tensor with shape [batch_size, input_length, hidden_size]
@@ -160,6 +185,8 @@ class Transformer(tf.keras.Model):
         pos_encoding = model_utils.get_position_encoding(
             length, self.params["hidden_size"])
         pos_encoding = tf.cast(pos_encoding, self.params["dtype"])
+        if positions is not None:
+          pos_encoding = tf.gather(pos_encoding, positions)
         encoder_inputs = embedded_inputs + pos_encoding
 
       if training:
@@ -169,7 +196,8 @@ class Transformer(tf.keras.Model):
       return self.encoder_stack(
           encoder_inputs, attention_bias, inputs_padding, training=training)
 
-  def decode(self, targets, encoder_outputs, attention_bias, training):
+  def decode(self, targets, encoder_outputs, attention_bias, training,
+             segment_ids=None, positions=None):
     """Generate logits for each value in the target sequence.
 
     Args:
@@ -177,8 +205,13 @@ class Transformer(tf.keras.Model):
         [batch_size, target_length]
       encoder_outputs: continuous representation of input sequence. float tensor
         with shape [batch_size, input_length, hidden_size]
-      attention_bias: float tensor with shape [batch_size, 1, 1, input_length]
+      attention_bias: float tensor with shape [batch_size, 1, 1, input_length],
+        or [batch_size, 1, target_length, input_length] of packed examples.
       training: boolean, whether in training mode or not.
+      segment_ids: optional int tensor with shape [batch_size, target_length],
+        segment ids of packed targets.
+      positions: optional int tensor with shape [batch_size, target_length],
+        positions of packed targets in their segments.
 
     Returns:
       float32 tensor with shape [batch_size, target_length, vocab_size]
@@ -193,11 +226,16 @@ class Transformer(tf.keras.Model):
         # Shift targets to the right, and remove the last element
         decoder_inputs = tf.pad(decoder_inputs,
                                 [[0, 0], [1, 0], [0, 0]])[:, :-1, :]
+        if positions is not None:
+          # the first target of each packed segment starts from zeros as well
+          decoder_inputs *= tf.cast(positions > 0, decoder_inputs.dtype)[:, :, None]
       with tf.name_scope("add_pos_encoding"):
         length = tf.shape(decoder_inputs)[1]
         pos_encoding = model_utils.get_position_encoding(
             length, self.params["hidden_size"])
         pos_encoding = tf.cast(pos_encoding, self.params["dtype"])
+        if positions is not None:
+          pos_encoding = tf.gather(pos_encoding, positions)
         decoder_inputs += pos_encoding
       if training:
         decoder_inputs = tf.nn.dropout(
@@ -205,7 +243,7 @@ class Transformer(tf.keras.Model):
 
       # Run values
       decoder_self_attention_bias = model_utils.get_decoder_self_attention_bias(
-          length, dtype=self.params["dtype"])
+          length, dtype=self.params["dtype"], segment_ids=segment_ids)
       outputs = self.decoder_stack(
           decoder_inputs,
           encoder_outputs,
@@ -319,24 +357,19 @@ class Transformer(tf.keras.Model):
     cache["encoder_outputs"] = encoder_outputs
     cache["encoder_decoder_attention_bias"] = encoder_decoder_attention_bias
 
-    # Use beam search to find the top beam_size sequences and scores.
-    decoded_ids, scores = beam_search.sequence_beam_search(
-        symbols_to_logits_fn=symbols_to_logits_fn,
-        initial_ids=initial_ids,
-        initial_cache=cache,
-        vocab_size=self.params["vocab_size"],
-        beam_size=self.params["beam_size"],
-        alpha=self.params["alpha"],
-        max_decode_length=max_decode_length,
-        eos_id=self.params["vocab_size"] + 1,  # EOS_ID,
-        padded_decode=self.params["padded_decode"],
-        dtype=self.params["dtype"])
-
-    # Get the top sequence for each batch element
-    top_decoded_ids = decoded_ids[:, 0, 1:]
-    top_scores = scores[:, 0]
-
-    return {"outputs": top_decoded_ids, "scores": top_scores}
+    # The first decoding step on a copy of the cache, its logits are the same
+    # as the first step of decoding, which are not returned by it.
+    first_logits, _ = symbols_to_logits_fn(
+        initial_ids[:, None], 0, tf.nest.map_structure(tf.identity, cache))
+    null_probs = tf.nn.softmax(tf.cast(first_logits, tf.float32))[:, 1]
+
+    # Decode by params["decode_strategy"], beam search by default.
+    top_decoded_ids, top_scores = decoding.decode(
+        symbols_to_logits_fn, initial_ids, cache, self.params,
+        max_decode_length)
+
+    return {"outputs": top_decoded_ids, "scores": top_scores,
+            "null_probs": null_probs}
 
 
 class LayerNormalization(tf.keras.layers.Layer):
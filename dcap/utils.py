@@ -63,7 +63,7 @@ def get_position_encoding(length,
   return signal
 
 
-def get_decoder_self_attention_bias(length, dtype=tf.float32):
+def get_decoder_self_attention_bias(length, dtype=tf.float32, segment_ids=None):
   """Calculate bias for decoder that maintains model's autoregressive property.
 
   Creates a tensor that masks out locations that correspond to illegal
@@ -73,19 +73,48 @@ def get_decoder_self_attention_bias(length, dtype=tf.float32):
   Args:
     length: int length of sequences in batch.
     dtype: The dtype of the return value.
+    segment_ids: optional int tensor with shape [batch_size, length] of packed
+      targets, positions cannot draw information from other segments either.
 
   Returns:
-    float tensor of shape [1, 1, length, length]
+    float tensor of shape [1, 1, length, length], or [batch_size, 1, length,
+    length] when segment_ids is given.
   """
   neg_inf = _NEG_INF_FP16 if dtype == tf.float16 else _NEG_INF_FP32
   with tf.name_scope("decoder_self_attention_bias"):
     valid_locs = tf.linalg.band_part(tf.ones([length, length], dtype=dtype),
                                      -1, 0)
     valid_locs = tf.reshape(valid_locs, [1, 1, length, length])
+    if segment_ids is not None:
+      valid_locs *= 1.0 - get_segment_mask(segment_ids, segment_ids, dtype)
     decoder_bias = neg_inf * (1.0 - valid_locs)
   return decoder_bias
 
 
+def get_segment_mask(query_segment_ids, segment_ids, dtype=tf.float32):
+  """Return float tensor representing the attentions across segments of packed
+  examples.
+
+  Segment ids start from 1 in each row and 0 means padding. Padding queries are
+  not masked, so that every query attends to at least one position.
+
+  Args:
+    query_segment_ids: int tensor with shape [batch_size, query_length]
+    segment_ids: int tensor with shape [batch_size, length]
+    dtype: The dtype of the return value.
+
+  Returns:
+    float tensor with shape [batch_size, 1, query_length, length] containing
+      values 0 or 1. 0 -> the same segment, 1 -> across segments
+  """
+  with tf.name_scope("segment_mask"):
+    across = tf.not_equal(tf.expand_dims(query_segment_ids, axis=2),
+                          tf.expand_dims(segment_ids, axis=1))
+    across = tf.logical_and(across,
+                            tf.expand_dims(query_segment_ids > 0, axis=2))
+    return tf.expand_dims(tf.cast(across, dtype), axis=1)
+
+
 def get_padding(x, padding_value=0, dtype=tf.float32):
   """Return float tensor representing the padding values in x.
 
@@ -102,7 +131,8 @@ def get_padding(x, padding_value=0, dtype=tf.float32):
     return tf.cast(tf.equal(x, padding_value), dtype)
 
 
-def get_padding_bias(x, padding_value=0, dtype=tf.float32):
+def get_padding_bias(x, padding_value=0, dtype=tf.float32, segment_ids=None,
+                     query_segment_ids=None):
   """Calculate bias tensor from padding values in tensor.
 
   Bias tensor that is added to the pre-softmax multi-headed attention logits,
@@ -113,15 +143,25 @@ def get_padding_bias(x, padding_value=0, dtype=tf.float32):
     x: int tensor with shape [batch_size, length]
     padding_value: int which represents padded values in input
     dtype: The dtype of the return value
+    segment_ids: optional int tensor with shape [batch_size, length] of packed
+      x, attentions across segments are masked like paddings.
+    query_segment_ids: optional int tensor with shape [batch_size,
+      query_length], segment ids of the queries, segment_ids by default (self
+      attention of x).
 
   Returns:
-    Attention bias tensor of shape [batch_size, 1, 1, length].
+    Attention bias tensor of shape [batch_size, 1, 1, length], or [batch_size,
+    1, query_length, length] when segment_ids is given.
   """
   with tf.name_scope("attention_bias"):
     padding = get_padding(x, padding_value, dtype)
+    padding = tf.expand_dims(tf.expand_dims(padding, axis=1), axis=1)
+    if segment_ids is not None:
+      if query_segment_ids is None:
+        query_segment_ids = segment_ids
+      padding = tf.maximum(
+          padding, get_segment_mask(query_segment_ids, segment_ids, dtype))
     attention_bias = padding * _NEG_INF_FP32
-    attention_bias = tf.expand_dims(
-        tf.expand_dims(attention_bias, axis=1), axis=1)
   return attention_bias
 
 